@@ -0,0 +1,195 @@
+# Outbound announcements.
+# Reports like the nightly decay can have a field per runner, far more than one
+# Discord embed holds, so they're built as plain EmbedPages, split to fit Discord's
+# limits (paginate) and packed several to a message (pack). Messages then go out
+# through an Announcer: one queue per channel, each kept inside the channel's rate
+# limit so the API never has to turn sends away, with channels sent to concurrently
+# and failed sends retried with backoff. Nothing here needs discord.py; main.py hands
+# the Announcer a function that does the actual send.
+
+import asyncio
+import logging
+import random
+import time
+
+import metrics
+
+logger = logging.getLogger('ranked')
+
+# Discord's limits
+MAX_TITLE = 256
+MAX_DESCRIPTION = 4096
+MAX_FIELDS = 25
+MAX_FIELD_NAME = 256
+MAX_FIELD_VALUE = 1024
+MAX_FOOTER = 2048
+# Counted over every embed in a message, not just each embed
+MAX_MESSAGE_CHARS = 6000
+MAX_EMBEDS_PER_MESSAGE = 10
+
+# Each channel gets CHANNEL_BURST messages per CHANNEL_PERIOD seconds, about what
+# Discord allows a bot in one channel
+CHANNEL_BURST = 5
+CHANNEL_PERIOD = 5.0
+
+# A failed send is tried up to MAX_ATTEMPTS times in all, waiting BACKOFF seconds
+# before the first retry and twice as long before each one after that
+MAX_ATTEMPTS = 5
+BACKOFF = 1.0
+
+class EmbedPage:
+    __slots__ = ('title', 'description', 'fields', 'footer')
+
+    def __init__(self, title, description=None, fields=(), footer=None):
+        self.title = title
+        self.description = description
+        self.fields = list(fields)
+        self.footer = footer
+
+    # Characters counted against MAX_MESSAGE_CHARS
+    def size(self):
+        return len(self.title) + len(self.description or '') + len(self.footer or '') + sum(len(name) + len(value) for name, value in self.fields)
+
+    def __repr__(self):
+        return f'EmbedPage({self.title!r}, {len(self.fields)} fields)'
+
+def _truncate(text, limit):
+    return text if len(text) <= limit else text[:limit - 1] + '…'
+
+# Splits an embed's fields (a list of (name, value)) over as many EmbedPages as it
+# takes to stay inside Discord's limits. The description goes on the first page, the
+# footer on every page, and the pages after the first are titled "<title> (continued)".
+def paginate(title, description=None, fields=(), footer=None):
+    title = _truncate(title, MAX_TITLE - len(' (continued)'))
+    description = _truncate(description, MAX_DESCRIPTION) if description else None
+    footer = _truncate(footer, MAX_FOOTER) if footer else None
+    page = EmbedPage(title, description, footer=footer)
+    pages = [page]
+    size = page.size()
+    for name, value in fields:
+        field = (_truncate(name, MAX_FIELD_NAME), _truncate(value, MAX_FIELD_VALUE))
+        field_size = len(field[0]) + len(field[1])
+        if len(page.fields) == MAX_FIELDS or size + field_size > MAX_MESSAGE_CHARS:
+            page = EmbedPage(title + ' (continued)', footer=footer)
+            pages.append(page)
+            size = page.size()
+        page.fields.append(field)
+        size += field_size
+    return pages
+
+# Groups pages, in order, into as few messages as fit Discord's per-message limits
+def pack(pages):
+    messages = []
+    size = 0
+    for page in pages:
+        if not messages or len(messages[-1]) == MAX_EMBEDS_PER_MESSAGE or size + page.size() > MAX_MESSAGE_CHARS:
+            messages.append([])
+            size = 0
+        messages[-1].append(page)
+        size += page.size()
+    return messages
+
+# Raised by a send function for a message that can never be delivered (e.g. the
+# channel is gone), so it isn't retried
+class Undeliverable(Exception):
+    pass
+
+# Token bucket for one channel's sends
+class RateBudget:
+    def __init__(self, burst=CHANNEL_BURST, period=CHANNEL_PERIOD):
+        self.burst = burst
+        self.period = period
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.burst / self.period)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) * self.period / self.burst)
+
+    # Spends the whole budget, for when Discord says to slow down anyway
+    def drain(self):
+        self.tokens = 0
+        self.updated = time.monotonic()
+
+class Announcer:
+    # send(channel_id, pages) is a coroutine function that sends one message
+    def __init__(self, send, burst=CHANNEL_BURST, period=CHANNEL_PERIOD, max_attempts=MAX_ATTEMPTS, backoff=BACKOFF):
+        self.send = send
+        self.burst = burst
+        self.period = period
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.budgets = {}
+        self.queues = {}
+        self.workers = set()
+
+    # Queues pages to go out to a channel, packed into as few messages as possible, after
+    # anything already queued for it. Returns a future that resolves to whether every
+    # message was delivered; it never raises, so it's fine not to await it.
+    def post(self, channel_id, pages):
+        futures = []
+        for message in pack(pages):
+            future = asyncio.get_running_loop().create_future()
+            futures.append(future)
+            queue = self.queues.get(channel_id)
+            if queue is None:
+                queue = self.queues[channel_id] = asyncio.Queue()
+                worker = asyncio.create_task(self._drain(channel_id, queue))
+                self.workers.add(worker)
+                worker.add_done_callback(self.workers.discard)
+            queue.put_nowait((message, future))
+        return asyncio.ensure_future(self._all(futures))
+
+    @staticmethod
+    async def _all(futures):
+        return all(await asyncio.gather(*futures))
+
+    # Waits for everything queued so far to be sent or given up on
+    async def join(self):
+        while self.workers:
+            await asyncio.gather(*self.workers)
+
+    # Sends a channel's queue in order, then retires, so idle channels cost nothing
+    async def _drain(self, channel_id, queue):
+        budget = self.budgets.setdefault(channel_id, RateBudget(self.burst, self.period))
+        while not queue.empty():
+            message, future = queue.get_nowait()
+            delivered = await self._deliver(channel_id, message, budget)
+            metrics.announcement_messages.inc('sent' if delivered else 'failed')
+            future.set_result(delivered)
+        del self.queues[channel_id]
+
+    async def _deliver(self, channel_id, message, budget):
+        for attempt in range(self.max_attempts):
+            await budget.acquire()
+            try:
+                await self.send(channel_id, message)
+                return True
+            except Undeliverable as e:
+                logger.warning("Dropped announcement for channel %s: %s", channel_id, e)
+                return False
+            except Exception as e:
+                # discord.HTTPException has the response's status; anything without one
+                # (timeouts, dropped connections) is worth retrying too
+                status = getattr(e, 'status', None)
+                if status is not None and 400 <= status < 500 and status != 429:
+                    logger.warning("Dropped announcement for channel %s: %r", channel_id, e)
+                    return False
+                if attempt + 1 == self.max_attempts:
+                    logger.warning("Gave up on announcement for channel %s after %d attempts: %r", channel_id, self.max_attempts, e)
+                    return False
+                if status == 429:
+                    budget.drain()
+                    delay = getattr(e, 'retry_after', None) or self.backoff
+                else:
+                    delay = self.backoff * 2 ** attempt * random.uniform(1, 1.5)
+                metrics.announcement_retries.inc()
+                logger.info("Retrying announcement for channel %s in %.1fs: %r", channel_id, delay, e)
+                await asyncio.sleep(delay)
+        return False
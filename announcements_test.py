@@ -0,0 +1,76 @@
+# Testing class for announcements.py
+import asyncio
+import time
+import unittest
+import announcements
+import metrics
+
+class RateLimited(Exception):
+    status = 429
+    retry_after = 0.01
+
+class Forbidden(Exception):
+    status = 403
+
+class TestAnnouncements(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_paginate_fits_discord_limits(self):
+        fields = [(f"runner {i}", "RR: 100 -> 95 (Lost 5 RR)") for i in range(60)]
+        pages = announcements.paginate("End of Monday", "It's the end of the day", fields, "footer")
+        self.assertEqual([len(page.fields) for page in pages], [25, 25, 10])
+        self.assertEqual([page.title for page in pages], ["End of Monday", "End of Monday (continued)", "End of Monday (continued)"])
+        self.assertEqual([page.description for page in pages], ["It's the end of the day", None, None])
+        self.assertEqual([field for page in pages for field in page.fields], fields)
+        # Long values are cut down and pages stay under the character limit
+        pages = announcements.paginate("Big", None, [("name", "x" * 2000)] * 10)
+        self.assertTrue(all(page.size() <= announcements.MAX_MESSAGE_CHARS for page in pages))
+        self.assertEqual(len(pages[0].fields[0][1]), announcements.MAX_FIELD_VALUE)
+        self.assertEqual(sum(len(page.fields) for page in pages), 10)
+
+    def test_pack(self):
+        small = announcements.paginate("Small", None, [("a", "b")])
+        big = announcements.paginate("Big", None, [("name", "x" * 1000)] * 5)
+        self.assertEqual([len(message) for message in announcements.pack(small * 12)], [10, 2])
+        self.assertEqual([len(message) for message in announcements.pack(small + big + big + small)], [2, 2])
+
+    async def test_rate_budget_and_concurrency(self):
+        sent = []
+        async def send(channel_id, pages):
+            sent.append((channel_id, time.monotonic()))
+        announcer = announcements.Announcer(send, burst=2, period=0.2)
+        pages = announcements.paginate("Hi")
+        start = time.monotonic()
+        futures = [announcer.post(channel_id, pages) for _ in range(4) for channel_id in (1, 2)]
+        self.assertTrue(all(await asyncio.gather(*futures)))
+        # Two at once per channel, then one every 0.1s, with both channels going together
+        for channel_id in (1, 2):
+            times = [at - start for sent_to, at in sent if sent_to == channel_id]
+            self.assertEqual(len(times), 4)
+            self.assertLess(times[1], 0.05)
+            self.assertGreater(times[3], 0.15)
+        self.assertLess(time.monotonic() - start, 0.4)
+        self.assertEqual(announcer.queues, {})
+        self.assertEqual(metrics.announcement_messages.values, {'sent': 8})
+
+    async def test_retries(self):
+        attempts = []
+        async def send(channel_id, pages):
+            attempts.append(channel_id)
+            if channel_id == 1 and attempts.count(1) < 3:
+                raise RateLimited()
+            if channel_id == 2:
+                raise Forbidden()
+            if channel_id == 3:
+                raise ConnectionError()
+        announcer = announcements.Announcer(send, period=0.05, max_attempts=3, backoff=0.01)
+        pages = announcements.paginate("Hi")
+        results = await asyncio.gather(*(announcer.post(channel_id, pages) for channel_id in (1, 2, 3)))
+        self.assertEqual(results, [True, False, False])
+        self.assertEqual(sorted(attempts), [1, 1, 1, 2, 3, 3, 3])
+        self.assertEqual(metrics.announcement_retries.values, {None: 4})
+
+if __name__ == '__main__':
+    unittest.main()
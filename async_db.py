@@ -0,0 +1,353 @@
+# Async data access for the bot.
+# db.py is synchronous and sqlite3 blocks, so calling it straight from a command
+# handler stalls the gateway heartbeat and every other guild's commands.
+# Everything here ships the call off the event loop instead:
+# - mutators run in submission order on one dedicated writer thread, which owns
+#   db.conn (SQLite only allows a single writer at a time anyway)
+# - accessors run on a small pool of threads, each with its own read-only
+#   connection, so profile/leaderboard lookups don't queue behind writes
+
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import queue
+import threading
+import time
+
+import backups
+import cache
+import db
+import leaderboard
+
+READER_THREADS = 4
+
+# Group commit: once a write arrives, the writer waits up to GROUP_COMMIT_WINDOW
+# seconds for more (up to GROUP_COMMIT_MAX writes) and commits them all as one
+# transaction, so a burst of !mile log costs one commit instead of one each.
+# Every write still runs in its own savepoint, so one failing doesn't take the
+# rest of the group down with it. Callers only hear back once the commit is done.
+GROUP_COMMIT_WINDOW = 0.002
+GROUP_COMMIT_MAX = 256
+
+_writes = queue.Queue()
+_writer = None
+_writer_lock = threading.Lock()
+_readers = concurrent.futures.ThreadPoolExecutor(max_workers=READER_THREADS, thread_name_prefix='db-reader', initializer=db.open_reader)
+
+# A write that has to be committed on its own, held over from the group before
+_held = None
+
+# Collects the next group of writes. Returns (group, stop), where stop means close()
+# was called and the writer should exit once this group is done. A write submitted
+# with run_write_alone always makes up a group by itself.
+def _next_group():
+    global _held
+    job, _held = _held, None
+    if job is None:
+        job = _writes.get()
+    if job is None:
+        return [], True
+    group = [job]
+    if job[4]:
+        return group, False
+    deadline = time.monotonic() + GROUP_COMMIT_WINDOW
+    while len(group) < GROUP_COMMIT_MAX:
+        try:
+            job = _writes.get(timeout=max(0, deadline - time.monotonic()))
+        except queue.Empty:
+            break
+        if job is None:
+            return group, True
+        if job[4]:
+            _held = job
+            break
+        group.append(job)
+    return group, False
+
+def _commit_group(group):
+    outcomes = []
+    try:
+        with db.transaction():
+            for fn, args, kwargs, future, _ in group:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    with db.transaction():
+                        outcomes.append((future, fn(*args, **kwargs), None))
+                except Exception as e:
+                    outcomes.append((future, None, e))
+    except BaseException as e:
+        # The commit itself failed, so none of the group was written
+        for _, _, _, future, _ in group:
+            if not future.done():
+                future.set_exception(e)
+        return
+    for future, result, error in outcomes:
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+def _run_outside_transaction(job):
+    fn, args, kwargs, future, _ = job
+    if not future.set_running_or_notify_cancel():
+        return
+    try:
+        future.set_result(fn(*args, **kwargs))
+    except Exception as e:
+        future.set_exception(e)
+
+def _write_loop():
+    stop = False
+    while not stop:
+        group, stop = _next_group()
+        if group and group[0][4] is OUTSIDE_TRANSACTION:
+            _run_outside_transaction(group[0])
+        elif group:
+            _commit_group(group)
+    db.checkpoint()
+
+def start():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_write_loop, name='db-writer', daemon=True)
+            _writer.start()
+
+async def close():
+    # Let queued writes finish and flush them to disk, then stop the writer and the reader pool.
+    global _writer
+    with _writer_lock:
+        writer, _writer = _writer, None
+    if writer is not None:
+        _writes.put(None)
+        await asyncio.to_thread(writer.join)
+    _readers.shutdown(wait=True)
+
+# Runs fn(*args, **kwargs) on the writer thread. Anything that mutates the
+# database (or reads and then writes based on what it read) must go through here.
+async def run_write(fn, *args, **kwargs):
+    return await _submit(fn, args, kwargs, False)
+
+# Like run_write, but commits fn in a transaction of its own rather than as part of a
+# group. For long writes, like a big guild's end-of-day decay, so that whatever was
+# queued just before them isn't held up until they've finished too.
+async def run_write_alone(fn, *args, **kwargs):
+    return await _submit(fn, args, kwargs, True)
+
+# Like run_write_alone, but runs fn between transactions instead of inside one, for
+# the few things SQLite won't do in a transaction (like db.restore). fn has to manage
+# its own transactions.
+OUTSIDE_TRANSACTION = 'outside transaction'
+
+async def run_write_outside_transaction(fn, *args, **kwargs):
+    return await _submit(fn, args, kwargs, OUTSIDE_TRANSACTION)
+
+async def _submit(fn, args, kwargs, alone):
+    start()
+    future = concurrent.futures.Future()
+    _writes.put((fn, args, kwargs, future, alone))
+    return await asyncio.wrap_future(future)
+
+# Writes for one user (in one guild) take that user's lock, so they go through one at
+# a time in the order they were made: a second !mile log waits for the first to land
+# and then sees it, rather than racing it. Other users' writes never wait on it. Each
+# lock is dropped once nobody holds it or is waiting for it.
+_user_locks = {}
+
+@contextlib.asynccontextmanager
+async def user_lock(guild_id, discord_id):
+    key = (guild_id, discord_id)
+    entry = _user_locks.get(key)
+    if entry is None:
+        entry = _user_locks[key] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _user_locks[key]
+
+# Runs fn(*args, **kwargs) on one of the read-only reader threads.
+async def run_read(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_readers, functools.partial(fn, *args, **kwargs))
+
+# Accessors
+# All scoped to one guild, like the functions in db.py they wrap.
+
+async def get_last_position(guild_id):
+    return await run_read(db.get_last_position, guild_id)
+
+# Cached users are returned without leaving the event loop
+async def get_user(guild_id, discord_id):
+    user, generation = cache.users.get((guild_id, discord_id))
+    if user is None:
+        user = await run_read(db.load_user, guild_id, discord_id, generation)
+    return user
+
+async def get_leaderboard(guild_id):
+    return await run_read(db.get_leaderboard, guild_id)
+
+# Leaderboard pages come from the guild's page cache when they're cached, without
+# leaving the event loop; only a miss goes to a reader thread.
+async def get_leaderboard_page(guild_id, page):
+    pages = leaderboard.pages(guild_id)
+    fields, generation = pages.get(page)
+    if fields is None:
+        first_position = (page - 1) * pages.page_size + 1
+        rows = await run_read(db.get_leaderboard_page, guild_id, first_position, pages.page_size)
+        fields = leaderboard.render_page(rows)
+        pages.put(page, generation, fields)
+    return fields
+
+# Rank summaries are published by the writer as it commits (see
+# db._publish_rank_summaries), so they're read without leaving the event loop. Only a
+# guild without one goes to the writer, to build its leaderboard index: the first time
+# it's asked for, or after a rolled back write or an admin delete dropped the index.
+async def get_rank_summary(guild_id):
+    summary = leaderboard.rank_summaries.get(guild_id)
+    if summary is None:
+        summary = await run_write(db.get_rank_summary, guild_id)
+    return summary
+
+# Has handler(guild_id, old holder, new holder), a coroutine function, run on the
+# current event loop whenever a commit changes who holds a guild's Usain Bolt title
+# (see leaderboard.title_listeners)
+_title_tasks = set()
+
+def on_title_change(handler):
+    loop = asyncio.get_running_loop()
+    def start_handler(guild_id, old_holder, new_holder):
+        task = loop.create_task(handler(guild_id, old_holder, new_holder))
+        _title_tasks.add(task)
+        task.add_done_callback(_title_tasks.discard)
+    leaderboard.title_listeners.append(lambda *change: loop.call_soon_threadsafe(start_handler, *change))
+
+async def get_leaderboard_page_count(guild_id):
+    pages = leaderboard.pages(guild_id)
+    count, generation = pages.get(leaderboard.PageCache.COUNT)
+    if count is None:
+        count = await get_last_position(guild_id)
+        pages.put(leaderboard.PageCache.COUNT, generation, count)
+    return -(-count // pages.page_size)
+
+async def get_users_who_didnt_log_today(guild_id, date, first_offset=db.ALL_OFFSETS[0], end_offset=db.ALL_OFFSETS[1]):
+    return await run_read(db.get_users_who_didnt_log_today, guild_id, date, first_offset, end_offset)
+
+async def count_users(guild_id, first_offset=db.ALL_OFFSETS[0], end_offset=db.ALL_OFFSETS[1]):
+    return await run_read(db.count_users, guild_id, first_offset, end_offset)
+
+# Run history comes back as a list, since the rows have to be read on a reader
+# thread before they can be handed back to the event loop.
+async def get_user_runs(guild_id, discord_id, start=None, end=None):
+    return await run_read(lambda: list(db.iter_user_runs(guild_id, discord_id, start, end)))
+
+async def get_runs(guild_id, start=None, end=None):
+    return await run_read(lambda: list(db.iter_runs(guild_id, start, end)))
+
+async def get_guilds():
+    return await run_read(db.get_guilds)
+
+async def get_announcement_channel(guild_id):
+    return await run_read(db.get_announcement_channel, guild_id)
+
+async def get_user_seasons(guild_id, discord_id):
+    return await run_read(db.get_user_seasons, guild_id, discord_id)
+
+async def get_season_winners(guild_id, limit=None):
+    return await run_read(db.get_season_winners, guild_id, limit)
+
+async def get_season_standings(guild_id, season, limit):
+    return await run_read(db.get_season_standings, guild_id, season, limit)
+
+async def get_rollup(guild_id, discord_id, period, date):
+    return await run_read(db.get_rollup, guild_id, discord_id, period, date)
+
+async def get_period_leaderboard(guild_id, period, date, limit):
+    return await run_read(db.get_period_leaderboard, guild_id, period, date, limit)
+
+# Returns (this week's rollup, this month's rollup, personal best) for a profile, as of
+# date, in one trip to a reader thread
+async def get_profile_stats(guild_id, discord_id, date):
+    return await run_read(lambda: (db.get_rollup(guild_id, discord_id, 'week', date), db.get_rollup(guild_id, discord_id, 'month', date), db.get_personal_best(guild_id, discord_id)))
+
+async def get_last_job_run(job, guild_id):
+    return await run_read(db.get_last_job_run, job, guild_id)
+
+# Mutators
+
+# Between transactions, since it opens the writer connection the first time
+async def setup():
+    return await run_write_outside_transaction(db.setup)
+
+async def record_job_run(job, guild_id, run_at, prune_before=None):
+    return await run_write(db.record_job_run, job, guild_id, run_at, prune_before)
+
+async def set_announcement_channel(guild_id, channel_id):
+    return await run_write(db.set_announcement_channel, guild_id, channel_id)
+
+async def claim_legacy_guild(guild_id, channel_id):
+    return await run_write(db.claim_legacy_guild, guild_id, channel_id)
+
+async def add_new_user(guild_id, discord_id, username):
+    async with user_lock(guild_id, discord_id):
+        return await run_write(db.add_new_user, guild_id, discord_id, username)
+
+async def log_run(guild_id, discord_id, distance, date=None):
+    async with user_lock(guild_id, discord_id):
+        return await run_write(db.log_run, guild_id, discord_id, distance, date)
+
+async def apply_daily_decay(guild_id, date, first_offset=db.ALL_OFFSETS[0], end_offset=db.ALL_OFFSETS[1]):
+    return await run_write_alone(db.apply_daily_decay, guild_id, date, first_offset, end_offset)
+
+# Alone, like the decay: a big guild's reset shouldn't hold up anyone else's writes
+async def reset_season(guild_id, ended):
+    return await run_write_alone(db.reset_season, guild_id, ended)
+
+async def catch_up_decay(guild_id, since, at):
+    return await run_write_alone(db.catch_up_decay, guild_id, since, at)
+
+async def set_timezone(discord_id, timezone):
+    return await run_write(db.set_timezone, discord_id, timezone)
+
+async def refresh_timezone_offsets(at):
+    return await run_write(db.refresh_timezone_offsets, at)
+
+async def adjust_rr(guild_id, discord_id, rr):
+    async with user_lock(guild_id, discord_id):
+        return await run_write(db.adjust_rr, guild_id, discord_id, rr)
+
+async def update_user(guild_id, discord_id, **fields):
+    async with user_lock(guild_id, discord_id):
+        return await run_write(db.update_user, guild_id, discord_id, **fields)
+
+async def update_leaderboard_positions(guild_id):
+    return await run_write(db.update_leaderboard_positions, guild_id)
+
+# Admin Mutators
+# Each one takes a backup first (see backups.py), so a mistaken one can be undone
+# with !mile restore.
+
+async def ADMIN_ONLY_reset_rr(guild_id):
+    await backups.take('before-reset_rr')
+    return await run_write(db.ADMIN_ONLY_reset_rr, guild_id)
+
+async def ADMIN_ONLY_delete_user(guild_id, discord_id):
+    await backups.take('before-delete_user')
+    async with user_lock(guild_id, discord_id):
+        return await run_write(db.ADMIN_ONLY_delete_user, guild_id, discord_id)
+
+async def ADMIN_ONLY_delete_table(guild_id):
+    await backups.take('before-delete_table')
+    return await run_write(db.ADMIN_ONLY_delete_table, guild_id)
+
+# Puts the database back as it was in the backup called name, after backing up the
+# current one in case that was a mistake too. Raises backups.UnknownBackup.
+async def restore_backup(name):
+    path = backups.path_of(name)
+    await backups.take('before-restore')
+    return await run_write_outside_transaction(db.restore, path)
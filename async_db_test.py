@@ -0,0 +1,105 @@
+# Testing class for async_db.py
+import asyncio
+import threading
+import unittest
+from unittest import mock
+import async_db
+import db
+import leaderboard
+
+GUILD = '100'
+
+class TestAsyncDB(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        # Writes go to a fresh in-memory database on the writer thread
+        db.use_database(':memory:')
+
+    async def test_same_user_logs_one_run_a_day(self):
+        db.add_new_user(GUILD, '1', 'a')
+        db.add_new_user(GUILD, '2', 'b')
+        results = await asyncio.gather(*(async_db.log_run(GUILD, discord_id, 1.0, '2025-01-01') for discord_id in '1121'), return_exceptions=True)
+        self.assertEqual([type(result).__name__ for result in results], ['User', 'AlreadyLoggedToday', 'User', 'AlreadyLoggedToday'])
+        self.assertEqual(db.get_user(GUILD, '1').runs_logged, 1)
+        self.assertEqual(async_db._user_locks, {})
+
+    async def test_user_lock_only_blocks_the_same_user(self):
+        order = []
+        async def hold(discord_id, name, delay):
+            async with async_db.user_lock(GUILD, discord_id):
+                order.append(name + ' start')
+                await asyncio.sleep(delay)
+                order.append(name + ' end')
+        await asyncio.gather(hold('1', 'a', 0.02), hold('1', 'b', 0), hold('2', 'c', 0))
+        self.assertEqual(order, ['a start', 'c start', 'c end', 'a end', 'b start', 'b end'])
+        self.assertEqual(async_db._user_locks, {})
+
+    # Queues writes behind one that blocks the writer, so they're all waiting when it
+    # next collects a group. Returns their outcomes and the groups they were committed in.
+    async def write_queued(self, writes):
+        groups = []
+        commit_group = async_db._commit_group
+        def record(group):
+            groups.append([args[0] for _, args, *_ in group if args])
+            commit_group(group)
+        release = threading.Event()
+        blocked = asyncio.ensure_future(async_db.run_write_alone(release.wait))
+        with mock.patch.object(async_db, '_commit_group', record):
+            futures = [asyncio.ensure_future(submit(fn, name)) for submit, fn, name in writes]
+            await asyncio.sleep(0)
+            release.set()
+            await blocked
+            results = await asyncio.gather(*futures, return_exceptions=True)
+        # The first group is the blocking write's
+        return results, groups[1:]
+
+    async def test_group_commit_isolates_a_failing_write(self):
+        for discord_id in '123':
+            db.add_new_user(GUILD, discord_id, discord_id)
+        def adjust(discord_id):
+            db.adjust_rr(GUILD, discord_id, 100)
+            return discord_id
+        def adjust_then_fail(discord_id):
+            adjust(discord_id)
+            raise ValueError(discord_id)
+        results, groups = await self.write_queued([(async_db.run_write, adjust, '1'), (async_db.run_write, adjust_then_fail, '2'), (async_db.run_write, adjust, '3')])
+        self.assertEqual(groups, [['1', '2', '3']])
+        self.assertEqual(results[::2], ['1', '3'])
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual([(user.discord_id, user.rr) for user in db.get_leaderboard(GUILD)], [('1', 100), ('3', 100), ('2', 0)])
+
+    async def test_write_alone_is_held_over_to_its_own_group(self):
+        for discord_id in '1234':
+            db.add_new_user(GUILD, discord_id, discord_id)
+        def adjust(discord_id):
+            db.adjust_rr(GUILD, discord_id, int(discord_id))
+        results, groups = await self.write_queued([(async_db.run_write, adjust, '1'), (async_db.run_write, adjust, '2'), (async_db.run_write_alone, adjust, '3'), (async_db.run_write, adjust, '4')])
+        self.assertEqual(groups, [['1', '2'], ['3'], ['4']])
+        self.assertEqual([user.rr for user in db.get_leaderboard(GUILD)], [4, 3, 2, 1])
+
+    async def test_rank_summary_and_title_changes(self):
+        changes = []
+        async def handler(guild_id, old_holder, new_holder):
+            changes.append((guild_id, old_holder, new_holder))
+        async_db.on_title_change(handler)
+        self.addCleanup(leaderboard.title_listeners.pop)
+        await async_db.add_new_user(GUILD, '1', 'a')
+        # Built on the writer the first time, then read straight from the published summary
+        leaderboard.rank_summaries.clear()
+        self.assertEqual((await async_db.get_rank_summary(GUILD)).runners, 1)
+        self.assertIs(await async_db.get_rank_summary(GUILD), leaderboard.rank_summaries[GUILD])
+        await async_db.adjust_rr(GUILD, '1', 800)
+        await asyncio.sleep(0.01)
+        self.assertEqual(changes, [(GUILD, None, '1')])
+        # Rejected runs don't cost the guild its summary or its index
+        await async_db.log_run(GUILD, '1', 1.0, '2025-01-01')
+        summary, index = leaderboard.rank_summaries[GUILD], db._leaderboards[GUILD]
+        with self.assertRaises(db.AlreadyLoggedToday):
+            await async_db.log_run(GUILD, '1', 1.0, '2025-01-01')
+        with self.assertRaises(db.NotSignedUp):
+            await async_db.log_run(GUILD, '2', 1.0, '2025-01-01')
+        self.assertIs(await async_db.get_rank_summary(GUILD), summary)
+        self.assertIs(db._leaderboards[GUILD], index)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+# Online backups of the database.
+# snapshot copies the live database into BACKUP_DIR with SQLite's backup API,
+# PAGES_PER_STEP pages at a time with a short pause between steps, from a read-only
+# connection of its own. The whole copy happens inside one read transaction on that
+# connection, so it's a consistent snapshot as of when it started: with WAL the writer
+# keeps committing alongside it, and since the copy never sees those commits it never
+# has to start over. take() runs it on a worker thread, off the event loop and out
+# of the reader pool, so commands carry on as normal while it runs.
+#
+# main.py takes a snapshot every BACKUP_INTERVAL_HOURS, async_db takes one before
+# every ADMIN_ONLY mutation, and the admin !mile restore command puts one back (see
+# db.restore). Each kind of snapshot is rotated separately (see KEEP).
+
+import asyncio
+import datetime
+import logging
+import os
+import re
+import sqlite3
+import time
+
+import db
+
+logger = logging.getLogger('ranked')
+
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_INTERVAL_HOURS = 6
+
+# How many snapshots to keep of each label; the oldest beyond that are deleted.
+# Labels not listed here (the before-<command> ones) keep DEFAULT_KEEP.
+KEEP = {'scheduled': int(os.getenv("BACKUP_KEEP", "28"))}
+DEFAULT_KEEP = 10
+
+PAGES_PER_STEP = 256
+STEP_PAUSE = 0.002
+
+# Snapshots are named <UTC time taken>-<label>.db, so they sort oldest first
+NAME = re.compile(r'^(\d{8}T\d{12}Z)-([a-z0-9_-]+)\.db$')
+
+class UnknownBackup(ValueError):
+    pass
+
+def _pause(status, remaining, total):
+    time.sleep(STEP_PAUSE)
+
+# Copies the database to a new snapshot and rotates out old ones with the same label.
+# Returns the snapshot's name. The copy is written under a temporary name and only
+# renamed into place once it's complete, so a crash never leaves half a snapshot.
+def snapshot(label='scheduled', directory=None):
+    directory = directory or BACKUP_DIR
+    os.makedirs(directory, exist_ok=True)
+    name = f"{datetime.datetime.now(datetime.timezone.utc):%Y%m%dT%H%M%S%fZ}-{label}.db"
+    path = os.path.join(directory, name)
+    partial = path + '.partial'
+    started = time.monotonic()
+    source = db.connect(db.DB_PATH, read_only=True)
+    try:
+        target = sqlite3.connect(partial)
+        try:
+            # Pin one read transaction for the whole copy
+            source.execute('BEGIN')
+            source.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+            source.backup(target, pages=PAGES_PER_STEP, progress=_pause)
+            source.execute('ROLLBACK')
+        finally:
+            target.close()
+        os.replace(partial, path)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    finally:
+        source.close()
+    rotate(label, directory)
+    logger.info("Backed up the database to %s in %.1fs", path, time.monotonic() - started)
+    return name
+
+# Names of the snapshots in directory, newest first, optionally only those with label
+def list_snapshots(directory=None, label=None):
+    directory = directory or BACKUP_DIR
+    if not os.path.isdir(directory):
+        return []
+    names = [name for name in os.listdir(directory) if (match := NAME.match(name)) and label in (None, match.group(2))]
+    return sorted(names, reverse=True)
+
+# Deletes all but the newest KEEP snapshots with label
+def rotate(label, directory=None):
+    directory = directory or BACKUP_DIR
+    for name in list_snapshots(directory, label)[KEEP.get(label, DEFAULT_KEEP):]:
+        os.remove(os.path.join(directory, name))
+
+# The path of the snapshot called name, or raises UnknownBackup. Only names of
+# existing snapshots are accepted, so nothing outside directory can be named.
+def path_of(name, directory=None):
+    directory = directory or BACKUP_DIR
+    if name not in list_snapshots(directory):
+        raise UnknownBackup(name)
+    return os.path.join(directory, name)
+
+# Runs snapshot on a worker thread, one snapshot at a time
+_lock = asyncio.Lock()
+
+async def take(label='scheduled'):
+    async with _lock:
+        return await asyncio.to_thread(snapshot, label)
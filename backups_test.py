@@ -0,0 +1,71 @@
+# Testing class for backups.py
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+import async_db
+import backups
+import db
+
+GUILD = '100'
+
+class TestBackups(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        # Backups copy from a database file, so this one isn't in memory
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = os.path.join(directory.name, 'backups')
+        path = os.path.join(directory.name, 'ranked_stats.db')
+        for patcher in (mock.patch.object(db, 'DB_PATH', path), mock.patch.object(backups, 'BACKUP_DIR', self.directory)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        db.use_database(path)
+        self.addCleanup(db.conn.close)
+        for discord_id in '123':
+            db.add_new_user(GUILD, discord_id, discord_id)
+        db.adjust_rr(GUILD, '3', 50)
+
+    def positions(self):
+        return db.conn.execute('SELECT discord_id, rr, leaderboard_position FROM users ORDER BY leaderboard_position').fetchall()
+
+    def test_snapshot_is_a_copy_of_the_database(self):
+        name = backups.snapshot()
+        self.assertRegex(name, backups.NAME)
+        self.assertEqual(os.listdir(self.directory), [name])
+        copy = sqlite3.connect(os.path.join(self.directory, name))
+        self.assertEqual(copy.execute('SELECT discord_id, rr, leaderboard_position FROM users ORDER BY leaderboard_position').fetchall(), self.positions())
+        self.assertEqual(copy.execute('PRAGMA integrity_check').fetchone(), ('ok',))
+        copy.close()
+
+    def test_rotation_is_per_label(self):
+        with mock.patch.dict(backups.KEEP, {'scheduled': 2}):
+            scheduled = [backups.snapshot() for _ in range(3)]
+            manual = backups.snapshot('manual')
+        self.assertEqual(backups.list_snapshots(), [manual, scheduled[2], scheduled[1]])
+        self.assertEqual(backups.list_snapshots(label='manual'), [manual])
+
+    def test_only_existing_backups_can_be_named(self):
+        name = backups.snapshot()
+        self.assertEqual(backups.path_of(name), os.path.join(self.directory, name))
+        for bad in ('../ranked_stats.db', name + '.partial', 'missing.db'):
+            with self.assertRaises(backups.UnknownBackup):
+                backups.path_of(bad)
+
+    async def test_admin_mutations_back_up_first_and_restore_undoes_them(self):
+        before = self.positions()
+        await async_db.ADMIN_ONLY_delete_user(GUILD, '3')
+        self.assertEqual([discord_id for discord_id, _, _ in self.positions()], ['1', '2'])
+        [name] = backups.list_snapshots(label='before-delete_user')
+        await async_db.restore_backup(name)
+        self.assertEqual(self.positions(), before)
+        # The database as it was just before the restore was backed up too
+        self.assertEqual(len(backups.list_snapshots(label='before-restore')), 1)
+        # In-memory state was rebuilt from the restored database
+        self.assertEqual(db.get_user(GUILD, '3').leaderboard_position, 1)
+        await async_db.adjust_rr(GUILD, '1', 60)
+        self.assertEqual([discord_id for discord_id, _, _ in self.positions()], ['1', '3', '2'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,206 @@
+# Benchmarks for the ranking hot paths.
+# Seeds a throwaway database with synthetic users and run histories, times the calls
+# the bot makes most, and prints p50/p99 latency and throughput for each as JSON.
+# Runs fully offline: no Discord token, no network, and the real database is never
+# touched.
+#
+# Usage: python bench.py [--sizes 1000,10000,100000] [--output results.json]
+#                        [--baseline results.json] [--tolerance 0.25]
+#
+# With --baseline, every benchmark is compared against a saved run and the script
+# exits with status 1 if any of them got slower than the tolerance allows.
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+import cache
+import db
+import leaderboard
+import replay
+import rr
+
+try:
+    import helper
+except ImportError:
+    # discord.py isn't installed; the daily job is timed without building its embeds
+    helper = None
+
+SIZES = [1000, 10000, 100000]
+ITERATIONS = 200
+HEAVY_ITERATIONS = 10  # For the calls that touch every user
+HISTORY_DAYS = 28
+LAST_DAY = '2025-06-30'  # Last day of the seeded history
+GUILD_ID = '1'  # Every synthetic user is in the one guild
+TOLERANCE = 0.25
+
+# Seeds the database with size users, each with a run history over the HISTORY_DAYS
+# days up to LAST_DAY. Some users run nearly every day and some hardly ever. Scores
+# are derived from the histories by the replay engine, so they are what the bot
+# itself would have given everyone.
+def seed(size, rng):
+    last = datetime.date.fromisoformat(LAST_DAY)
+    days = list(replay._days((last - datetime.timedelta(days=HISTORY_DAYS - 1)).isoformat(), LAST_DAY))
+    histories = {}
+    run_id = 0
+    for i in range(size):
+        discord_id = str(10**17 + i)
+        commitment = rng.betavariate(2, 3)
+        runs = []
+        for day in days:
+            if rng.random() < commitment:
+                run_id += 1
+                runs.append((run_id, day, round(max(0.3, rng.lognormvariate(0.3, 0.5)), 2)))
+        histories[discord_id] = runs
+    users, run_rrs = replay._replay_chunk({discord_id: runs for discord_id, runs in histories.items() if runs}, LAST_DAY)
+    scores = {discord_id: user for discord_id, *user in users}
+    run_scores = {run_id: (rr_before, rr_after) for run_id, rr_before, rr_after in run_rrs}
+    with db.transaction():
+        db.c.executemany('''
+            INSERT INTO users (guild_id, discord_id, username, longest_streak, last_logged, rr, runs_logged, total_distance)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [(GUILD_ID, discord_id, f'runner{i}', *_user_stats(scores.get(discord_id))) for i, discord_id in enumerate(histories)])
+        db.c.executemany('INSERT INTO runs (id, guild_id, discord_id, date, distance, rr_before, rr_after) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(run_id, GUILD_ID, discord_id, date, distance, *run_scores[run_id]) for discord_id, runs in histories.items() for run_id, date, distance in runs])
+    db.update_leaderboard_positions(GUILD_ID)
+    return list(histories)
+
+# (longest_streak, last_logged, rr, runs_logged, total_distance) for a user the
+# replay scored, or a fresh user's defaults if they never ran
+def _user_stats(score):
+    if score is None:
+        return 0, None, 0, 0, 0.0
+    new_rr, streak, runs_logged, total_distance, last_logged = score
+    return streak, last_logged, new_rr, runs_logged, total_distance
+
+# Calls call(arg) for each arg in args and returns the timing summary
+def measure(call, args):
+    timings = []
+    start = time.perf_counter()
+    for arg in args:
+        before = time.perf_counter()
+        call(arg)
+        timings.append(time.perf_counter() - before)
+    elapsed = time.perf_counter() - start
+    return summarize(timings, elapsed)
+
+def percentile(timings, fraction):
+    ordered = sorted(timings)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def summarize(timings, elapsed):
+    return {
+        'count': len(timings),
+        'p50_ms': round(percentile(timings, 0.50) * 1000, 4),
+        'p99_ms': round(percentile(timings, 0.99) * 1000, 4),
+        'ops_per_sec': round(len(timings) / elapsed, 2) if elapsed else None,
+    }
+
+# Seeds a database of size users in directory and runs every benchmark against it
+def run_size(size, directory, iterations, heavy_iterations, rng):
+    path = os.path.join(directory, f'bench_{size}.db')
+    db_path, db.DB_PATH = db.DB_PATH, path
+    db.use_database(path)
+    try:
+        discord_ids = seed(size, rng)
+        results = {}
+        everyone = db.get_leaderboard(GUILD_ID)
+        rrs = [user.rr for user in everyone]
+        positions = [user.leaderboard_position for user in everyone]
+        streaks = [user.longest_streak for user in everyone]
+        distances = [rng.uniform(0.5, 5.0) for _ in everyone]
+
+        # Reads
+        before = cache.users.stats()
+        results['get_user'] = measure(lambda discord_id: db.get_user(GUILD_ID, discord_id), rng.choices(discord_ids, k=iterations))
+        after = cache.users.stats()
+        results['get_user']['cache_hits'] = after['hits'] - before['hits']
+        results['get_user']['cache_misses'] = after['misses'] - before['misses']
+        results['get_leaderboard'] = measure(lambda _: db.get_leaderboard(GUILD_ID), range(heavy_iterations))
+        results['get_leaderboard_page'] = measure(lambda position: db.get_leaderboard_page(GUILD_ID, position, leaderboard.PAGE_SIZE),
+            [rng.randrange(1, size + 1) for _ in range(iterations)])
+
+        # RR calculators, per user and for the whole leaderboard at once
+        sample = rng.sample(everyone, min(iterations, size))
+        results['calculate_rr_logged'] = measure(lambda user: rr.calculate_rr_logged(user, 1.5), sample)
+        results['calculate_rr_no_log'] = measure(rr.calculate_rr_no_log, sample)
+        results['calculate_rr_logged_batch'] = measure(lambda _: rr.calculate_rr_logged_batch(rrs, positions, streaks, distances), range(heavy_iterations))
+        results['calculate_rr_no_log_batch'] = measure(lambda _: rr.calculate_rr_no_log_batch(rrs, positions), range(heavy_iterations))
+
+        # Writes. Everyone logs the day after the seeded history, once each.
+        next_day = datetime.date.fromisoformat(LAST_DAY) + datetime.timedelta(days=1)
+        loggers = rng.sample(discord_ids, min(iterations, size))
+        results['log_run'] = measure(lambda discord_id: db.log_run(GUILD_ID, discord_id, round(rng.uniform(0.5, 5.0), 2), next_day.isoformat()), loggers)
+        results['update_leaderboard_positions'] = measure(lambda _: db.update_leaderboard_positions(GUILD_ID), range(heavy_iterations))
+        decay_dates = [(next_day + datetime.timedelta(days=i)).isoformat() for i in range(heavy_iterations)]
+        if helper is not None:
+            results['daily_rr_message'] = measure(lambda date: helper.daily_rr_message(GUILD_ID, date), decay_dates)
+        else:
+            results['apply_daily_decay'] = measure(lambda date: db.apply_daily_decay(GUILD_ID, date), decay_dates)
+        return results
+    finally:
+        db.conn.close()
+        db.DB_PATH = db_path
+
+def run(sizes, iterations=ITERATIONS, heavy_iterations=HEAVY_ITERATIONS, seed_value=0):
+    rng = random.Random(seed_value)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            results[str(size)] = run_size(size, directory, iterations, heavy_iterations, rng)
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'iterations': iterations,
+            'heavy_iterations': heavy_iterations,
+            'seed': seed_value,
+        },
+        'results': results,
+    }
+
+# Compares results against a baseline from an earlier run. Returns a list of
+# (size, benchmark, reason) for every benchmark that got slower than tolerance
+# allows: p50 latency up, or throughput down, by more than that fraction.
+def compare(results, baseline, tolerance=TOLERANCE):
+    regressions = []
+    for size, benchmarks in results['results'].items():
+        for name, current in benchmarks.items():
+            previous = baseline['results'].get(size, {}).get(name)
+            if previous is None:
+                continue
+            if current['p50_ms'] > previous['p50_ms'] * (1 + tolerance):
+                regressions.append((size, name, f"p50 {previous['p50_ms']}ms -> {current['p50_ms']}ms"))
+            elif previous['ops_per_sec'] and current['ops_per_sec'] < previous['ops_per_sec'] * (1 - tolerance):
+                regressions.append((size, name, f"throughput {previous['ops_per_sec']}/s -> {current['ops_per_sec']}/s"))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the ranking hot paths against a synthetic database.")
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)), help="comma-separated user counts to seed (default: %(default)s)")
+    parser.add_argument('--iterations', type=int, default=ITERATIONS, help="calls per benchmark (default: %(default)s)")
+    parser.add_argument('--heavy-iterations', type=int, default=HEAVY_ITERATIONS, help="calls per benchmark that touches every user (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0, help="random seed for the synthetic data (default: %(default)s)")
+    parser.add_argument('--output', help="also write the results to this file")
+    parser.add_argument('--baseline', help="results file from an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help="allowed slowdown against the baseline, as a fraction (default: %(default)s)")
+    args = parser.parse_args()
+    results = run([int(size) for size in args.sizes.split(',')], args.iterations, args.heavy_iterations, args.seed)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for size, name, reason in regressions:
+            print(f"REGRESSION {name} @ {size} users: {reason}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,32 @@
+# Testing class for bench.py
+import unittest
+import bench
+import db
+
+class TestBench(unittest.TestCase):
+
+    def tearDown(self):
+        db.use_database(':memory:')
+
+    def test_run_reports_every_benchmark(self):
+        results = bench.run([50], iterations=5, heavy_iterations=2)
+        benchmarks = results['results']['50']
+        for name in ['get_user', 'get_leaderboard', 'calculate_rr_logged', 'calculate_rr_no_log_batch', 'log_run', 'update_leaderboard_positions']:
+            self.assertIn(name, benchmarks)
+            self.assertGreaterEqual(benchmarks[name]['p99_ms'], benchmarks[name]['p50_ms'])
+        self.assertEqual(benchmarks['log_run']['count'], 5)
+        self.assertEqual(benchmarks['get_leaderboard']['count'], 2)
+
+    def test_compare_flags_regressions(self):
+        baseline = {'results': {'10': {'log_run': {'p50_ms': 1.0, 'ops_per_sec': 1000}, 'get_user': {'p50_ms': 1.0, 'ops_per_sec': 1000}}}}
+        results = {'results': {'10': {'log_run': {'p50_ms': 1.2, 'ops_per_sec': 900}, 'get_user': {'p50_ms': 2.0, 'ops_per_sec': 500}, 'new': {'p50_ms': 9.0, 'ops_per_sec': 1}}}}
+        regressions = bench.compare(results, baseline, tolerance=0.25)
+        self.assertEqual([(size, name) for size, name, _ in regressions], [('10', 'get_user')])
+
+    def test_percentile(self):
+        timings = list(range(1, 101))
+        self.assertEqual(bench.percentile(timings, 0.50), 51)
+        self.assertEqual(bench.percentile(timings, 0.99), 100)
+
+if __name__ == '__main__':
+    unittest.main()
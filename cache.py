@@ -0,0 +1,115 @@
+# Bounded LRU cache of user records, keyed by (guild_id, discord_id).
+# db.get_user serves from here before going to the database, and every db.py mutator
+# writes its changes through to it once they commit, so hot users checking their
+# profile over and over don't cost a query each time.
+
+import threading
+from collections import OrderedDict
+
+USER_CACHE_SIZE = 2048
+
+class UserCache:
+    def __init__(self, capacity=USER_CACHE_SIZE):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # A user read from the database is only cached if no write committed while it
+        # was being read. generation moves on at the start and end of every commit,
+        # and nothing read in between is cached at all.
+        self.generation = 0
+        self.writing = False
+        # guild_id -> how many writes have gone through for the guild's users, for
+        # anything built from a guild's users (web.py's snapshots) to tell it's stale
+        self.versions = {}
+        self.clears = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def keys(self):
+        with self.lock:
+            return list(self.entries)
+
+    # Returns (user or None, generation to hand back to put)
+    def get(self, key):
+        with self.lock:
+            user = self.entries.get(key)
+            if user is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return user, self.generation
+
+    def put(self, key, generation, user):
+        with self.lock:
+            if generation == self.generation and not self.writing:
+                self._store(key, user)
+
+    def _store(self, key, user):
+        self.entries[key] = user
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    # Writer side. db.transaction() calls begin_write just before it commits and
+    # end_write once the write-through below has been applied.
+
+    def begin_write(self):
+        with self.lock:
+            self.generation += 1
+            self.writing = True
+
+    def end_write(self):
+        with self.lock:
+            self.generation += 1
+            self.writing = False
+
+    # Write-through for users whose row changed. users maps (guild_id, discord_id)
+    # to the user's new record, or to None to evict them. With evict_guild, everyone
+    # else in that guild is dropped as well.
+    def write(self, users, evict_guild=None):
+        with self.lock:
+            for guild_id in {guild_id for guild_id, _ in users} | ({evict_guild} if evict_guild is not None else set()):
+                self.versions[guild_id] = self.versions.get(guild_id, 0) + 1
+            if evict_guild is not None:
+                for key in [key for key in self.entries if key[0] == evict_guild and key not in users]:
+                    del self.entries[key]
+            for key, user in users.items():
+                if user is None:
+                    self.entries.pop(key, None)
+                else:
+                    self._store(key, user)
+
+    # Write-through for a block of a guild's leaderboard shifting up or down:
+    # everyone cached at positions first to last (or first onwards) moves by step.
+    # skip is the discord_id whose move caused the shift, who gets written separately.
+    def shift_positions(self, guild_id, first, last, step, skip=None):
+        with self.lock:
+            self.versions[guild_id] = self.versions.get(guild_id, 0) + 1
+            for key, user in list(self.entries.items()):
+                position = user.leaderboard_position
+                if key[0] == guild_id and key[1] != skip and position is not None and position >= first and (last is None or position <= last):
+                    self.entries[key] = user.replace(leaderboard_position=position + step)
+
+    # The write version of a guild's users (see versions). Both counts only go up, so
+    # neither a write nor a clear() can leave it where it was.
+    def version(self, guild_id):
+        return self.versions.get(guild_id, 0) + self.clears
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            # Everything built from the cache's users is stale too
+            self.clears += 1
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'capacity': self.capacity}
+
+users = UserCache()
@@ -1,107 +1,909 @@
+import datetime
+import itertools
+import os
 import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+import cache
+import leaderboard
+import metrics
+import migrations
 import rr as rrsystem
+import timezones
+from records import user_factory
 
 # Database class to handle keeping track of user stats.
 
-conn = sqlite3.connect('ranked_stats.db')
-c = conn.cursor()
+DB_PATH = os.getenv("RANKED_STATS_DB", "ranked_stats.db")
 
-# Setup the database tables
-def setup():
+# Connection tuning. WAL lets readers keep reading while a write is in progress,
+# and with WAL, synchronous=NORMAL only syncs at checkpoints rather than on every
+# commit (a commit can be lost to a power cut, but the database can't be corrupted).
+CACHE_SIZE_KB = 20000
+MMAP_SIZE = 256 * 1024 * 1024
+
+# Connections time every statement they run (see metrics.py).
+def connect(path, read_only=False):
+    if read_only:
+        connection = sqlite3.connect(Path(path).resolve().as_uri() + '?mode=ro', uri=True, check_same_thread=False, factory=metrics.TimedConnection)
+    else:
+        # Transactions are managed explicitly by transaction() below
+        connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, factory=metrics.TimedConnection)
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.execute('PRAGMA synchronous = NORMAL')
+    connection.execute('PRAGMA busy_timeout = 5000')
+    connection.execute(f'PRAGMA cache_size = -{CACHE_SIZE_KB}')
+    connection.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+    connection.execute('PRAGMA temp_store = MEMORY')
+    return connection
+
+# conn is the writer connection. The bot drives it from the async_db writer
+# thread, so it can't be pinned to the thread that imported this module. It's opened
+# by setup() (or use_database) rather than on import, so just importing this module,
+# as the tests and replay's worker processes do, never touches DB_PATH.
+conn = None
+c = None
+
+# Reader threads (see async_db) each open their own read-only connection.
+# Accessors use it when there is one and fall back to conn everywhere else.
+_local = threading.local()
+
+def open_reader():
+    _local.conn = connect(DB_PATH, read_only=True)
+
+def _reader():
+    return getattr(_local, 'conn', conn)
+
+# Runs a query against the users table on connection and returns a cursor that
+# yields User records (see records.py). Uses its own cursor so the row factory
+# doesn't leak onto c.
+def _select_users(connection, sql, parameters=()):
+    cursor = connection.cursor()
+    cursor.row_factory = user_factory
+    return cursor.execute(sql, parameters)
+
+# Checkpoints the write-ahead log into the database file and syncs it to disk.
+# Called on shutdown so nothing committed is left sitting only in the WAL.
+def checkpoint():
+    if c is not None:
+        c.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+# Replaces the whole database with a copy of the database file at path (see
+# backups.py), then forgets everything cached from the old one and brings the copy's
+# schema up to date. SQLite can't restore into a connection that's in a transaction,
+# so this has to run on the writer between transactions.
+def restore(path):
+    source = sqlite3.connect(Path(path).resolve().as_uri() + '?mode=ro', uri=True)
+    try:
+        source.backup(conn)
+    finally:
+        source.close()
+    _forget_cached_state()
+    setup()
+
+# Points the writer connection at a different database (a path, or ':memory:'), for
+# the tests and benchmarks, and forgets everything kept in memory about the old one,
+# down to who held each guild's Usain Bolt title.
+def use_database(path):
+    global conn, c
+    if conn is not None:
+        conn.close()
+    conn = connect(path)
+    c = conn.cursor()
+    _forget_cached_state()
+    leaderboard.guild_pages.clear()
+    leaderboard.forget_all_summaries()
+    setup()
+
+def _forget_cached_state():
+    _leaderboards.clear()
+    _touched_indexes.clear()
+    for guild_id in list(leaderboard.rank_summaries):
+        leaderboard.forget_summary(guild_id)
+    for page_cache in list(leaderboard.guild_pages.values()):
+        page_cache.invalidate_all()
+    cache.users.clear()
+
+class NotSignedUp(Exception):
+    pass
+
+class AlreadyLoggedToday(Exception):
+    pass
+
+# Groups the statements inside it into one transaction on the writer connection:
+# committed together on success, rolled back together if anything raises.
+# Transactions nest: an inner one becomes a savepoint, so async_db can wrap a whole
+# group of writes in one commit and still roll back just the one that failed.
+_transaction_depth = 0
+_after_commit = []
+
+@contextmanager
+def transaction():
+    global _transaction_depth
+    savepoint = f'sp{_transaction_depth}'
+    pending = len(_after_commit)
+    touched = len(_touched_indexes)
+    c.execute('BEGIN IMMEDIATE' if _transaction_depth == 0 else f'SAVEPOINT {savepoint}')
+    _transaction_depth += 1
+    try:
+        yield c
+    except BaseException:
+        _transaction_depth -= 1
+        if _transaction_depth == 0:
+            c.execute('ROLLBACK')
+        else:
+            c.execute(f'ROLLBACK TO {savepoint}')
+            c.execute(f'RELEASE {savepoint}')
+        # The leaderboard indexes this scope used may hold changes that were just
+        # rolled back. Writes that fail before using one (like a rejected log_run)
+        # leave every index as it was.
+        for guild_id in _touched_indexes[touched:]:
+            _leaderboards.pop(guild_id, None)
+        del _after_commit[pending:]
+        if _transaction_depth == 0:
+            _touched_indexes.clear()
+        raise
+    _transaction_depth -= 1
+    if _transaction_depth == 0:
+        callbacks = _after_commit[:]
+        _after_commit.clear()
+        cache.users.begin_write()
+        try:
+            try:
+                c.execute('COMMIT')
+            except BaseException:
+                # A failed COMMIT (e.g. SQLITE_BUSY or a deferred constraint) can leave
+                # the transaction open; none of it was written, so roll it back and
+                # drop the indexes that hold its changes
+                if conn.in_transaction:
+                    c.execute('ROLLBACK')
+                for guild_id in _touched_indexes:
+                    _leaderboards.pop(guild_id, None)
+                _touched_indexes.clear()
+                raise
+            for callback in callbacks:
+                callback()
+            _publish_rank_summaries()
+        finally:
+            cache.users.end_write()
+    else:
+        c.execute(f'RELEASE {savepoint}')
+
+# Runs callback once the current transaction has committed (straight away if there
+# isn't one), or never if it rolls back. Caches use this so they're only invalidated
+# once readers can actually see the new data.
+def after_commit(callback):
+    if _transaction_depth == 0:
+        callback()
+    else:
+        _after_commit.append(callback)
+
+# Reads the given users of a guild inside the current transaction and writes them
+# through to cache.users once it commits. Only users already cached are re-read; the
+# rest are just evicted in case a reader cached them while the transaction was open.
+# discord_ids=None means every user in the guild may have changed.
+def _write_through(guild_id, discord_ids=None):
+    if discord_ids is None:
+        cached = [discord_id for key_guild_id, discord_id in cache.users.keys() if key_guild_id == guild_id]
+    else:
+        cached = [discord_id for discord_id in discord_ids if (guild_id, discord_id) in cache.users]
+    fresh = {(guild_id, discord_id): None for discord_id in discord_ids or ()}
+    for i in range(0, len(cached), 500):
+        chunk = cached[i:i + 500]
+        users = _select_users(conn, f"SELECT * FROM users WHERE guild_id = ? AND discord_id IN ({', '.join('?' * len(chunk))})", (guild_id, *chunk))
+        fresh.update(((guild_id, user.discord_id), user) for user in users)
+    after_commit(lambda: cache.users.write(fresh, evict_guild=guild_id if discord_ids is None else None))
+
+# Ordering of each guild's users by RR, kept in step with the leaderboard_position
+# column so a single RR change only has to shift the rows between the old and new
+# position. Only ever touched by the writer; each guild's is built lazily from the
+# users table, at which point any position that doesn't match it gets rewritten.
+_leaderboards = {}
+
+# Guilds whose index the current transaction has used, in the order they were used,
+# so a rolled back savepoint knows which ones it may have changed. Their rank summaries
+# (see leaderboard.RankSummary) are republished from the index once it commits, or
+# forgotten if the index has been dropped, to be rebuilt when next asked for.
+_touched_indexes = []
+
+def _publish_rank_summaries():
+    for guild_id in dict.fromkeys(_touched_indexes):
+        index = _leaderboards.get(guild_id)
+        if index is None:
+            leaderboard.forget_summary(guild_id)
+        else:
+            leaderboard.publish_summary(guild_id, index.summary())
+    _touched_indexes.clear()
+
+# Drops a guild's index, to be rebuilt from the users table when it's next needed
+def _forget_index(guild_id):
+    _leaderboards.pop(guild_id, None)
+    _touched_indexes.append(guild_id)
+
+def _leaderboard_index(guild_id):
+    _touched_indexes.append(guild_id)
+    index = _leaderboards.get(guild_id)
+    if index is None:
+        c.execute('SELECT discord_id, id, rr, leaderboard_position FROM users WHERE guild_id = ? ORDER BY rr DESC, id', (guild_id,))
+        users = c.fetchall()
+        index = _leaderboards[guild_id] = leaderboard.LeaderboardIndex((discord_id, user_id, rr) for discord_id, user_id, rr, _ in users)
+        current = {discord_id: position for discord_id, _, _, position in users}
+        changed = [(position, guild_id, discord_id) for position, discord_id in enumerate(index, start=1) if current[discord_id] != position]
+        c.executemany('UPDATE users SET leaderboard_position = ? WHERE guild_id = ? AND discord_id = ?', changed)
+        if changed:
+            positions = [position for position, _, _ in changed]
+            after_commit(lambda: leaderboard.pages(guild_id).invalidate_positions(positions))
+            _write_through(guild_id, [discord_id for _, _, discord_id in changed])
+    return index
+
+# Mirrors a move in a guild's leaderboard index to the users table in one statement:
+# the user takes their new position and everyone in between shifts by one.
+def _move_position(guild_id, discord_id, old_position, new_position):
+    first, last = min(old_position, new_position), max(old_position, new_position)
+    after_commit(lambda: leaderboard.pages(guild_id).invalidate(first, last))
+    if old_position == new_position:
+        return
+    step = 1 if new_position < old_position else -1
+    after_commit(lambda: cache.users.shift_positions(guild_id, first, last, step, skip=discord_id))
     c.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY,
-            discord_id TEXT UNIQUE,
-            username TEXT,
-            longest_streak REAL DEFAULT 0,
-            last_logged DATE,
-            rr INTEGER DEFAULT 0,
-            leaderboard_position INTEGER,
-            runs_logged INTEGER DEFAULT 0,
-            total_distance DOUBLE DEFAULT 0.0
-        )
-    ''')
-    conn.commit()
+        UPDATE users
+        SET leaderboard_position = CASE WHEN discord_id = ? THEN ? ELSE leaderboard_position + ? END
+        WHERE guild_id = ? AND leaderboard_position BETWEEN ? AND ?
+    ''', (discord_id, new_position, step, guild_id, first, last))
+
+def _set_rr(guild_id, discord_id, rr):
+    c.execute('UPDATE users SET rr = ? WHERE guild_id = ? AND discord_id = ?', (rr, guild_id, discord_id))
+    index = _leaderboard_index(guild_id)
+    if c.rowcount and discord_id in index:
+        _move_position(guild_id, discord_id, *index.move(discord_id, rr))
+    _write_through(guild_id, [discord_id])
+
+# Opens the writer connection to DB_PATH if it isn't open yet and brings the schema
+# up to date (see migrations.py). Run once at startup, before anything else.
+def setup():
+    global conn, c
+    if conn is None:
+        conn = connect(DB_PATH)
+        c = conn.cursor()
+    with transaction():
+        migrations.migrate(c)
 
 # Accessors
+# Every guild has its own leaderboard, so everything here is scoped to one guild_id
+# (the guild's Discord ID, as a string like discord_id).
 
-def get_last_position() -> int:
+def get_last_position(guild_id) -> int:
     # Get the highest leaderboard position currently in use
-    c.execute('SELECT MAX(leaderboard_position) FROM users')
-    result = c.fetchone()
+    result = _reader().execute('SELECT MAX(leaderboard_position) FROM users WHERE guild_id = ?', (guild_id,)).fetchone()
     return result[0] if result[0] is not None else 0
 
-def get_user(discord_id):
-    c.execute('SELECT * FROM users WHERE discord_id = ?', (discord_id,))
-    return c.fetchone()
+# Served from cache.users when possible. Mutators must not use this to read a user
+# they're about to change, since it only sees committed data; they read through c.
+def get_user(guild_id, discord_id):
+    user, generation = cache.users.get((guild_id, discord_id))
+    if user is None:
+        user = load_user(guild_id, discord_id, generation)
+    return user
+
+# Reads a user from the database, bypassing cache.users, and caches them if the
+# cache is still at generation (from cache.users.get)
+def load_user(guild_id, discord_id, generation):
+    user = _select_users(_reader(), 'SELECT * FROM users WHERE guild_id = ? AND discord_id = ?', (guild_id, discord_id)).fetchone()
+    if user is not None:
+        cache.users.put((guild_id, discord_id), generation, user)
+    return user
+
+def get_leaderboard(guild_id):
+    return _select_users(_reader(), 'SELECT * FROM users WHERE guild_id = ? ORDER BY leaderboard_position ASC', (guild_id,)).fetchall()
+
+# Returns (leaderboard_position, username, rr) for up to limit users, starting at
+# first_position
+def get_leaderboard_page(guild_id, first_position, limit):
+    return _reader().execute('''
+        SELECT leaderboard_position, username, rr FROM users
+        WHERE guild_id = ? AND leaderboard_position >= ?
+        ORDER BY leaderboard_position
+        LIMIT ?
+    ''', (guild_id, first_position, limit)).fetchall()
+
+# Selects columns for everyone in a guild with first_offset <= tz_offset < end_offset
+# who has no run on date. Takes (guild_id, date, first_offset, end_offset) as named
+# parameters. The run is looked up in runs (through its unique index) rather than
+# going by users.last_logged, since a runner may already have logged the next day by
+# the time date's decay runs: hourly ticks reach half-hour timezones like India's
+# 30 minutes after their midnight.
+def _didnt_log(columns):
+    return f'''
+        SELECT {columns} FROM users
+        WHERE guild_id = :guild_id AND tz_offset >= :first_offset AND tz_offset < :end_offset
+        AND NOT EXISTS (SELECT 1 FROM runs WHERE runs.guild_id = users.guild_id AND runs.discord_id = users.discord_id AND runs.date = :date)
+    '''
+
+# The offsets take in every timezone unless given, here and below
+ALL_OFFSETS = (timezones.MIN_OFFSET, timezones.MAX_OFFSET + 1)
+
+def get_users_who_didnt_log_today(guild_id, date, first_offset=ALL_OFFSETS[0], end_offset=ALL_OFFSETS[1]):
+    return _select_users(_reader(), _didnt_log('*'), {'guild_id': guild_id, 'date': date, 'first_offset': first_offset, 'end_offset': end_offset}).fetchall()
+
+# How many users a guild has with first_offset <= tz_offset < end_offset
+def count_users(guild_id, first_offset=ALL_OFFSETS[0], end_offset=ALL_OFFSETS[1]):
+    return _reader().execute('SELECT COUNT(*) FROM users WHERE guild_id = ? AND tz_offset >= ? AND tz_offset < ?', (guild_id, first_offset, end_offset)).fetchone()[0]
+
+# Run history. Both of these stream rows straight off the cursor, so a year of
+# history never has to sit in memory at once. start and end are inclusive
+# YYYY-MM-DD dates; leave either out for an open-ended range.
+
+# Yields (date, distance, rr_before, rr_after) for one user's runs, oldest first
+def iter_user_runs(guild_id, discord_id, start=None, end=None):
+    yield from _reader().execute('''
+        SELECT date, distance, rr_before, rr_after FROM runs
+        WHERE guild_id = ? AND discord_id = ? AND date BETWEEN ? AND ?
+        ORDER BY date
+    ''', (guild_id, discord_id, start or '0000-00-00', end or '9999-99-99'))
+
+# Yields (id, discord_id, date, distance) for every run ever logged in a guild, oldest first
+def iter_run_history(guild_id):
+    yield from _reader().execute('SELECT id, discord_id, date, distance FROM runs WHERE guild_id = ? ORDER BY date, id', (guild_id,))
 
-def get_leaderboard():
-    c.execute('SELECT * FROM users ORDER BY leaderboard_position ASC')
-    return c.fetchall()
+# Yields (date, discord_id, distance) for everyone's runs in a guild, oldest first
+def iter_runs(guild_id, start=None, end=None):
+    yield from _reader().execute('''
+        SELECT date, discord_id, distance FROM runs
+        WHERE guild_id = ? AND date BETWEEN ? AND ?
+        ORDER BY date
+    ''', (guild_id, start or '0000-00-00', end or '9999-99-99'))
 
-def get_users_who_didnt_log_today(date):
-    c.execute('SELECT * FROM users WHERE last_logged != ? OR last_logged IS NULL', (date,))
-    return c.fetchall()
+# Yields every user in a guild as a User record, in leaderboard order
+def iter_users(guild_id):
+    yield from _select_users(_reader(), 'SELECT * FROM users WHERE guild_id = ? ORDER BY leaderboard_position', (guild_id,))
+
+# Guilds
+
+# Returns (guild_id, announcement_channel_id or None, runners) for every guild that
+# has runners or settings, smallest first
+def get_guilds():
+    return _reader().execute('''
+        SELECT known.guild_id, guilds.announcement_channel_id, (SELECT COUNT(*) FROM users WHERE users.guild_id = known.guild_id) AS runners
+        FROM (SELECT guild_id FROM guilds UNION SELECT DISTINCT guild_id FROM users) AS known
+        LEFT JOIN guilds ON guilds.guild_id = known.guild_id
+        WHERE known.guild_id != ?
+        ORDER BY runners, known.guild_id
+    ''', (migrations.LEGACY_GUILD_ID,)).fetchall()
+
+def get_announcement_channel(guild_id):
+    row = _reader().execute('SELECT announcement_channel_id FROM guilds WHERE guild_id = ?', (guild_id,)).fetchone()
+    return row[0] if row else None
+
+# Seasons, from the archive written by reset_season
+
+# Returns (season, ended, rr, leaderboard_position) for each season a user finished in
+# a guild, latest first
+def get_user_seasons(guild_id, discord_id):
+    return _reader().execute('''
+        SELECT season, ended, rr, leaderboard_position FROM seasons
+        WHERE guild_id = ? AND discord_id = ?
+        ORDER BY season DESC
+    ''', (guild_id, discord_id)).fetchall()
+
+# Returns (season, ended, discord_id, username, rr) for the winner of each of a guild's
+# seasons, latest first
+def get_season_winners(guild_id, limit=None):
+    return _reader().execute('''
+        SELECT season, ended, discord_id, username, rr FROM seasons
+        WHERE guild_id = ? AND leaderboard_position = 1
+        ORDER BY season DESC
+        LIMIT ?
+    ''', (guild_id, -1 if limit is None else limit)).fetchall()
+
+# Returns (leaderboard_position, discord_id, username, rr) for the top limit finishers
+# of one of a guild's seasons
+def get_season_standings(guild_id, season, limit):
+    return _reader().execute('''
+        SELECT leaderboard_position, discord_id, username, rr FROM seasons
+        WHERE guild_id = ? AND season = ?
+        ORDER BY leaderboard_position
+        LIMIT ?
+    ''', (guild_id, season, limit)).fetchall()
+
+# Job ledger
+# Scheduled jobs record what they've finished in job_runs, one row per guild and
+# run_at: the hourly tick (an ISO datetime in UTC) for the decay and the day the
+# season ended (YYYY-MM-DD) for season resets. After a restart, the last row says
+# how much was missed (see main.py), and recording a run_at that's already there
+# does nothing, so a job can tell it has already run.
+DECAY_JOB = 'daily_decay'
+SEASON_JOB = 'season_reset'
+
+def get_last_job_run(job, guild_id):
+    return _reader().execute('SELECT MAX(run_at) FROM job_runs WHERE job = ? AND guild_id = ?', (job, guild_id)).fetchone()[0]
+
+# Rollups
+# Each runner's distance, run count and longest run per ISO week and calendar month
+# (see migrations.add_run_rollups), so period stats are a lookup rather than a scan
+# of the run history. A period is named by the date of its first day.
+PERIODS = ('week', 'month')
+
+# The first day (YYYY-MM-DD) of the period containing date: the Monday of its ISO
+# week, or the 1st of its month
+def period_start(period, date):
+    day = datetime.date.fromisoformat(date)
+    if period == 'week':
+        return (day - datetime.timedelta(days=day.weekday())).isoformat()
+    return day.replace(day=1).isoformat()
+
+# Returns (distance, runs, best) for a user's runs in the period containing date, or
+# None if they haven't run in it
+def get_rollup(guild_id, discord_id, period, date):
+    return _reader().execute('''
+        SELECT distance, runs, best FROM run_rollups
+        WHERE guild_id = ? AND period = ? AND period_start = ? AND discord_id = ?
+    ''', (guild_id, period, period_start(period, date), discord_id)).fetchone()
+
+# A user's longest run ever, or None if they've never run. Read from the monthly
+# rollups, so it costs one row per month they've run in.
+def get_personal_best(guild_id, discord_id):
+    return _reader().execute('''
+        SELECT MAX(best) FROM run_rollups
+        WHERE guild_id = ? AND period = 'month' AND discord_id = ?
+    ''', (guild_id, discord_id)).fetchone()[0]
+
+# Returns (discord_id, username, distance, runs, best) for the limit runners in a guild
+# who've run furthest in the period containing date, furthest first
+def get_period_leaderboard(guild_id, period, date, limit):
+    return _reader().execute('''
+        SELECT run_rollups.discord_id, users.username, distance, runs, best FROM run_rollups
+        LEFT JOIN users ON users.guild_id = run_rollups.guild_id AND users.discord_id = run_rollups.discord_id
+        WHERE run_rollups.guild_id = ? AND period = ? AND period_start = ?
+        ORDER BY distance DESC
+        LIMIT ?
+    ''', (guild_id, period, period_start(period, date), limit)).fetchall()
 
 # Mutators
 
-def add_new_user(discord_id, username, position: int):
-    c.execute('INSERT OR IGNORE INTO users (discord_id, username, leaderboard_position) VALUES (?, ?, ?)', (discord_id, username, position))
-    conn.commit()
+# Adds one run to its runner's rollups
+def _add_to_rollups(guild_id, discord_id, date, distance):
+    c.executemany('''
+        INSERT INTO run_rollups (guild_id, period, period_start, discord_id, distance, runs, best) VALUES (?, ?, ?, ?, ?, 1, ?)
+        ON CONFLICT (guild_id, period, period_start, discord_id) DO UPDATE
+        SET distance = distance + excluded.distance, runs = runs + 1, best = MAX(best, excluded.best)
+    ''', [(guild_id, period, period_start(period, date), discord_id, distance, distance) for period in PERIODS])
+
+# Rebuilds a guild's rollups from its run history, for writes that add or move runs
+# in bulk
+def _rebuild_rollups(guild_id):
+    c.execute('DELETE FROM run_rollups WHERE guild_id = ?', (guild_id,))
+    c.execute('''
+        INSERT INTO run_rollups (guild_id, period, period_start, discord_id, distance, runs, best)
+        SELECT guild_id, 'week', date(date, 'weekday 0', '-6 days'), discord_id, SUM(distance), COUNT(*), MAX(distance) FROM runs WHERE guild_id = :guild_id GROUP BY 3, 4
+        UNION ALL
+        SELECT guild_id, 'month', strftime('%Y-%m-01', date), discord_id, SUM(distance), COUNT(*), MAX(distance) FROM runs WHERE guild_id = :guild_id GROUP BY 3, 4
+    ''', {'guild_id': guild_id})
+
+# Records that job finished run_at for a guild, and forgets its runs from before
+# prune_before if given. Returns False if it had already been recorded.
+def record_job_run(job, guild_id, run_at, prune_before=None):
+    with transaction():
+        c.execute('INSERT OR IGNORE INTO job_runs (job, guild_id, run_at) VALUES (?, ?, ?)', (job, guild_id, run_at))
+        recorded = c.rowcount == 1
+        if prune_before is not None:
+            c.execute('DELETE FROM job_runs WHERE job = ? AND guild_id = ? AND run_at < ?', (job, guild_id, prune_before))
+    return recorded
+
+def set_announcement_channel(guild_id, channel_id):
+    with transaction():
+        c.execute('''
+            INSERT INTO guilds (guild_id, announcement_channel_id) VALUES (?, ?)
+            ON CONFLICT (guild_id) DO UPDATE SET announcement_channel_id = excluded.announcement_channel_id
+        ''', (guild_id, channel_id))
+
+# Moves everyone from before multi-guild support into guild_id, the guild that owns
+# the old announcement channel, and makes that channel the guild's announcement
+# channel unless it already has one. Anyone who has signed up to guild_id since
+# keeps their new row. Returns how many users were claimed.
+def claim_legacy_guild(guild_id, channel_id):
+    with transaction():
+        c.execute('UPDATE OR IGNORE users SET guild_id = ? WHERE guild_id = ?', (guild_id, migrations.LEGACY_GUILD_ID))
+        claimed = c.rowcount
+        # Runs go with the users who were claimed, i.e. everyone no longer left behind
+        c.execute('''
+            UPDATE runs SET guild_id = ?
+            WHERE guild_id = ? AND discord_id NOT IN (SELECT discord_id FROM users WHERE guild_id = ?)
+        ''', (guild_id, migrations.LEGACY_GUILD_ID, migrations.LEGACY_GUILD_ID))
+        if c.rowcount:
+            _rebuild_rollups(guild_id)
+            _rebuild_rollups(migrations.LEGACY_GUILD_ID)
+        c.execute('INSERT OR IGNORE INTO guilds (guild_id, announcement_channel_id) VALUES (?, ?)', (guild_id, channel_id))
+        if claimed:
+            _forget_index(guild_id)
+            _forget_index(migrations.LEGACY_GUILD_ID)
+            _leaderboard_index(guild_id)
+            after_commit(leaderboard.pages(guild_id).invalidate_all)
+            _write_through(guild_id)
+    return claimed
 
-def log_run(discord_id, distance, date):
-    user = get_user(discord_id)
-    if user:
+def add_new_user(guild_id, discord_id, username):
+    # New users start on 0 RR and lose ties to everyone who signed up before them,
+    # so they always go in last place.
+    with transaction():
+        index = _leaderboard_index(guild_id)
+        position = len(index) + 1
+        c.execute('''
+            INSERT OR IGNORE INTO users (guild_id, discord_id, username, leaderboard_position, timezone, tz_offset)
+            SELECT ?, ?, ?, ?, name, tz_offset FROM timezones WHERE name = ?
+        ''', (guild_id, discord_id, username, position, timezones.DEFAULT_TIMEZONE))
+        if c.rowcount:
+            index.add(discord_id, c.lastrowid, 0)
+            pages = leaderboard.pages(guild_id)
+            after_commit(lambda: pages.invalidate(position, position))
+            after_commit(pages.invalidate_count)
+            _write_through(guild_id, [discord_id])
+
+# Logs a run in a single read and a single transaction, and returns the updated user.
+# date defaults to today in the user's own timezone.
+# Raises NotSignedUp or AlreadyLoggedToday instead of writing anything. The runs
+# table's unique index backs up the last_logged check, so even a write that raced
+# past it can't log a second run for the same day.
+def log_run(guild_id, discord_id, distance, date=None):
+    with transaction():
+        user = _select_users(conn, 'SELECT * FROM users WHERE guild_id = ? AND discord_id = ?', (guild_id, discord_id)).fetchone()
+        if user is None:
+            raise NotSignedUp(discord_id)
+        if date is None:
+            date = timezones.local_date(user.timezone, timezones.now())
+        if user.last_logged == date:
+            raise AlreadyLoggedToday(discord_id)
         new_rr = rrsystem.calculate_rr_logged(user, distance)
-        update_user(user[1], longest_streak=user[3] + 1, last_logged=date, rr=new_rr, runs_logged=user[7] + 1, total_distance=user[8] + distance)
+        try:
+            c.execute('INSERT INTO runs (guild_id, discord_id, date, distance, rr_before, rr_after) VALUES (?, ?, ?, ?, ?, ?)', (guild_id, discord_id, date, distance, user.rr, new_rr))
+        except sqlite3.IntegrityError:
+            raise AlreadyLoggedToday(discord_id) from None
+        _add_to_rollups(guild_id, discord_id, date, distance)
+        c.execute('''
+            UPDATE users
+            SET longest_streak = longest_streak + 1, last_logged = ?, rr = ?, runs_logged = runs_logged + 1, total_distance = total_distance + ?
+            WHERE guild_id = ? AND discord_id = ?
+        ''', (date, new_rr, distance, guild_id, discord_id))
+        old_position, new_position = _leaderboard_index(guild_id).move(discord_id, new_rr)
+        _move_position(guild_id, discord_id, old_position, new_position)
+        user = user.replace(longest_streak=user.longest_streak + 1, last_logged=date, rr=new_rr, leaderboard_position=new_position, runs_logged=user.runs_logged + 1, total_distance=user.total_distance + distance)
+        after_commit(lambda: cache.users.write({(guild_id, discord_id): user}))
+    return user
+
+# Applies the end-of-day RR loss to everyone in a guild who didn't log a run on
+# date, as one transaction, and returns (user, old_rr, new_rr, old_rank, new_rank)
+# for each of them. Only users with first_offset <= tz_offset < end_offset are
+# decayed, i.e. the ones whose day was date (see timezones.midnight_buckets). user is
+# as it was before the decay, and only has discord_id, username, rr and
+# leaderboard_position.
+# Users who have already lost RR for date (last_decayed) are skipped, so running the
+# decay for the same day twice, by hand or by catch_up_decay, only applies it once.
+def apply_daily_decay(guild_id, date, first_offset=ALL_OFFSETS[0], end_offset=ALL_OFFSETS[1]):
+    parameters = {'guild_id': guild_id, 'date': date, 'first_offset': first_offset, 'end_offset': end_offset}
+    with transaction():
+        users = _select_users(conn, _didnt_log('discord_id, username, rr, leaderboard_position, last_decayed'), parameters).fetchall()
+        users = [user for user in users if user.last_decayed is None or user.last_decayed < date]
+        decayed, _ = rrsystem.calculate_rr_no_log_batch([user.rr for user in users], [user.leaderboard_position for user in users])
+        new_rrs = {user.discord_id: rr for user, rr in zip(users, decayed)}
+        c.execute(f'''
+            UPDATE users SET last_decayed = :date
+            WHERE guild_id = :guild_id AND (last_decayed IS NULL OR last_decayed < :date) AND id IN ({_didnt_log('id')})
+        ''', parameters)
+        moved = _apply_decayed_rrs(guild_id, users, new_rrs, [user.discord_id for user in users])
+    diffs = []
+    for user in users:
+        new_rr = new_rrs[user.discord_id]
+        new_position = moved[user.discord_id][1] if user.discord_id in moved else user.leaderboard_position
+        diffs.append((user, user.rr, new_rr, rrsystem.get_rank(user.rr, user.leaderboard_position), rrsystem.get_rank(new_rr, new_position)))
+    return diffs
+
+# Writes decayed RRs (discord_id -> rr) for users and moves them on the leaderboard.
+# touched are the discord_ids whose last_decayed changed too, for the user cache.
+# Returns {discord_id: (old position, new position)} for everyone who moved.
+def _apply_decayed_rrs(guild_id, users, new_rrs, touched):
+    changed = {user.discord_id: new_rrs[user.discord_id] for user in users if new_rrs[user.discord_id] != user.rr}
+    c.executemany('UPDATE users SET rr = ? WHERE guild_id = ? AND discord_id = ?', [(rr, guild_id, discord_id) for discord_id, rr in changed.items()])
+    index = _leaderboard_index(guild_id)
+    moved = index.move_many(changed)
+    c.executemany('UPDATE users SET leaderboard_position = ? WHERE guild_id = ? AND discord_id = ?', [(new_position, guild_id, discord_id) for discord_id, (_, new_position) in moved.items()])
+    positions = [index.position(discord_id) for discord_id in changed] + [position for moves in moved.values() for position in moves]
+    after_commit(lambda: leaderboard.pages(guild_id).invalidate_positions(positions))
+    _write_through(guild_id, set(touched) | set(moved))
+    return moved
+
+# The dates (YYYY-MM-DD) from first up to but not including end
+def _dates(first, end):
+    return [(first + datetime.timedelta(days=i)).isoformat() for i in range((end - first).days)]
+
+# Applies every day that ended in a guild between the hourly ticks since and at (aware
+# datetimes, since exclusive) in one pass, for when the bot was down and missed the
+# ticks in between. Each user loses RR once for each of those days that ended in
+# their timezone, other than the ones they logged a run on and any they've already
+# lost RR for. The days are applied one after another in memory and each user
+# is written once; ranks are worked out against the positions from before the first
+# day. Returns (user, old_rr, new_rr, old_rank, new_rank, days) for each user who
+# missed at least one day, where user only has discord_id, username, rr and
+# leaderboard_position.
+def catch_up_decay(guild_id, since, at):
+    with transaction():
+        users = _select_users(conn, 'SELECT discord_id, username, rr, leaderboard_position, last_decayed, tz_offset FROM users WHERE guild_id = ?', (guild_id,)).fetchall()
+        # Every run on a day that could have ended in someone's timezone in between
+        start = (since + datetime.timedelta(minutes=timezones.MIN_OFFSET)).date().isoformat()
+        logged = set(c.execute('SELECT discord_id, date FROM runs WHERE guild_id = ? AND date >= ?', (guild_id, start)).fetchall())
+        missed_users, missed_days, decayed_through = [], [], []
+        for user in users:
+            offset = datetime.timedelta(minutes=user.tz_offset)
+            # The days ending in the user's timezone are first up to (but not including) end
+            first, end = (since + offset).date(), (at + offset).date()
+            if user.last_decayed is not None:
+                first = max(first, datetime.date.fromisoformat(user.last_decayed) + datetime.timedelta(days=1))
+            if first >= end:
+                continue
+            days = sum((user.discord_id, day) not in logged for day in _dates(first, end))
+            decayed_through.append(((end - datetime.timedelta(days=1)).isoformat(), guild_id, user.discord_id))
+            if days:
+                missed_users.append(user)
+                missed_days.append(days)
+        c.executemany('UPDATE users SET last_decayed = ? WHERE guild_id = ? AND discord_id = ?', decayed_through)
+        rrs = [user.rr for user in missed_users]
+        positions = [user.leaderboard_position for user in missed_users]
+        for day in range(max(missed_days, default=0)):
+            still_missing = [i for i, days in enumerate(missed_days) if days > day]
+            decayed, _ = rrsystem.calculate_rr_no_log_batch([rrs[i] for i in still_missing], [positions[i] for i in still_missing])
+            for i, rr in zip(still_missing, decayed):
+                rrs[i] = rr
+        new_rrs = {user.discord_id: rr for user, rr in zip(missed_users, rrs)}
+        moved = _apply_decayed_rrs(guild_id, missed_users, new_rrs, [discord_id for _, _, discord_id in decayed_through])
+    diffs = []
+    for user, new_rr, days in zip(missed_users, rrs, missed_days):
+        new_position = moved[user.discord_id][1] if user.discord_id in moved else user.leaderboard_position
+        diffs.append((user, user.rr, new_rr, rrsystem.get_rank(user.rr, user.leaderboard_position), rrsystem.get_rank(new_rr, new_position), days))
+    return diffs
+
+# Writes the result of a history replay of a guild (see replay.py) in one transaction.
+# users is a list of (discord_id, rr, longest_streak, runs_logged, total_distance, last_logged)
+# and runs is a list of (run id, rr_before, rr_after). Positions are rebuilt afterwards.
+def apply_replay(guild_id, users, runs):
+    with transaction():
+        c.executemany('''
+            UPDATE users
+            SET rr = ?, longest_streak = ?, runs_logged = ?, total_distance = ?, last_logged = ?
+            WHERE guild_id = ? AND discord_id = ?
+        ''', [(rr, longest_streak, runs_logged, total_distance, last_logged, guild_id, discord_id) for discord_id, rr, longest_streak, runs_logged, total_distance, last_logged in users])
+        c.executemany('UPDATE runs SET rr_before = ?, rr_after = ? WHERE id = ?', [(rr_before, rr_after, run_id) for run_id, rr_before, rr_after in runs])
+        _forget_index(guild_id)
+        _leaderboard_index(guild_id)
+        after_commit(leaderboard.pages(guild_id).invalidate_all)
+        _write_through(guild_id)
+
+# Bulk imports (see transfer.py) are inserted this many rows per executemany, so an
+# import of any size only holds one chunk in memory
+IMPORT_CHUNK_SIZE = 5000
+
+def _chunks(rows):
+    rows = iter(rows)
+    while chunk := list(itertools.islice(rows, IMPORT_CHUNK_SIZE)):
+        yield chunk
+
+# Signs up everyone in users, an iterable of (discord_id, username, timezone) with
+# canonical timezone names, in one transaction. Like add_new_user, new users start on 0
+# RR behind everyone already signed up, but positions are rebuilt once at the end
+# rather than per user. Users already signed up are left as they are.
+# Returns how many users were added.
+def import_users(guild_id, users):
+    added = 0
+    with transaction():
+        now = timezones.now()
+        for chunk in _chunks(users):
+            c.executemany('INSERT OR IGNORE INTO timezones (name, tz_offset) VALUES (?, ?)', [(name, timezones.offset(name, now)) for name in {timezone for _, _, timezone in chunk}])
+            c.executemany('''
+                INSERT OR IGNORE INTO users (guild_id, discord_id, username, timezone, tz_offset)
+                SELECT ?, ?, ?, name, tz_offset FROM timezones WHERE name = ?
+            ''', [(guild_id, discord_id, username, timezone) for discord_id, username, timezone in chunk])
+            added += c.rowcount
+        if added:
+            _forget_index(guild_id)
+            _leaderboard_index(guild_id)
+            after_commit(leaderboard.pages(guild_id).invalidate_all)
+            _write_through(guild_id)
+    return added
 
-def adjust_rr(discord_id, rr):
-    c.execute('UPDATE users SET rr = ? WHERE discord_id = ?', (rr, discord_id))
-    conn.commit()
+# Adds runs, an iterable of (discord_id, date, distance), to a guild's run history in
+# one transaction, and rebuilds the guild's rollups. Runs by anyone who isn't signed
+# up, or on a day the runner already has a run, are skipped. Users and RR aren't
+# touched: the new runs are only scored once the history is replayed (see
+# transfer.import_runs), so they're written with rr_before and rr_after of 0 until then.
+# Returns how many runs were added.
+def import_runs(guild_id, runs):
+    added = 0
+    with transaction():
+        for chunk in _chunks(runs):
+            c.executemany('''
+                INSERT OR IGNORE INTO runs (guild_id, discord_id, date, distance, rr_before, rr_after)
+                SELECT guild_id, discord_id, ?, ?, 0, 0 FROM users WHERE guild_id = ? AND discord_id = ?
+            ''', [(date, distance, guild_id, discord_id) for discord_id, date, distance in chunk])
+            added += c.rowcount
+        if added:
+            _rebuild_rollups(guild_id)
+    return added
 
-def update_user(discord_id, longest_streak=None, last_logged=None, rr=None, leaderboard_position=None, runs_logged=None, total_distance=None):
-    user = get_user(discord_id)
-    if not user:
+# Users are read and compressed this many positions at a time during a season reset
+SEASON_CHUNK_SIZE = 1000
+
+# Ends a guild's season as of ended (YYYY-MM-DD), in one transaction: archives the
+# final standings to seasons, compresses everyone's RR toward floor (see
+# rr.calculate_rr_season_reset_batch) and rebuilds the positions once at the end.
+# Returns the new archive's season number, or None if the guild has no runners or
+# its season already ended on ended.
+# Readers keep seeing the old season until it commits, and the compression works
+# through the leaderboard a chunk of positions at a time so the writer never holds
+# more than SEASON_CHUNK_SIZE users in memory.
+def reset_season(guild_id, ended, floor=rrsystem.SEASON_RR_FLOOR, carryover=rrsystem.SEASON_RR_CARRYOVER):
+    with transaction():
+        # Each season only ends once, however many times the job runs
+        if not record_job_run(SEASON_JOB, guild_id, ended):
+            return None
+        count = len(_leaderboard_index(guild_id))
+        if count == 0:
+            return None
+        season = c.execute('SELECT COALESCE(MAX(season), 0) + 1 FROM seasons WHERE guild_id = ? AND leaderboard_position = 1', (guild_id,)).fetchone()[0]
+        c.execute('''
+            INSERT INTO seasons (guild_id, season, ended, leaderboard_position, discord_id, username, rr)
+            SELECT guild_id, ?, ?, leaderboard_position, discord_id, username, rr FROM users WHERE guild_id = ?
+        ''', (season, ended, guild_id))
+        for first in range(1, count + 1, SEASON_CHUNK_SIZE):
+            users = c.execute('''
+                SELECT discord_id, rr FROM users
+                WHERE guild_id = ? AND leaderboard_position BETWEEN ? AND ?
+            ''', (guild_id, first, first + SEASON_CHUNK_SIZE - 1)).fetchall()
+            new_rrs = rrsystem.calculate_rr_season_reset_batch([rr for _, rr in users], floor, carryover)
+            c.executemany('UPDATE users SET rr = ? WHERE guild_id = ? AND discord_id = ?',
+                [(new_rr, guild_id, discord_id) for (discord_id, rr), new_rr in zip(users, new_rrs) if new_rr != rr])
+        _forget_index(guild_id)
+        _leaderboard_index(guild_id)
+        after_commit(leaderboard.pages(guild_id).invalidate_all)
+        _write_through(guild_id)
+    return season
+
+# Sets a user's timezone (an IANA name like "America/New_York", in any case) in every
+# guild they're in, and returns its canonical name. Raises timezones.UnknownTimezone
+# for names that don't exist. Their day starts following the new timezone straight
+# away (at, an aware datetime, is when the switch happens; now by default). Any day
+# that has already ended in the new timezone but not yet in the old one ends there and
+# then (see _end_skipped_days), so switching can make a day shorter but never skips one.
+def set_timezone(discord_id, timezone, at=None):
+    timezone = timezones.canonical_name(timezone)
+    at = at or timezones.now()
+    with transaction():
+        c.execute('INSERT OR IGNORE INTO timezones (name, tz_offset) VALUES (?, ?)', (timezone, timezones.offset(timezone, at)))
+        users = c.execute('SELECT guild_id, rr, leaderboard_position, timezone, last_decayed FROM users WHERE discord_id = ?', (discord_id,)).fetchall()
+        for guild_id, rr, position, old_timezone, last_decayed in users:
+            _end_skipped_days(guild_id, discord_id, rr, position, old_timezone, last_decayed, timezone, at)
+        c.execute('''
+            UPDATE users SET timezone = ?, tz_offset = (SELECT tz_offset FROM timezones WHERE name = ?)
+            WHERE discord_id = ?
+            RETURNING guild_id
+        ''', (timezone, timezone, discord_id))
+        for guild_id, in c.fetchall():
+            _write_through(guild_id, [discord_id])
+    return timezone
+
+# The days from the user's current date in old_timezone up to (but not including)
+# their current date in new_timezone have already ended in the new timezone, so its
+# midnight decay has been and gone for them, and the old timezone's won't be applied
+# once they've switched. They're decayed now instead, the same way catch_up_decay
+# decays missed days: once per day that wasn't logged or already decayed.
+def _end_skipped_days(guild_id, discord_id, rr, position, old_timezone, last_decayed, new_timezone, at):
+    first = datetime.date.fromisoformat(timezones.local_date(old_timezone, at))
+    end = datetime.date.fromisoformat(timezones.local_date(new_timezone, at))
+    if last_decayed is not None:
+        first = max(first, datetime.date.fromisoformat(last_decayed) + datetime.timedelta(days=1))
+    if first >= end:
         return
-    if longest_streak is None:
-        longest_streak = user[3]
-    if last_logged is None:
-        last_logged = user[4]
-    if rr is None:
-        rr = user[5]
-    if leaderboard_position is None:
-        leaderboard_position = user[6]
-    if runs_logged is None:
-        runs_logged = user[7]
-    if total_distance is None:
-        total_distance = user[8]
-    c.execute('''
-        UPDATE users 
-        SET longest_streak = ?, last_logged = ?, rr = ?, leaderboard_position = ?, runs_logged = ?, total_distance = ? 
-        WHERE discord_id = ?
-    ''', (longest_streak, last_logged, rr, leaderboard_position, runs_logged, total_distance, discord_id))
-    conn.commit()
-
-def update_leaderboard_positions():
-    c.execute('SELECT discord_id, rr FROM users ORDER BY rr DESC')
-    users = c.fetchall()
-    for position, (discord_id, rr) in enumerate(users, start=1):
-        c.execute('UPDATE users SET leaderboard_position = ? WHERE discord_id = ?', (position, discord_id))
-    conn.commit()
+    logged = {date for date, in c.execute('SELECT date FROM runs WHERE guild_id = ? AND discord_id = ? AND date >= ? AND date < ?', (guild_id, discord_id, first.isoformat(), end.isoformat()))}
+    days = sum(day not in logged for day in _dates(first, end))
+    c.execute('UPDATE users SET last_decayed = ? WHERE guild_id = ? AND discord_id = ?', ((end - datetime.timedelta(days=1)).isoformat(), guild_id, discord_id))
+    new_rr = rr
+    for _ in range(days):
+        (new_rr,), _ = rrsystem.calculate_rr_no_log_batch([new_rr], [position])
+    if new_rr != rr:
+        _set_rr(guild_id, discord_id, new_rr)
+
+# Brings every user's tz_offset up to date with their timezone's offset at at (an
+# aware datetime), for when daylight saving starts or ends. Only timezones whose
+# offset changed touch the users table, so most calls only read the timezones
+# table. Returns the names of the timezones that changed.
+def refresh_timezone_offsets(at):
+    with transaction():
+        changed = []
+        for name, tz_offset in c.execute('SELECT name, tz_offset FROM timezones').fetchall():
+            current = timezones.offset(name, at)
+            if current != tz_offset:
+                changed.append(name)
+                c.execute('UPDATE timezones SET tz_offset = ? WHERE name = ?', (current, name))
+                c.execute('UPDATE users SET tz_offset = ? WHERE timezone = ?', (current, name))
+        if changed:
+            after_commit(cache.users.clear)
+    return changed
+
+def adjust_rr(guild_id, discord_id, rr):
+    with transaction():
+        _set_rr(guild_id, discord_id, rr)
+
+def update_user(guild_id, discord_id, longest_streak=None, last_logged=None, rr=None, leaderboard_position=None, runs_logged=None, total_distance=None):
+    with transaction():
+        user = _select_users(conn, 'SELECT * FROM users WHERE guild_id = ? AND discord_id = ?', (guild_id, discord_id)).fetchone()
+        if not user:
+            return
+        if longest_streak is None:
+            longest_streak = user.longest_streak
+        if last_logged is None:
+            last_logged = user.last_logged
+        if rr is None:
+            rr = user.rr
+        if leaderboard_position is None:
+            leaderboard_position = user.leaderboard_position
+        if runs_logged is None:
+            runs_logged = user.runs_logged
+        if total_distance is None:
+            total_distance = user.total_distance
+        c.execute('''
+            UPDATE users 
+            SET longest_streak = ?, last_logged = ?, leaderboard_position = ?, runs_logged = ?, total_distance = ? 
+            WHERE guild_id = ? AND discord_id = ?
+        ''', (longest_streak, last_logged, leaderboard_position, runs_logged, total_distance, guild_id, discord_id))
+        if rr != user.rr:
+            _set_rr(guild_id, discord_id, rr)
+        _write_through(guild_id, [discord_id])
+
+# Returns a guild's current leaderboard.RankSummary, building its leaderboard index if
+# there isn't one. The summary is published when the transaction commits, so this is
+# only needed while a guild has no published summary (see async_db.get_rank_summary).
+def get_rank_summary(guild_id):
+    with transaction():
+        return _leaderboard_index(guild_id).summary()
+
+# Rebuilds a guild's leaderboard ordering from scratch and rewrites any position that
+# doesn't match it. RR changes keep positions current on their own, so this is only
+# needed to repair the table (e.g. after editing the database by hand).
+def update_leaderboard_positions(guild_id):
+    with transaction():
+        _forget_index(guild_id)
+        _leaderboard_index(guild_id)
 
 # Admin Mutators (Guarded behind admin-only commands)
 
-def ADMIN_ONLY_reset_rr():
-    c.execute('UPDATE users SET rr = 0')
-    conn.commit()
+def ADMIN_ONLY_reset_rr(guild_id):
+    with transaction():
+        c.execute('UPDATE users SET rr = 0 WHERE guild_id = ?', (guild_id,))
+        update_leaderboard_positions(guild_id)
+        after_commit(leaderboard.pages(guild_id).invalidate_all)
+        _write_through(guild_id)
 
-def ADMIN_ONLY_delete_user(discord_id):
-    c.execute('DELETE FROM users WHERE discord_id = ?', (discord_id,))
-    conn.commit()
+def ADMIN_ONLY_delete_user(guild_id, discord_id):
+    with transaction():
+        index = _leaderboard_index(guild_id)
+        c.execute('DELETE FROM users WHERE guild_id = ? AND discord_id = ?', (guild_id, discord_id))
+        if c.rowcount and discord_id in index:
+            c.execute('DELETE FROM runs WHERE guild_id = ? AND discord_id = ?', (guild_id, discord_id))
+            c.execute('DELETE FROM run_rollups WHERE guild_id = ? AND discord_id = ?', (guild_id, discord_id))
+            position = index.remove(discord_id)
+            c.execute('UPDATE users SET leaderboard_position = leaderboard_position - 1 WHERE guild_id = ? AND leaderboard_position > ?', (guild_id, position))
+            pages = leaderboard.pages(guild_id)
+            after_commit(lambda: pages.invalidate(position))
+            after_commit(pages.invalidate_count)
+            after_commit(lambda: cache.users.shift_positions(guild_id, position + 1, None, -1))
+            after_commit(lambda: cache.users.write({(guild_id, discord_id): None}))
 
-def ADMIN_ONLY_delete_table():
-    c.execute('DROP TABLE IF EXISTS users')
-    conn.commit()
+# Deletes every user in a guild, along with their runs and rollups
+def ADMIN_ONLY_delete_table(guild_id):
+    with transaction():
+        c.execute('DELETE FROM users WHERE guild_id = ?', (guild_id,))
+        c.execute('DELETE FROM runs WHERE guild_id = ?', (guild_id,))
+        c.execute('DELETE FROM run_rollups WHERE guild_id = ?', (guild_id,))
+        _forget_index(guild_id)
+        after_commit(leaderboard.pages(guild_id).invalidate_all)
+        after_commit(lambda: cache.users.write({}, evict_guild=guild_id))
 
 def __init__(self):
-    setup()
\ No newline at end of file
+    setup()
@@ -0,0 +1,451 @@
+# Testing class for db.py
+import datetime
+import unittest
+import cache
+import db
+import leaderboard
+import rr
+import timezones
+
+GUILD = '100'
+
+class TestDBFunctions(unittest.TestCase):
+
+    def setUp(self):
+        # Point db.py at a fresh in-memory database for each test
+        db.use_database(':memory:')
+
+    def positions(self):
+        db.c.execute('SELECT discord_id, leaderboard_position FROM users ORDER BY leaderboard_position')
+        return db.c.fetchall()
+
+    def test_add_new_user_goes_last(self):
+        db.add_new_user(GUILD, '1', 'a')
+        db.add_new_user(GUILD, '2', 'b')
+        db.add_new_user(GUILD, '3', 'c')
+        self.assertEqual(self.positions(), [('1', 1), ('2', 2), ('3', 3)])
+
+    def test_adjust_rr_shifts_positions_in_between(self):
+        for discord_id in '12345':
+            db.add_new_user(GUILD, discord_id, discord_id)
+        db.adjust_rr(GUILD, '4', 50)
+        self.assertEqual(self.positions(), [('4', 1), ('1', 2), ('2', 3), ('3', 4), ('5', 5)])
+        db.adjust_rr(GUILD, '2', 60)
+        self.assertEqual(self.positions(), [('2', 1), ('4', 2), ('1', 3), ('3', 4), ('5', 5)])
+        db.adjust_rr(GUILD, '2', 0)
+        self.assertEqual(self.positions(), [('4', 1), ('1', 2), ('2', 3), ('3', 4), ('5', 5)])
+
+    def test_log_run_updates_position(self):
+        for discord_id in '123':
+            db.add_new_user(GUILD, discord_id, discord_id)
+        db.log_run(GUILD, '3', 1.0, '2025-01-01')
+        self.assertEqual(self.positions(), [('3', 1), ('1', 2), ('2', 3)])
+        self.assertEqual(db.get_user(GUILD, '3').rr, 25)
+
+    def test_log_run_returns_updated_user(self):
+        db.add_new_user(GUILD, '1', 'a')
+        user = db.log_run(GUILD, '1', 1.5, '2025-01-01')
+        self.assertEqual(user, db.get_leaderboard(GUILD)[0])
+        self.assertEqual((user.longest_streak, user.last_logged, user.rr, user.leaderboard_position, user.runs_logged, user.total_distance), (1, '2025-01-01', 26, 1, 1, 1.5))
+        with self.assertRaises(AttributeError):
+            db.apply_daily_decay(GUILD, '2025-01-02')[0][0].runs_logged
+
+    def test_log_run_records_history(self):
+        db.add_new_user(GUILD, '1', 'a')
+        db.add_new_user(GUILD, '2', 'b')
+        db.log_run(GUILD, '1', 1.0, '2025-01-01')
+        db.log_run(GUILD, '2', 3.0, '2025-01-01')
+        db.log_run(GUILD, '1', 2.0, '2025-01-02')
+        db.log_run(GUILD, '1', 0.5, '2025-01-03')
+        self.assertEqual(list(db.iter_user_runs(GUILD, '1')), [('2025-01-01', 1.0, 0, 25), ('2025-01-02', 2.0, 25, 51), ('2025-01-03', 0.5, 51, 38)])
+        self.assertEqual(list(db.iter_user_runs(GUILD, '1', start='2025-01-02', end='2025-01-02')), [('2025-01-02', 2.0, 25, 51)])
+        self.assertEqual(list(db.iter_runs(GUILD, end='2025-01-01')), [('2025-01-01', '1', 1.0), ('2025-01-01', '2', 3.0)])
+
+    def test_log_run_rejects_second_run_same_day(self):
+        db.add_new_user(GUILD, '1', 'a')
+        db.log_run(GUILD, '1', 1.0, '2025-01-01')
+        with self.assertRaises(db.AlreadyLoggedToday):
+            db.log_run(GUILD, '1', 1.0, '2025-01-01')
+        self.assertEqual(db.get_user(GUILD, '1').runs_logged, 1)
+        with self.assertRaises(db.NotSignedUp):
+            db.log_run(GUILD, '2', 1.0, '2025-01-01')
+
+    def test_runs_table_rejects_second_run_same_day(self):
+        db.add_new_user(GUILD, '1', 'a')
+        user = db.log_run(GUILD, '1', 1.0, '2025-01-01')
+        # Even if the user's row has lost track of it, the run is still there
+        db.c.execute("UPDATE users SET last_logged = NULL WHERE discord_id = '1'")
+        with self.assertRaises(db.AlreadyLoggedToday):
+            db.log_run(GUILD, '1', 1.0, '2025-01-01')
+        self.assertEqual((db.get_user(GUILD, '1').rr, db.get_user(GUILD, '1').runs_logged), (user.rr, 1))
+        self.assertEqual(len(list(db.iter_user_runs(GUILD, '1'))), 1)
+
+    def test_apply_daily_decay(self):
+        for discord_id in '1234':
+            db.add_new_user(GUILD, discord_id, discord_id)
+        db.adjust_rr(GUILD, '1', 50)    # Bronze, no loss
+        db.adjust_rr(GUILD, '2', 402)   # Diamond, loses 7 and drops to Platinum
+        db.adjust_rr(GUILD, '3', 398)   # Platinum, but logs a run
+        db.log_run(GUILD, '3', 1.0, '2025-01-01')
+        diffs = db.apply_daily_decay(GUILD, '2025-01-01')
+        summary = sorted((user.discord_id, old_rr, new_rr, old_rank, new_rank) for user, old_rr, new_rr, old_rank, new_rank in diffs)
+        self.assertEqual(summary, [
+            ('1', 50, 50, rr.Rank.BRONZE, rr.Rank.BRONZE),
+            ('2', 402, 395, rr.Rank.DIAMOND, rr.Rank.PLATINUM),
+            ('4', 0, 0, rr.Rank.BRONZE, rr.Rank.BRONZE),
+        ])
+        self.assertEqual(self.positions(), [('3', 1), ('2', 2), ('1', 3), ('4', 4)])
+
+    def test_delete_user_closes_gap(self):
+        for discord_id in '123':
+            db.add_new_user(GUILD, discord_id, discord_id)
+        db.ADMIN_ONLY_delete_user(GUILD, '2')
+        self.assertEqual(self.positions(), [('1', 1), ('3', 2)])
+
+    def test_nested_transaction_rolls_back_only_inner(self):
+        with db.transaction():
+            db.add_new_user(GUILD, '1', 'a')
+            with self.assertRaises(db.AlreadyLoggedToday):
+                with db.transaction():
+                    db.adjust_rr(GUILD, '1', 40)
+                    raise db.AlreadyLoggedToday('1')
+            db.add_new_user(GUILD, '2', 'b')
+        self.assertEqual(db.get_user(GUILD, '1').rr, 0)
+        self.assertEqual(self.positions(), [('1', 1), ('2', 2)])
+
+    def test_rollback_only_drops_indexes_it_used(self):
+        for guild_id in (GUILD, '200'):
+            db.add_new_user(guild_id, '1', 'a')
+        db.log_run(GUILD, '1', 1.0, '2025-01-01')
+        indexes = dict(db._leaderboards)
+        # Rejected before it touches the index, so nothing is dropped
+        with self.assertRaises(db.AlreadyLoggedToday):
+            db.log_run(GUILD, '1', 1.0, '2025-01-01')
+        with self.assertRaises(db.NotSignedUp):
+            db.log_run(GUILD, '2', 1.0, '2025-01-01')
+        self.assertEqual(db._leaderboards, indexes)
+        # Rolled back after moving someone, so only that guild's index goes
+        with self.assertRaises(db.AlreadyLoggedToday):
+            with db.transaction():
+                db.adjust_rr('200', '1', 40)
+                raise db.AlreadyLoggedToday('1')
+        self.assertEqual(db._leaderboards, {GUILD: indexes[GUILD]})
+        db.add_new_user('200', '2', 'b')
+        self.assertEqual([(user.discord_id, user.rr) for user in db.get_leaderboard('200')], [('1', 0), ('2', 0)])
+
+    def test_failed_commit_is_rolled_back(self):
+        db.add_new_user(GUILD, '1', 'a')
+        # A deferred foreign key is only checked at COMMIT, which then fails and leaves
+        # the transaction open
+        db.c.execute('PRAGMA foreign_keys = ON')
+        db.c.execute('CREATE TEMP TABLE parent (id INTEGER PRIMARY KEY)')
+        db.c.execute('CREATE TEMP TABLE child (parent_id INTEGER REFERENCES parent (id) DEFERRABLE INITIALLY DEFERRED)')
+        with self.assertRaises(db.sqlite3.IntegrityError):
+            with db.transaction():
+                db.adjust_rr(GUILD, '1', 40)
+                db.c.execute('INSERT INTO child VALUES (1)')
+        self.assertFalse(db.conn.in_transaction)
+        self.assertNotIn(GUILD, db._leaderboards)
+        self.assertEqual(db.get_user(GUILD, '1').rr, 0)
+        db.add_new_user(GUILD, '2', 'b')
+        self.assertEqual(self.positions(), [('1', 1), ('2', 2)])
+
+    def cache_pages(self):
+        for page in range(1, 4):
+            fields, generation = leaderboard.pages(GUILD).get(page)
+            leaderboard.pages(GUILD).put(page, generation, leaderboard.render_page(db.get_leaderboard_page(GUILD, (page - 1) * leaderboard.PAGE_SIZE + 1, leaderboard.PAGE_SIZE)))
+
+    def test_leaderboard_pages(self):
+        for i in range(25):
+            db.add_new_user(GUILD, str(i), f'u{i}')
+            db.adjust_rr(GUILD, str(i), 25 - i)
+        self.assertEqual(db.get_leaderboard_page(GUILD, 11, 10)[0], (11, 'u10', 15))
+        self.cache_pages()
+        # Moving from 21st to 16th only touches pages 2 and 3
+        db.adjust_rr(GUILD, '20', 11)
+        self.assertEqual(db.get_user(GUILD, '20').leaderboard_position, 16)
+        self.assertIsNotNone(leaderboard.pages(GUILD).get(1)[0])
+        self.assertIsNone(leaderboard.pages(GUILD).get(2)[0])
+        self.assertIsNone(leaderboard.pages(GUILD).get(3)[0])
+
+    def test_leaderboard_pages_not_invalidated_on_rollback(self):
+        db.add_new_user(GUILD, '1', 'a')
+        self.cache_pages()
+        with self.assertRaises(db.AlreadyLoggedToday):
+            with db.transaction():
+                db.adjust_rr(GUILD, '1', 40)
+                raise db.AlreadyLoggedToday('1')
+        self.assertEqual(leaderboard.pages(GUILD).get(1)[0], [('🥉 #1 a', 'RR: 0 (Bronze)')])
+
+    def test_leaderboard_page_not_cached_if_invalidated_while_reading(self):
+        db.add_new_user(GUILD, '1', 'a')
+        _, generation = leaderboard.pages(GUILD).get(1)
+        db.adjust_rr(GUILD, '1', 40)
+        leaderboard.pages(GUILD).put(1, generation, [('stale', 'stale')])
+        self.assertIsNone(leaderboard.pages(GUILD).get(1)[0])
+
+    def test_user_cache_write_through(self):
+        for discord_id in '123':
+            db.add_new_user(GUILD, discord_id, discord_id)
+        for discord_id in '123':
+            db.get_user(GUILD, discord_id)
+        hits = cache.users.stats()['hits']
+        self.assertEqual(db.get_user(GUILD, '2').leaderboard_position, 2)
+        self.assertEqual(cache.users.stats()['hits'], hits + 1)
+        # Logging a run moves user 3 to the top and shifts the other cached users down
+        db.log_run(GUILD, '3', 1.0, '2025-01-01')
+        db.adjust_rr(GUILD, '2', 10)
+        db.ADMIN_ONLY_delete_user(GUILD, '1')
+        db.apply_daily_decay(GUILD, '2025-01-01')
+        cached = {discord_id: cache.users.get((GUILD, discord_id))[0] for discord_id in '123'}
+        self.assertIsNone(cached['1'])
+        for user in db.get_leaderboard(GUILD):
+            self.assertEqual(cached[user.discord_id], user)
+
+    def test_user_cache_is_bounded(self):
+        cache.users.capacity = 2
+        try:
+            for discord_id in '123':
+                db.add_new_user(GUILD, discord_id, discord_id)
+                db.get_user(GUILD, discord_id)
+            self.assertEqual(cache.users.keys(), [(GUILD, '2'), (GUILD, '3')])
+        finally:
+            cache.users.capacity = cache.USER_CACHE_SIZE
+
+    def test_update_leaderboard_positions_repairs_table(self):
+        for discord_id in '123':
+            db.add_new_user(GUILD, discord_id, discord_id)
+        db.c.execute("UPDATE users SET rr = 10, leaderboard_position = NULL WHERE discord_id = '3'")
+        db.update_leaderboard_positions(GUILD)
+        self.assertEqual(self.positions(), [('3', 1), ('1', 2), ('2', 3)])
+
+    def test_guilds_have_separate_leaderboards(self):
+        for discord_id in '123':
+            db.add_new_user(GUILD, discord_id, discord_id)
+        db.add_new_user('200', '3', 'c')
+        db.add_new_user('200', '4', 'd')
+        db.adjust_rr('200', '3', 760)
+        db.log_run(GUILD, '2', 1.0, '2025-01-01')
+        self.assertEqual([(user.discord_id, user.leaderboard_position) for user in db.get_leaderboard(GUILD)], [('2', 1), ('1', 2), ('3', 3)])
+        self.assertEqual([(user.discord_id, user.rr, user.leaderboard_position) for user in db.get_leaderboard('200')], [('3', 760, 1), ('4', 0, 2)])
+        self.assertEqual(db.get_user(GUILD, '3').rr, 0)
+        with self.assertRaises(db.NotSignedUp):
+            db.log_run('200', '1', 1.0, '2025-01-01')
+        # The Usain Bolt decay only applies to the top of guild 200
+        diffs = db.apply_daily_decay('200', '2025-01-01')
+        self.assertEqual(sorted((user.discord_id, old_rank, new_rr) for user, _, new_rr, old_rank, _ in diffs), [('3', rr.Rank.USAIN_BOLT, 738), ('4', rr.Rank.BRONZE, 0)])
+        self.assertEqual(db.get_user(GUILD, '1').rr, 0)
+        db.ADMIN_ONLY_delete_table('200')
+        self.assertEqual(db.get_leaderboard('200'), [])
+        self.assertEqual(len(db.get_leaderboard(GUILD)), 3)
+
+    def test_claim_legacy_guild(self):
+        # Users and runs from before guilds, plus someone who signed up since
+        db.c.execute("INSERT INTO users (guild_id, discord_id, username, rr, leaderboard_position) VALUES ('', '1', 'a', 10, 1), ('', '2', 'b', 0, 2)")
+        db.c.execute("INSERT INTO runs (discord_id, date, distance, rr_before, rr_after) VALUES ('1', '2025-01-01', 1.0, 0, 10)")
+        db.add_new_user(GUILD, '3', 'c')
+        db.adjust_rr(GUILD, '3', 5)
+        self.assertEqual(db.get_guilds(), [(GUILD, None, 1)])
+        self.assertEqual(db.claim_legacy_guild(GUILD, 42), 2)
+        self.assertEqual([(user.discord_id, user.leaderboard_position) for user in db.get_leaderboard(GUILD)], [('1', 1), ('3', 2), ('2', 3)])
+        self.assertEqual(list(db.iter_user_runs(GUILD, '1')), [('2025-01-01', 1.0, 0, 10)])
+        self.assertEqual(db.get_guilds(), [(GUILD, 42, 3)])
+        # Claiming again does nothing
+        self.assertEqual(db.claim_legacy_guild(GUILD, 43), 0)
+        self.assertEqual(db.get_announcement_channel(GUILD), 42)
+
+    def test_decay_by_timezone(self):
+        for discord_id in '123':
+            db.add_new_user(GUILD, discord_id, discord_id)
+            db.adjust_rr(GUILD, discord_id, 300)
+        self.assertEqual(db.set_timezone('2', 'asia/tokyo'), 'Asia/Tokyo')
+        self.assertEqual(db.get_user(GUILD, '2').tz_offset, 540)
+        with self.assertRaises(timezones.UnknownTimezone):
+            db.set_timezone('3', 'Mars/Olympus_Mons')
+        self.assertEqual(db.count_users(GUILD, 540, 600), 1)
+        # Only Tokyo's bucket is decayed
+        diffs = db.apply_daily_decay(GUILD, '2025-01-01', 540, 600)
+        self.assertEqual([user.discord_id for user, *_ in diffs], ['2'])
+        self.assertEqual([db.get_user(GUILD, discord_id).rr for discord_id in '123'], [300, 295, 300])
+
+    def test_switching_timezone_cant_skip_a_day(self):
+        for discord_id in '12':
+            db.add_new_user(GUILD, discord_id, discord_id)
+            db.adjust_rr(GUILD, discord_id, 450)
+        # 23:30 on the 1st in Los Angeles, but already 00:30 on the 2nd in Denver, whose
+        # midnight decay for the 1st ran half an hour ago
+        at = datetime.datetime(2025, 7, 2, 6, 30, tzinfo=datetime.timezone.utc)
+        db.set_timezone('1', 'America/Denver', at)
+        user = db.get_user(GUILD, '1')
+        self.assertEqual((user.rr, user.last_decayed), (443, '2025-07-01'))
+        self.assertEqual(db.apply_daily_decay(GUILD, '2025-07-01', user.tz_offset, user.tz_offset + 1), [])
+        # Going back the other way doesn't end the 2nd early, and nobody loses the 1st twice
+        db.set_timezone('1', 'America/Los_Angeles', at)
+        db.set_timezone('2', 'America/Los_Angeles', at)
+        self.assertEqual([db.get_user(GUILD, discord_id).rr for discord_id in '12'], [443, 450])
+        self.assertEqual([user.discord_id for user, *_ in db.apply_daily_decay(GUILD, '2025-07-01')], ['2'])
+
+    def test_decay_sees_runs_before_the_latest(self):
+        db.add_new_user(GUILD, '1', 'a')
+        db.set_timezone('1', 'Asia/Kolkata')
+        db.adjust_rr(GUILD, '1', 536)
+        # Kolkata's midnight bucket runs at 00:30 local, after this runner has already
+        # logged the next day
+        db.log_run(GUILD, '1', 1.0, '2025-01-01')
+        db.log_run(GUILD, '1', 1.0, '2025-01-02')
+        rr_value = db.get_user(GUILD, '1').rr
+        self.assertEqual(db.apply_daily_decay(GUILD, '2025-01-01', 330, 331), [])
+        # Nor does catching up take it for the 1st; only the 3rd, which had no run
+        since = datetime.datetime(2024, 12, 31, 19, tzinfo=datetime.timezone.utc)
+        at = datetime.datetime(2025, 1, 3, 19, tzinfo=datetime.timezone.utc)
+        [(_, old_rr, new_rr, _, _, days)] = db.catch_up_decay(GUILD, since, at)
+        self.assertEqual((old_rr, days), (rr_value, 1))
+        self.assertEqual(db.get_user(GUILD, '1').rr, new_rr)
+
+    def test_refresh_timezone_offsets(self):
+        db.add_new_user(GUILD, '1', 'a')
+        db.set_timezone('1', 'America/New_York')
+        summer = datetime.datetime(2025, 7, 1, tzinfo=datetime.timezone.utc)
+        winter = datetime.datetime(2025, 12, 1, tzinfo=datetime.timezone.utc)
+        db.refresh_timezone_offsets(summer)
+        self.assertEqual(db.get_user(GUILD, '1').tz_offset, -240)
+        self.assertEqual(sorted(db.refresh_timezone_offsets(winter)), ['America/Los_Angeles', 'America/New_York'])
+        self.assertEqual(db.get_user(GUILD, '1').tz_offset, -300)
+        self.assertEqual(db.refresh_timezone_offsets(winter), [])
+
+    def test_reset_season(self):
+        self.assertIsNone(db.reset_season(GUILD, '2024-12-31'))
+        for discord_id, rr_value in [('1', 800), ('2', 301), ('3', 300), ('4', 0)]:
+            db.add_new_user(GUILD, discord_id, discord_id)
+            db.adjust_rr(GUILD, discord_id, rr_value)
+        db.SEASON_CHUNK_SIZE = 3
+        try:
+            self.assertEqual(db.reset_season(GUILD, '2025-01-31', floor=100), 1)
+        finally:
+            db.SEASON_CHUNK_SIZE = 1000
+        # 301 and 300 both compress to 200, so the older account goes first
+        self.assertEqual([(user.discord_id, user.rr, user.leaderboard_position) for user in db.get_leaderboard(GUILD)], [('1', 450, 1), ('2', 200, 2), ('3', 200, 3), ('4', 0, 4)])
+        self.assertEqual(db.get_season_standings(GUILD, 1, 2), [(1, '1', '1', 800), (2, '2', '2', 301)])
+        db.adjust_rr(GUILD, '2', 500)
+        self.assertEqual(db.reset_season(GUILD, '2025-02-28'), 2)
+        self.assertEqual(db.get_season_winners(GUILD), [(2, '2025-02-28', '2', '2', 500), (1, '2025-01-31', '1', '1', 800)])
+        self.assertEqual(db.get_user_seasons(GUILD, '1'), [(2, '2025-02-28', 450, 2), (1, '2025-01-31', 800, 1)])
+        self.assertEqual(db.get_season_winners('200'), [])
+        # A season only ends once
+        self.assertIsNone(db.reset_season(GUILD, '2025-02-28'))
+        self.assertEqual(db.get_user(GUILD, '2').rr, 250)
+
+    def test_daily_decay_only_applies_once(self):
+        db.add_new_user(GUILD, '1', 'a')
+        db.adjust_rr(GUILD, '1', 300)
+        self.assertEqual(len(db.apply_daily_decay(GUILD, '2025-01-01')), 1)
+        self.assertEqual(db.apply_daily_decay(GUILD, '2025-01-01'), [])
+        self.assertEqual(db.get_user(GUILD, '1').rr, 295)
+
+    def test_catch_up_decay(self):
+        for discord_id in '123':
+            db.add_new_user(GUILD, discord_id, discord_id)
+            db.adjust_rr(GUILD, discord_id, 400)
+        db.set_timezone('2', 'Asia/Tokyo')
+        db.c.execute("UPDATE users SET last_logged = '2025-01-02' WHERE discord_id = '1'")
+        db.c.execute("INSERT INTO runs (guild_id, discord_id, date, distance, rr_before, rr_after) VALUES (?, '1', '2025-01-02', 1.0, 400, 400)", (GUILD,))
+        db.c.execute("UPDATE users SET rr = 393, last_decayed = '2025-01-01' WHERE discord_id = '3'")
+        db.update_leaderboard_positions(GUILD)
+        # January 1st to 3rd ended everywhere between these ticks
+        since = datetime.datetime(2025, 1, 1, 12, tzinfo=datetime.timezone.utc)
+        at = datetime.datetime(2025, 1, 4, 12, tzinfo=datetime.timezone.utc)
+        diffs = db.catch_up_decay(GUILD, since, at)
+        self.assertEqual(sorted((user.discord_id, old_rr, new_rr, days) for user, old_rr, new_rr, _, _, days in diffs), [('1', 400, 388, 2), ('2', 400, 383, 3), ('3', 393, 383, 2)])
+        self.assertEqual([(user.discord_id, user.rr, user.last_decayed) for user in db.get_leaderboard(GUILD)], [('1', 388, '2025-01-03'), ('2', 383, '2025-01-03'), ('3', 383, '2025-01-03')])
+        self.assertEqual(db.catch_up_decay(GUILD, since, at), [])
+        self.assertEqual(db.apply_daily_decay(GUILD, '2025-01-03'), [])
+
+    def test_job_ledger(self):
+        self.assertIsNone(db.get_last_job_run(db.DECAY_JOB, GUILD))
+        self.assertTrue(db.record_job_run(db.DECAY_JOB, GUILD, '2025-01-01T00:00:00+00:00'))
+        self.assertFalse(db.record_job_run(db.DECAY_JOB, GUILD, '2025-01-01T00:00:00+00:00'))
+        self.assertTrue(db.record_job_run(db.DECAY_JOB, GUILD, '2025-01-09T00:00:00+00:00', prune_before='2025-01-02'))
+        self.assertEqual(db.get_last_job_run(db.DECAY_JOB, GUILD), '2025-01-09T00:00:00+00:00')
+        self.assertEqual(db.c.execute('SELECT COUNT(*) FROM job_runs').fetchone()[0], 1)
+        self.assertIsNone(db.get_last_job_run(db.DECAY_JOB, '200'))
+
+    def test_rollups_follow_runs(self):
+        for discord_id in '123':
+            db.add_new_user(GUILD, discord_id, 'runner ' + discord_id)
+        self.assertEqual(db.period_start('week', '2025-03-02'), '2025-02-24')
+        self.assertEqual(db.period_start('month', '2025-03-02'), '2025-03-01')
+        db.log_run(GUILD, '1', 1.0, '2025-03-01')
+        db.log_run(GUILD, '1', 3.5, '2025-03-02')
+        db.log_run(GUILD, '1', 2.0, '2025-03-03')
+        db.log_run(GUILD, '2', 5.0, '2025-03-04')
+        db.log_run(GUILD, '3', 0.5, '2025-03-05')
+        with self.assertRaises(db.AlreadyLoggedToday):
+            db.log_run(GUILD, '3', 9.0, '2025-03-05')
+        self.assertEqual(db.get_rollup(GUILD, '1', 'week', '2025-02-28'), (4.5, 2, 3.5))
+        self.assertEqual(db.get_rollup(GUILD, '1', 'month', '2025-03-31'), (6.5, 3, 3.5))
+        self.assertIsNone(db.get_rollup(GUILD, '2', 'week', '2025-03-02'))
+        self.assertEqual(db.get_personal_best(GUILD, '1'), 3.5)
+        self.assertIsNone(db.get_personal_best('200', '1'))
+        self.assertEqual(db.get_period_leaderboard(GUILD, 'week', '2025-03-09', 2), [('2', 'runner 2', 5.0, 1, 5.0), ('1', 'runner 1', 2.0, 1, 2.0)])
+        self.assertEqual([row[0] for row in db.get_period_leaderboard(GUILD, 'month', '2025-03-01', 10)], ['1', '2', '3'])
+        db.ADMIN_ONLY_delete_user(GUILD, '2')
+        self.assertEqual([row[0] for row in db.get_period_leaderboard(GUILD, 'month', '2025-03-01', 10)], ['1', '3'])
+        # Bulk imports rebuild them from the run history
+        db.import_runs(GUILD, [('3', '2025-03-06', 4.0), ('1', '2025-03-03', 8.0)])
+        self.assertEqual(db.get_rollup(GUILD, '3', 'month', '2025-03-01'), (4.5, 2, 4.0))
+        self.assertEqual(db.get_rollup(GUILD, '1', 'week', '2025-03-03'), (2.0, 1, 2.0))
+        # Deleting the table takes everyone's runs and rollups with it, so nobody signing
+        # up afterwards inherits them
+        db.add_new_user('200', '1', 'a')
+        db.log_run('200', '1', 1.0, '2025-03-01')
+        db.ADMIN_ONLY_delete_table(GUILD)
+        self.assertEqual(db.get_period_leaderboard(GUILD, 'month', '2025-03-01', 10), [])
+        db.add_new_user(GUILD, '1', 'runner 1')
+        self.assertIsNone(db.get_personal_best(GUILD, '1'))
+        self.assertEqual(list(db.iter_runs(GUILD)), [])
+        self.assertEqual(db.get_rollup('200', '1', 'month', '2025-03-01'), (1.0, 1, 1.0))
+
+    def test_rank_summary_follows_rr_changes(self):
+        changes = []
+        leaderboard.title_listeners.append(lambda *change: changes.append(change))
+        self.addCleanup(leaderboard.title_listeners.pop)
+        for discord_id in '1234':
+            db.add_new_user(GUILD, discord_id, discord_id)
+        summary = leaderboard.rank_summaries[GUILD]
+        self.assertEqual((summary.count(rr.Rank.BRONZE), summary.runners, summary.usain_bolt), (4, 4, None))
+        db.adjust_rr(GUILD, '1', 760)
+        db.adjust_rr(GUILD, '2', 745)
+        db.adjust_rr(GUILD, '3', 420)
+        summary = leaderboard.rank_summaries[GUILD]
+        self.assertEqual([summary.count(rank) for rank in rr.Rank], [1, 0, 0, 0, 1, 1, 0, 1])
+        self.assertEqual(summary.usain_bolt, '1')
+        self.assertEqual([summary.top_percent(position) for position in (1, 2, 4)], [25, 50, 100])
+        # 2 overtakes 1 with a run, then decay takes 1 below Grandmaster (17 RR a night)
+        db.log_run(GUILD, '2', 3.0, '2025-01-01')
+        self.assertEqual(leaderboard.rank_summaries[GUILD].usain_bolt, '2')
+        db.log_run(GUILD, '1', 1.0, '2025-01-02')
+        db.apply_daily_decay(GUILD, '2025-01-02')
+        self.assertEqual(leaderboard.rank_summaries[GUILD].usain_bolt, '1')
+        # Matches counting every rank from scratch
+        users = db.get_leaderboard(GUILD)
+        recounted = [0] * len(rr.Rank)
+        for rank in rr.get_ranks([user.rr for user in users], [user.leaderboard_position for user in users]):
+            recounted[rank.value] += 1
+        self.assertEqual(list(leaderboard.rank_summaries[GUILD].counts), recounted)
+        db.reset_season(GUILD, '2025-01-31')
+        self.assertIsNone(leaderboard.rank_summaries[GUILD].usain_bolt)
+        self.assertEqual(changes, [(GUILD, None, '1'), (GUILD, '1', '2'), (GUILD, '2', '1'), (GUILD, '1', None)])
+        # A rollback publishes nothing
+        with self.assertRaises(db.AlreadyLoggedToday):
+            with db.transaction():
+                db.adjust_rr(GUILD, '4', 900)
+                raise db.AlreadyLoggedToday('4')
+        self.assertIsNone(leaderboard.rank_summaries[GUILD].usain_bolt)
+        self.assertEqual(len(changes), 4)
+        # A dropped index is rebuilt when asked for
+        db.ADMIN_ONLY_delete_table(GUILD)
+        self.assertNotIn(GUILD, leaderboard.rank_summaries)
+        self.assertEqual(db.get_rank_summary(GUILD).runners, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,13 @@
 # Helper class for managing commands between admin and bot executed commands
 
+import datetime
 import discord
-import pytz
-import timedelta
 
+import announcements
+import async_db
 import db
 import rr
+import timezones
 
 EMBED_COLOR = 0x00ff00
 
@@ -14,42 +16,104 @@ def admin_guard(ctx):
         return False
     return True
 
-def daily_rr_message(timezone, bot, announcement_channel_id):
-    now = pytz.datetime.datetime.now(tz=timezone)
-    yesterday = now - timedelta(days=1)
-    date_string = timezone.localize(yesterday).strftime("%Y-%m-%d")
-    date_embed_string = timezone.localize(yesterday).strftime("%A, %B %d")
-    users_who_didnt_log = db.get_users_who_didnt_log_today(date_string)
+# Builds the embed for one page of a guild's leaderboard. page is clamped to the pages
+# that exist; returns (embed, page, page count).
+async def leaderboard_embed(guild_id, page):
+    page_count = await async_db.get_leaderboard_page_count(guild_id)
+    page = min(max(page, 1), max(page_count, 1))
+    leaderboard_embed = discord.Embed(title="Run A Mile Ranked Leaderboard", description="Top runners based on their Run Rating (RR).", color=EMBED_COLOR)
+    fields = await async_db.get_leaderboard_page(guild_id, page)
+    if not fields:
+        leaderboard_embed.add_field(name="No runners yet!", value="Be the first to sign up and log a run!", inline=False)
+    for name, value in fields:
+        leaderboard_embed.add_field(name=name, value=value, inline=False)
+    leaderboard_embed.set_footer(text=f"Page {page} of {max(page_count, 1)}")
+    return leaderboard_embed, page, page_count
+
+# Previous/next buttons under a leaderboard message
+class LeaderboardView(discord.ui.View):
+    def __init__(self, guild_id, page, page_count):
+        super().__init__(timeout=300)
+        self.guild_id = guild_id
+        self.page = page
+        self.page_count = page_count
+        self.update_buttons()
+
+    def update_buttons(self):
+        self.previous_page.disabled = self.page <= 1
+        self.next_page.disabled = self.page >= self.page_count
+
+    async def show(self, interaction, page):
+        embed, self.page, self.page_count = await leaderboard_embed(self.guild_id, page)
+        self.update_buttons()
+        await interaction.response.edit_message(embed=embed, view=self)
+
+    @discord.ui.button(label="◀", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        await self.show(interaction, self.page - 1)
+
+    @discord.ui.button(label="▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        await self.show(interaction, self.page + 1)
+
+# Builds the discord.Embed for one EmbedPage (see announcements.py)
+def to_embed(page):
+    embed = discord.Embed(title=page.title, description=page.description, color=EMBED_COLOR)
+    for name, value in page.fields:
+        embed.add_field(name=name, value=value, inline=False)
+    if page.footer:
+        embed.set_footer(text=page.footer)
+    return embed
+
+# Applies the RR decay for the end of date (YYYY-MM-DD) to the users in a guild with
+# first_offset <= tz_offset < end_offset (a bucket from timezones.midnight_buckets)
+# and returns the EmbedPages announcing it: the day end report, then the rank changes
+# if anyone deranked. Returns None if nobody in the guild is in the bucket. Runs on
+# the async_db writer thread.
+def daily_rr_message(guild_id, date, first_offset=db.ALL_OFFSETS[0], end_offset=db.ALL_OFFSETS[1]):
+    if db.count_users(guild_id, first_offset, end_offset) == 0:
+        return None
+    date_embed_string = datetime.date.fromisoformat(date).strftime("%A, %B %d")
+    decay = db.apply_daily_decay(guild_id, date, first_offset, end_offset)
     description = "It's the end of the day, and you didn't log your run!"
-    if users_who_didnt_log == []:
+    if decay == []:
         description = "Congratulations! Everyone logged their runs today!"
-    day_end_embed = discord.Embed(title="End of " + date_embed_string, description=description, color=EMBED_COLOR)
-    rank_loss_embed = discord.Embed(title="Rank Changes", description="The following users deranked because they didn't run today:", color=EMBED_COLOR)
-    # A mapping of user, previous rank, new rank
-    rank_loss_mapping = {}
-    for user in users_who_didnt_log:
-        discord_id = user[1]
-        username = user[2]
-        rr_value = user[5]
-        position = user[6]
-        rank = rr.get_rank(rr_value, position)
-        rank_name = rr.get_rank_name(rank)
+    footer = None
+    if (first_offset, end_offset) != db.ALL_OFFSETS:
+        footer = f"For runners on {timezones.describe_offset(first_offset)} to {timezones.describe_offset(end_offset - 1)}"
+    day_end_fields = []
+    rank_loss_fields = []
+    for user, rr_value, new_rr_value, rank, new_rank in decay:
+        username = user.username
         rank_icon = rr.get_rank_icon(rank)
-        total_rr_loss = 10 # TODO (akhorana): Calculate RR loss based on rank, longest streak, etc.
-        # TODO (akhorana): Update total_rr_loss logic. total_rr_loss should account that the user doesn't go below 0RR.
-        new_rr_value = max(0, rr_value - total_rr_loss)  # RR cannot go below 0
-        new_rank = rr.get_rank(new_rr_value, position)
-        if (new_rank != rank):
-            rank_loss_mapping[username] = (rank, new_rank)
-        db.adjust_rr(discord_id, new_rr_value)
-        day_end_embed.add_field(name=f"{rank_icon} {username}", value=f"RR: {rr_value} -> {new_rr_value} (Lost {total_rr_loss} RR)", inline=False)
-    if rank_loss_mapping:
-        for username, (old_rank, new_rank) in rank_loss_mapping.items():
-            old_rank_name = rr.get_rank_name(old_rank)
+        day_end_fields.append((f"{rank_icon} {username}", f"RR: {rr_value} -> {new_rr_value} (Lost {rr_value - new_rr_value} RR)"))
+        if new_rank != rank:
+            old_rank_name = rr.get_rank_name(rank)
             new_rank_name = rr.get_rank_name(new_rank)
-            old_rank_icon = rr.get_rank_icon(old_rank)
             new_rank_icon = rr.get_rank_icon(new_rank)
-            rank_loss_embed.add_field(name=f"{old_rank_icon} {username}", value=f"{old_rank_icon} {old_rank_name} -> {new_rank_icon} {new_rank_name}", inline=False)
-    if rank_loss_mapping:
-        return day_end_embed, rank_loss_embed
-    return day_end_embed, None
\ No newline at end of file
+            rank_loss_fields.append((f"{rank_icon} {username}", f"{rank_icon} {old_rank_name} -> {new_rank_icon} {new_rank_name}"))
+    pages = announcements.paginate("End of " + date_embed_string, description, day_end_fields, footer)
+    if rank_loss_fields:
+        pages += announcements.paginate("Rank Changes", "The following users deranked because they didn't run today:", rank_loss_fields)
+    return pages
+
+# Applies every day a guild missed between the hourly ticks since and at while the bot
+# was down (see db.catch_up_decay) and returns the EmbedPages announcing it, like
+# daily_rr_message, or None if nobody missed a day. Runs on the async_db writer thread.
+def catch_up_message(guild_id, since, at):
+    decay = db.catch_up_decay(guild_id, since, at)
+    if not decay:
+        return None
+    catch_up_fields = []
+    rank_loss_fields = []
+    for user, rr_value, new_rr_value, rank, new_rank, days in decay:
+        username = user.username
+        rank_icon = rr.get_rank_icon(rank)
+        catch_up_fields.append((f"{rank_icon} {username}", f"RR: {rr_value} -> {new_rr_value} (Lost {rr_value - new_rr_value} RR over {days} {'day' if days == 1 else 'days'})"))
+        if new_rank != rank:
+            new_rank_icon = rr.get_rank_icon(new_rank)
+            rank_loss_fields.append((f"{rank_icon} {username}", f"{rank_icon} {rr.get_rank_name(rank)} -> {new_rank_icon} {rr.get_rank_name(new_rank)}"))
+    pages = announcements.paginate("Catching Up", "I was offline for a while, so here's the RR lost for the days that ended without a run:", catch_up_fields)
+    if rank_loss_fields:
+        pages += announcements.paginate("Rank Changes", "The following users deranked because they didn't run:", rank_loss_fields)
+    return pages
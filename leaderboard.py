@@ -0,0 +1,233 @@
+# In-memory ordering of the leaderboard.
+# db.py keeps one of these next to the users table so that when a single user's RR
+# changes it can work out their old and new position without re-sorting everyone,
+# and only shift the rows in between.
+# Users are ordered by RR (highest first), with ties going to whoever signed up
+# first (users.id). This matches ORDER BY rr DESC, id ASC in db.py.
+
+import bisect
+import threading
+
+import rr
+
+# Index into rr.RANKS_BY_RR of the rank for rr_value, not counting Usain Bolt
+def _bucket(rr_value):
+    return max(0, bisect.bisect_right(rr.RANK_STARTS, rr_value) - 1)
+
+class LeaderboardIndex:
+    # users is an iterable of (discord_id, id, rr) rows
+    def __init__(self, users=()):
+        self.keys = {}
+        self.ordered = []
+        # How many users are in each of rr.RANKS_BY_RR, kept up to date by every
+        # change below so the distribution never has to be counted
+        self.rank_counts = [0] * len(rr.RANKS_BY_RR)
+        for discord_id, user_id, rr_value in users:
+            key = (-rr_value, user_id, discord_id)
+            self.keys[discord_id] = key
+            self.ordered.append(key)
+            self.rank_counts[_bucket(rr_value)] += 1
+        self.ordered.sort()
+
+    def __len__(self):
+        return len(self.ordered)
+
+    def __contains__(self, discord_id):
+        return discord_id in self.keys
+
+    def __iter__(self):
+        # discord_ids from first place to last
+        return (key[2] for key in self.ordered)
+
+    def position(self, discord_id):
+        key = self.keys.get(discord_id)
+        if key is None:
+            return None
+        return bisect.bisect_left(self.ordered, key) + 1
+
+    def rr(self, discord_id):
+        return -self.keys[discord_id][0]
+
+    # Adds a user and returns their position
+    def add(self, discord_id, user_id, rr):
+        key = (-rr, user_id, discord_id)
+        self.keys[discord_id] = key
+        index = bisect.bisect_left(self.ordered, key)
+        self.ordered.insert(index, key)
+        self.rank_counts[_bucket(rr)] += 1
+        return index + 1
+
+    # Removes a user and returns the position they held
+    def remove(self, discord_id):
+        key = self.keys.pop(discord_id)
+        index = bisect.bisect_left(self.ordered, key)
+        del self.ordered[index]
+        self.rank_counts[_bucket(-key[0])] -= 1
+        return index + 1
+
+    # Changes a user's RR and returns their (old position, new position)
+    def move(self, discord_id, rr):
+        old_key = self.keys[discord_id]
+        old_position = self.remove(discord_id)
+        new_position = self.add(discord_id, old_key[1], rr)
+        return old_position, new_position
+
+    # Changes the RR of many users at once (a dict of discord_id -> rr) with a
+    # single re-sort, and returns {discord_id: (old position, new position)} for
+    # every user whose position changed.
+    def move_many(self, rrs):
+        before = {key[2]: position for position, key in enumerate(self.ordered, start=1)}
+        for discord_id, rr in rrs.items():
+            old_key = self.keys[discord_id]
+            self.keys[discord_id] = (-rr, old_key[1], discord_id)
+            self.rank_counts[_bucket(-old_key[0])] -= 1
+            self.rank_counts[_bucket(rr)] += 1
+        self.ordered = sorted(self.keys.values())
+        moved = {}
+        for position, key in enumerate(self.ordered, start=1):
+            if before[key[2]] != position:
+                moved[key[2]] = (before[key[2]], position)
+        return moved
+
+    # The current RankSummary, in O(number of ranks)
+    def summary(self):
+        counts = self.rank_counts + [0]
+        usain_bolt = None
+        if self.ordered and -self.ordered[0][0] >= rr.USAIN_BOLT_RR_START:
+            usain_bolt = self.ordered[0][2]
+            counts[rr.Rank.GRANDMASTER.value] -= 1
+            counts[rr.Rank.USAIN_BOLT.value] = 1
+        return RankSummary(tuple(counts), len(self.ordered), usain_bolt)
+
+# Rank distribution
+# db.py publishes a RankSummary of each guild's leaderboard index here whenever a
+# transaction that touched it commits, so the ranks and profile commands read the
+# distribution without leaving the event loop. Summaries are never changed once
+# published, only replaced.
+
+class RankSummary:
+    __slots__ = ('counts', 'runners', 'usain_bolt')
+
+    # counts is indexed by Rank.value; usain_bolt is the discord_id of the title
+    # holder, or None if nobody's at the top with enough RR for it
+    def __init__(self, counts, runners, usain_bolt):
+        self.counts = counts
+        self.runners = runners
+        self.usain_bolt = usain_bolt
+
+    def count(self, rank):
+        return self.counts[rank.value]
+
+    # The smallest whole percentage of runners that position is among the top of
+    def top_percent(self, position):
+        return min(100, max(1, -(-100 * position // self.runners))) if self.runners else 100
+
+rank_summaries = {}
+
+# Called as listener(guild_id, old holder, new holder) from the writer thread whenever
+# a commit changes who holds the Usain Bolt title (either can be None)
+title_listeners = []
+
+# The title holder in each guild's last published summary. Kept when a summary is
+# forgotten, so a change is still noticed once the summary is rebuilt.
+_title_holders = {}
+
+def publish_summary(guild_id, summary):
+    rank_summaries[guild_id] = summary
+    # A guild's first summary since startup isn't a change, just the first look
+    seen = guild_id in _title_holders
+    previous = _title_holders.get(guild_id)
+    _title_holders[guild_id] = summary.usain_bolt
+    if seen and previous != summary.usain_bolt:
+        for listener in title_listeners:
+            listener(guild_id, previous, summary.usain_bolt)
+
+def forget_summary(guild_id):
+    rank_summaries.pop(guild_id, None)
+
+# Forgets every guild's summary and title holder, so each guild's next summary is a
+# first look again
+def forget_all_summaries():
+    rank_summaries.clear()
+    _title_holders.clear()
+
+# Leaderboard pages
+# The !mile leaderboard command is served from this cache of pre-rendered pages,
+# so flipping through the leaderboard between runs never touches the database.
+# db.py invalidates the pages whose positions changed once each write commits.
+# Every guild has its own leaderboard, and its own PageCache (see pages below).
+
+PAGE_SIZE = 10
+
+# Turns (leaderboard_position, username, rr) rows into embed (name, value) fields
+def render_page(rows):
+    fields = []
+    for position, username, rr_value in rows:
+        rank = rr.get_rank(rr_value, position)
+        fields.append((f"{rr.get_rank_icon(rank)} #{position} {username}", f"RR: {rr_value} ({rr.get_rank_name(rank)})"))
+    return fields
+
+class PageCache:
+    # Keys are page numbers (from 1), plus COUNT for the number of runners.
+    COUNT = 'count'
+
+    def __init__(self, page_size=PAGE_SIZE):
+        self.page_size = page_size
+        self.entries = {}
+        # Bumped on every invalidation. A page read from the database is only
+        # cached if nothing was invalidated while it was being read, otherwise it
+        # might already be out of date.
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def page_of(self, position):
+        return (position - 1) // self.page_size + 1
+
+    # Returns (value or None, generation to hand back to put)
+    def get(self, key):
+        with self.lock:
+            return self.entries.get(key), self.generation
+
+    def put(self, key, generation, value):
+        with self.lock:
+            if generation == self.generation:
+                self.entries[key] = value
+
+    # Drops the pages showing positions first to last. Leave out last to drop
+    # everything from first onwards (e.g. when someone leaves the leaderboard).
+    def invalidate(self, first, last=None):
+        with self.lock:
+            self.generation += 1
+            first_page = self.page_of(first)
+            last_page = self.page_of(last) if last is not None else None
+            for key in list(self.entries):
+                if key != self.COUNT and key >= first_page and (last_page is None or key <= last_page):
+                    del self.entries[key]
+
+    def invalidate_positions(self, positions):
+        with self.lock:
+            self.generation += 1
+            for page in {self.page_of(position) for position in positions}:
+                self.entries.pop(page, None)
+
+    def invalidate_count(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.pop(self.COUNT, None)
+
+    def invalidate_all(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+# guild_id -> PageCache
+guild_pages = {}
+
+# The page cache for a guild's leaderboard. Called from the reader threads and the
+# event loop as well as the writer, so the cache is created with setdefault, which
+# can't race.
+def pages(guild_id):
+    page_cache = guild_pages.get(guild_id)
+    if page_cache is None:
+        page_cache = guild_pages.setdefault(guild_id, PageCache())
+    return page_cache
@@ -1,31 +1,36 @@
 import aiocron
+import announcements
 import asyncio
+import backups
 import discord
 from discord.ext import commands, tasks
 import logging
 from dotenv import load_dotenv
 from helper import admin_guard
 import helper
+import async_db
+import cache
 import db
+import metrics
 import rr
 import os
 import pytz
+import replay
+import timezones
+import transfer
+import web
 
 load_dotenv()
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 
 EMBED_COLOR = 0x00ff00
 
-handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w')
-
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
 
 bot = commands.Bot(command_prefix='!mile ', intents=intents, help_command=None)
 
-client = discord.Client(intents=intents)
-
 loop = asyncio.get_event_loop()
 
 timezone = pytz.timezone('America/Los_Angeles')
@@ -33,13 +38,44 @@ timezone = pytz.timezone('America/Los_Angeles')
 @bot.event
 async def on_ready():
     print(f'We have logged in as {bot.user}')
+    # Runners from before the bot supported more than one server belong to the server
+    # with the old announcement channel
+    channel = bot.get_channel(LEGACY_ANNOUNCEMENT_CHANNEL_ID)
+    if channel is not None:
+        claimed = await async_db.claim_legacy_guild(str(channel.guild.id), channel.id)
+        if claimed:
+            print(f"Moved {claimed} runners from before multi-server support to {channel.guild.name}.")
+    await catch_up()
+
+# Every server has its own leaderboard, so commands only work inside one
+@bot.check
+async def guild_only(ctx):
+    return ctx.guild is not None
+
+# The ID the database files a server's runners under
+def guild_of(ctx):
+    return str(ctx.guild.id)
 
 @bot.event
 async def on_message(message):
     if message.author == bot.user:
         return
     
-    await bot.process_commands(message)
+    await process_commands(message)
+
+# Same as bot.process_commands, but records each command's latency and errors (see metrics.py)
+async def process_commands(message):
+    if message.author.bot:
+        return
+    ctx = await bot.get_context(message)
+    if ctx.command is None:
+        await bot.invoke(ctx)
+        return
+    name = ctx.command.qualified_name
+    with metrics.time_command(name):
+        await bot.invoke(ctx)
+    if ctx.command_failed:
+        metrics.command_errors.inc(name)
 
 @bot.command()
 async def hello(ctx):
@@ -52,9 +88,13 @@ async def help(ctx):
         "**!mile help**: Displays this help message.",
         "**!mile ranks**: Learn about the different ranks and their RR ranges.",
         "**!mile profile [@user]**: View your profile or another user's profile.",
-        "**!mile leaderboard**: See the leaderboard!",
+        "**!mile leaderboard [page]**: See the leaderboard!",
         "**!mile signup**: Signs you up for Run A Mile Ranked.",
         "**!mile log <distance>**: Logs a run, in miles.",
+        "**!mile seasons [@user]**: See how you or another user finished in past seasons.",
+        "**!mile stats [week|month]**: See your miles this week or month, and the server's top runners by miles.",
+        "**!mile champions**: See the winner of every past season.",
+        "**!mile timezone [name]**: Shows or sets your timezone (e.g. America/New_York), which decides when your day ends.",
     ]
     help_embed = discord.Embed(title="Run A Mile Ranked Help", description=description, color=EMBED_COLOR)
     help_embed.add_field(name="Commands", value="\n".join(commands), inline=False)
@@ -64,58 +104,46 @@ async def help(ctx):
 async def ranks(ctx):
     description = "These are the ranks you can achieve based on your Run Rating (RR):"
     footnote = "Note: To achieve the Usain Bolt rank, you must be the top runner in the server with at least 750 RR."
-    ranks = [f"**{rr.get_rank_icon(rank)} {rr.get_rank_name(rank)}**: {rr.get_rank_range(rank)}" for rank in rr.Rank]
+    summary = await async_db.get_rank_summary(guild_of(ctx))
+    ranks = [f"**{rr.get_rank_icon(rank)} {rr.get_rank_name(rank)}**: {rr.get_rank_range(rank)} ({summary.count(rank)} runner{'s' if summary.count(rank) != 1 else ''})" for rank in rr.Rank]
     ranks_embed = discord.Embed(title="Run Ranks", description=description, color=EMBED_COLOR)
     ranks_embed.add_field(name="Run Ranks", value="\n".join(ranks), inline=False)
     ranks_embed.set_footer(text=footnote)
     await ctx.send(embed=ranks_embed)
 
+# !mile leaderboard [page]
 @bot.command()
-async def leaderboard(ctx):
-    # TODO (akhorana): Implement a web-hosted leaderboard
-    # For now, returns the leaderboard from the database in embed format
-    leaderboard_embed = discord.Embed(title="Run A Mile Ranked Leaderboard", description="Top runners based on their Run Rating (RR).", color=EMBED_COLOR)
-    leaderboard = db.get_leaderboard()
-    if not leaderboard:
-        leaderboard_embed.add_field(name="No runners yet!", value="Be the first to sign up and log a run!", inline=False)
-        await ctx.send(embed=leaderboard_embed)
-        return
-    for user in leaderboard:
-        discord_id = user[1]
-        username = user[2]
-        rr_value = user[5]
-        rank = rr.get_rank(rr_value, user[6])
-        rank_name = rr.get_rank_name(rank)
-        rank_icon = rr.get_rank_icon(rank)
-        leaderboard_embed.add_field(name=f"{rank_icon} {username}", value=f"RR: {rr_value} ({rank_name})", inline=False)
-    await ctx.send(embed=leaderboard_embed)
-    
+async def leaderboard(ctx, page: int = 1):
+    # Returns the leaderboard in embed format, one page at a time, linking to the full
+    # leaderboard on the web (see web.py) when it's reachable from outside
+    leaderboard_embed, page, page_count = await helper.leaderboard_embed(guild_of(ctx), page)
+    if web.WEB_URL:
+        leaderboard_embed.url = web.WEB_URL.rstrip('/') + web.leaderboard_path(guild_of(ctx))
+    await ctx.send(embed=leaderboard_embed, view=helper.LeaderboardView(guild_of(ctx), page, page_count))
 
 @bot.command()
 async def signup(ctx):
-    db.setup()
-    last_position = int(db.get_last_position()) + 1
-    if (db.get_user(str(ctx.author.id)) is not None):
+    if (await async_db.get_user(guild_of(ctx), str(ctx.author.id)) is not None):
         await ctx.send(f"{ctx.author.mention}, you are already signed up for Run A Mile Ranked!")
         return
-    db.add_new_user(str(ctx.author.id), str(ctx.author), last_position)
+    await async_db.add_new_user(guild_of(ctx), str(ctx.author.id), str(ctx.author))
     await ctx.send(f"{ctx.author.mention}, you are now signed up for Run A Mile Ranked, Happy Running! :athletic_shoe:")
 
 @bot.command()
 async def profile(ctx, member: discord.Member = None):
     if member is None:
         member = ctx.author
-    user = db.get_user(str(member.id))
+    user = await async_db.get_user(guild_of(ctx), str(member.id))
     if user is None:
         await ctx.send(f"{ctx.author.mention}, {member.mention} is not signed up for Run A Mile Ranked. They can sign up using `!mile signup`.")
         return
-    username = user[2]
-    longest_streak = user[3]
-    last_logged = user[4]
-    rr_value = user[5]
-    position = user[6]
-    total_distance = user[8]
-    runs_logged = user[7]
+    username = user.username
+    longest_streak = user.longest_streak
+    last_logged = user.last_logged
+    rr_value = user.rr
+    position = user.leaderboard_position
+    total_distance = user.total_distance
+    runs_logged = user.runs_logged
     average_distance = total_distance / runs_logged if runs_logged > 0 else 0
     rank = rr.get_rank(rr_value, position)
     rank_name = rr.get_rank_name(rank)
@@ -128,9 +156,39 @@ async def profile(ctx, member: discord.Member = None):
     profile_embed.add_field(name="Average Distance", value=str(average_distance), inline=False)
     profile_embed.add_field(name="Total Distance", value=str(total_distance), inline=False)
     profile_embed.add_field(name="Last Logged Run", value=str(last_logged) if last_logged else "No runs logged yet", inline=False)
-    profile_embed.add_field(name="Leaderboard Position", value=str(position), inline=False)
+    week, month, personal_best = await async_db.get_profile_stats(guild_of(ctx), str(member.id), timezones.local_date(user.timezone, timezones.now()))
+    profile_embed.add_field(name="Longest Run", value=f"{personal_best:g} miles" if personal_best is not None else "No runs logged yet", inline=False)
+    profile_embed.add_field(name="This Week", value=describe_rollup(week), inline=False)
+    profile_embed.add_field(name="This Month", value=describe_rollup(month), inline=False)
+    summary = await async_db.get_rank_summary(guild_of(ctx))
+    profile_embed.add_field(name="Leaderboard Position", value=f"{position} (top {summary.top_percent(position)}%)", inline=False)
+    profile_embed.add_field(name="Timezone", value=f"{user.timezone} ({timezones.describe_offset(user.tz_offset)})", inline=False)
     await ctx.send(embed=profile_embed)
 
+# A (distance, runs, best) rollup as shown on profiles and stats
+def describe_rollup(rollup):
+    if rollup is None:
+        return "No runs yet"
+    distance, runs, best = rollup
+    return f"{distance:g} miles over {runs} run{'s' if runs != 1 else ''} (longest {best:g})"
+
+# !mile stats [week|month]: your miles this week (or month) and the server's top runners by miles over it.
+# Weeks start on Monday, and "this week" is this week in your timezone.
+@bot.command()
+async def stats(ctx, period: str = "week"):
+    if period not in db.PERIODS:
+        await ctx.send(f"{ctx.author.mention}, usage: `!mile stats [week|month]`.")
+        return
+    user = await async_db.get_user(guild_of(ctx), str(ctx.author.id))
+    date = timezones.local_date(user.timezone if user else timezones.DEFAULT_TIMEZONE, timezones.now())
+    standings = await async_db.get_period_leaderboard(guild_of(ctx), period, date, 10)
+    stats_embed = discord.Embed(title=f"Miles This {period.capitalize()}", description=f"Since {db.period_start(period, date)}", color=EMBED_COLOR)
+    if user is not None:
+        stats_embed.add_field(name="You", value=describe_rollup(await async_db.get_rollup(guild_of(ctx), user.discord_id, period, date)), inline=False)
+    lines = [f"**#{place}** {username}: {distance:g} miles ({runs} run{'s' if runs != 1 else ''})" for place, (_, username, distance, runs, _) in enumerate(standings, start=1)]
+    stats_embed.add_field(name="Top Runners", value="\n".join(lines) or f"Nobody has run this {period} yet", inline=False)
+    await ctx.send(embed=stats_embed)
+
 # !mile log <distance> (assumes miles)
 @bot.command()
 async def log(ctx, *, entry: str):
@@ -141,19 +199,63 @@ async def log(ctx, *, entry: str):
     except ValueError:
         await ctx.send(f"{ctx.author.mention}, please provide a valid positive number for distance. Example: `!mile log 3.5`")
         return
-    db.setup()
-    user = db.get_user(str(ctx.author.id))
-    if user is None:
+    try:
+        user = await async_db.log_run(guild_of(ctx), str(ctx.author.id), distance)
+    except db.NotSignedUp:
         await ctx.send(f"{ctx.author.mention}, you are not signed up for Run A Mile Ranked. Please sign up using `!mile signup` before logging runs.")
         return
-    now = pytz.datetime.datetime.now(tz=timezone)
-    date_string = now.strftime("%Y-%m-%d")
-    if user[4] == date_string:
+    except db.AlreadyLoggedToday:
         await ctx.send(f"{ctx.author.mention}, you have already logged a run today. You can only log one run per day.")
         return
-    db.log_run(str(ctx.author.id), distance, date_string)
-    db.update_leaderboard_positions()
-    await ctx.send(f"{ctx.author.mention}, logged your run of {distance} miles! See your new RR on the leaderboard. Keep it up!")
+    await ctx.send(f"{ctx.author.mention}, logged your run of {distance} miles! You now have {user.rr} RR and are #{user.leaderboard_position} on the leaderboard. Keep it up!")
+
+# !mile seasons [@user]: where a user finished in each past season
+@bot.command()
+async def seasons(ctx, member: discord.Member = None):
+    if member is None:
+        member = ctx.author
+    finishes = await async_db.get_user_seasons(guild_of(ctx), str(member.id))
+    seasons_embed = discord.Embed(title=f"{member.display_name}'s Seasons", color=EMBED_COLOR)
+    if not finishes:
+        seasons_embed.description = "No finished seasons yet."
+    for season, ended, rr_value, position in finishes[:25]:
+        rank = rr.get_rank(rr_value, position)
+        seasons_embed.add_field(name=f"Season {season} (ended {ended})", value=f"#{position}, {rr.get_rank_icon(rank)} {rr.get_rank_name(rank)} with {rr_value} RR", inline=False)
+    await ctx.send(embed=seasons_embed)
+
+# !mile champions: the winner of every past season, and who has won the most
+@bot.command()
+async def champions(ctx):
+    winners = await async_db.get_season_winners(guild_of(ctx))
+    champions_embed = discord.Embed(title="Season Champions", color=EMBED_COLOR)
+    if not winners:
+        champions_embed.description = "No finished seasons yet."
+    else:
+        # Winners come latest first, so each runner is named as they were last time they won
+        titles = {}
+        for _, _, discord_id, username, _ in winners:
+            titles.setdefault(discord_id, [username, 0])[1] += 1
+        most = max(count for _, count in titles.values())
+        champions_embed.description = "Most titles: " + ", ".join(f"{username} ({count})" for username, count in titles.values() if count == most)
+    for season, ended, _, username, rr_value in winners[:24]:
+        champions_embed.add_field(name=f"Season {season} (ended {ended})", value=f"{username}, {rr_value} RR", inline=False)
+    await ctx.send(embed=champions_embed)
+
+# !mile timezone [name]: shows or sets your timezone, in every server you're signed up in.
+# Named set_timezone so it doesn't shadow the module's timezone.
+@bot.command(name="timezone")
+async def set_timezone(ctx, name: str = None):
+    if name is None:
+        user = await async_db.get_user(guild_of(ctx), str(ctx.author.id))
+        current = user.timezone if user else timezones.DEFAULT_TIMEZONE
+        await ctx.send(f"{ctx.author.mention}, your timezone is {current}. Change it with `!mile timezone <name>`, e.g. `!mile timezone America/New_York`.")
+        return
+    try:
+        name = await async_db.set_timezone(str(ctx.author.id), name)
+    except timezones.UnknownTimezone:
+        await ctx.send(f"{ctx.author.mention}, I don't know the timezone `{name}`. Use a name like `America/New_York` or `Europe/London`.")
+        return
+    await ctx.send(f"{ctx.author.mention}, your timezone is now {name}. Your day ends at midnight there.")
 
 # Static Admin Commands: Can only be used by konaxxx
 # TODO (akhorana): Create an allowlist of admins that can use these commands
@@ -161,108 +263,341 @@ async def log(ctx, *, entry: str):
 async def adjust_rr(ctx, member: discord.Member, rr_value: int):
     if not admin_guard(ctx):
         return
-    db.adjust_rr(str(member.id), rr_value)
+    await async_db.adjust_rr(guild_of(ctx), str(member.id), rr_value)
     await ctx.send(f"{ctx.author.mention}, adjusted {member.mention}'s RR to {rr_value}.")
 
 @bot.command()
 async def reset_rr(ctx):
     if not admin_guard(ctx):
         return
-    db.ADMIN_ONLY_reset_rr()
+    await async_db.ADMIN_ONLY_reset_rr(guild_of(ctx))
     await ctx.send(f"{ctx.author.mention}, reset all users' RR to 0.")
 
 @bot.command()
 async def delete_user(ctx, member: discord.Member):
     if not admin_guard(ctx):
         return
-    db.ADMIN_ONLY_delete_user(str(member.id))
+    await async_db.ADMIN_ONLY_delete_user(guild_of(ctx), str(member.id))
     await ctx.send(f"{ctx.author.mention}, deleted {member.mention} from the database.")
 
 @bot.command()
 async def delete_table(ctx):
     if not admin_guard(ctx):
         return
-    db.ADMIN_ONLY_delete_table()
-    await ctx.send(f"{ctx.author.mention}, deleted the users table from the database.")
+    await async_db.ADMIN_ONLY_delete_table(guild_of(ctx))
+    await ctx.send(f"{ctx.author.mention}, deleted every runner in this server from the database.")
 
 @bot.command()
 async def force_update_leaderboard(ctx):
     if not admin_guard(ctx):
         return
-    db.update_leaderboard_positions()
+    await async_db.update_leaderboard_positions(guild_of(ctx))
     await ctx.send(f"{ctx.author.mention}, force updated the leaderboard positions.")
 
 @bot.command()
 async def force_log(ctx, member: discord.Member, distance: float):
     if not admin_guard(ctx):
         return
-    db.setup()
-    user = db.get_user(str(member.id))
-    if user is None:
+    try:
+        await async_db.log_run(guild_of(ctx), str(member.id), distance)
+    except db.NotSignedUp:
         await ctx.send(f"{ctx.author.mention}, {member.mention} is not signed up for Run A Mile Ranked.")
         return
-    now = pytz.datetime.datetime.now(tz=timezone)
-    date_string = now.strftime("%Y-%m-%d")
-    if user[4] == date_string:
+    except db.AlreadyLoggedToday:
         await ctx.send(f"{ctx.author.mention}, {member.mention} has already logged a run today.")
         return
-    db.log_run(str(member.id), distance, date_string)
-    db.update_leaderboard_positions()
     await ctx.send(f"{ctx.author.mention}, force logged a run of {distance} miles for {member.mention}.")
 
 @bot.command()
 async def force_update_streak(ctx, member: discord.Member, streak: int):
     if not admin_guard(ctx):
         return
-    user = db.get_user(str(member.id))
+    user = await async_db.get_user(guild_of(ctx), str(member.id))
     if user is None:
         await ctx.send(f"{ctx.author.mention}, {member.mention} is not signed up for Run A Mile Ranked.")
         return
-    db.update_user(str(member.id), longest_streak=streak)
+    await async_db.update_user(guild_of(ctx), str(member.id), longest_streak=streak)
     await ctx.send(f"{ctx.author.mention}, force updated {member.mention}'s longest streak to {streak} days.")
 
+# !mile replay_history [apply]: re-scores everyone from the run history under the current RR rules.
+# Shows what would change unless "apply" is given.
+@bot.command()
+async def replay_history(ctx, mode: str = "dry"):
+    if not admin_guard(ctx):
+        return
+    dry_run = mode != "apply"
+    yesterday = pytz.datetime.datetime.now(tz=timezone) - pytz.datetime.timedelta(days=1)
+    # A preview only reads, so it stays off the writer; applying it commits on its own,
+    # like an import, so nobody else's writes are grouped in behind the replay
+    if dry_run:
+        diff = await async_db.run_read(replay.replay, guild_of(ctx), yesterday.strftime("%Y-%m-%d"), dry_run)
+    else:
+        diff = await async_db.run_write_alone(replay.replay, guild_of(ctx), yesterday.strftime("%Y-%m-%d"), dry_run)
+    title = "Replay Preview" if dry_run else "Replay Applied"
+    replay_embed = discord.Embed(title=title, description=f"{len(diff)} runners {'would change' if dry_run else 'changed'}.", color=EMBED_COLOR)
+    for discord_id, username, old_rr, new_rr, old_streak, new_streak in diff[:25]:
+        replay_embed.add_field(name=username, value=f"RR: {old_rr} -> {new_rr}, Streak: {old_streak} -> {new_streak}", inline=False)
+    await ctx.send(embed=replay_embed)
+
+# !mile export users|runs [csv|jsonl]: sends this server's runners or run history as a file
+@bot.command(name="export")
+async def export_data(ctx, table: str, format: str = "csv"):
+    if not admin_guard(ctx):
+        return
+    if table not in ("users", "runs") or format not in transfer.FORMATS:
+        await ctx.send(f"{ctx.author.mention}, usage: `!mile export users|runs [csv|jsonl]`.")
+        return
+    file, count = await async_db.run_read(transfer.export_file, guild_of(ctx), table, format)
+    with file:
+        await ctx.send(f"{ctx.author.mention}, exported {count} {table}.", file=discord.File(file, filename=f"{table}.{format}"))
+
+# !mile import users|runs, with a CSV or JSONL file attached: signs up every runner in the file,
+# or adds the runs in it to the run history and re-scores everyone from it (see transfer.py).
+# Runs after yesterday aren't imported.
+@bot.command(name="import")
+async def import_data(ctx, table: str):
+    if not admin_guard(ctx):
+        return
+    if table not in ("users", "runs") or not ctx.message.attachments:
+        await ctx.send(f"{ctx.author.mention}, usage: `!mile import users|runs` with a CSV or JSONL file attached.")
+        return
+    attachment = ctx.message.attachments[0]
+    data = await attachment.read()
+    yesterday = pytz.datetime.datetime.now(tz=timezone) - pytz.datetime.timedelta(days=1)
+    try:
+        result = await async_db.run_write_alone(transfer.import_bytes, guild_of(ctx), table, data, transfer.format_of(attachment.filename), yesterday.strftime("%Y-%m-%d"))
+    except transfer.BadRow as e:
+        await ctx.send(f"{ctx.author.mention}, nothing was imported: {e}")
+        return
+    added, skipped = result[:2]
+    message = f"{ctx.author.mention}, imported {added} {table}, skipped {skipped}."
+    if table == "runs":
+        message += f" {len(result[2])} runners' RR or streak changed."
+    await ctx.send(message)
+
+# !mile backup: backs up the database now. !mile backups lists the most recent backups.
+@bot.command()
+async def backup(ctx):
+    if not admin_guard(ctx):
+        return
+    name = await backups.take('manual')
+    await ctx.send(f"{ctx.author.mention}, backed up the database to `{name}`.")
+
+@bot.command(name="backups")
+async def list_backups(ctx):
+    if not admin_guard(ctx):
+        return
+    names = backups.list_snapshots()[:20]
+    backups_embed = discord.Embed(title="Backups", description="\n".join(f"`{name}`" for name in names) or "No backups yet", color=EMBED_COLOR)
+    backups_embed.set_footer(text="Restore one with !mile restore <name>")
+    await ctx.send(embed=backups_embed)
+
+# !mile restore <name>: puts the whole database (every server) back as it was in a backup. The current
+# database is backed up first, so a restore can be undone too.
+@bot.command()
+async def restore(ctx, name: str):
+    if not admin_guard(ctx):
+        return
+    try:
+        await async_db.restore_backup(name)
+    except backups.UnknownBackup:
+        await ctx.send(f"{ctx.author.mention}, there's no backup called `{name}`. See `!mile backups`.")
+        return
+    await ctx.send(f"{ctx.author.mention}, restored the database from `{name}`.")
+
+# !mile metrics: command latencies, the slowest SQL statements and the user cache hit rate.
+# The full set is served in the Prometheus format at http://127.0.0.1:METRICS_PORT/metrics.
+@bot.command(name="metrics")
+async def metrics_summary(ctx):
+    if not admin_guard(ctx):
+        return
+    def ms(seconds):
+        return f"<{seconds * 1000:g}ms" if seconds is not None else "slow"
+    commands_lines = [f"`{name}`: {count} runs, {errors} errors, p50 {ms(p50)}, p99 {ms(p99)}, {in_flight} running" for name, count, errors, p50, p99, in_flight in metrics.command_summary()]
+    statement_lines = [f"`{statement[:80]}`: {count} runs, {total * 1000:.1f}ms total, {rows} rows" for statement, count, total, rows in metrics.statement_summary(5)]
+    user_cache = cache.users.stats()
+    lookups = user_cache['hits'] + user_cache['misses']
+    metrics_embed = discord.Embed(title="Bot Metrics", color=EMBED_COLOR)
+    metrics_embed.add_field(name="Commands", value="\n".join(commands_lines)[:1024] or "No commands yet", inline=False)
+    metrics_embed.add_field(name="Slowest SQL", value="\n".join(statement_lines)[:1024] or "No statements yet", inline=False)
+    metrics_embed.add_field(name="User Cache", value=f"{user_cache['size']}/{user_cache['capacity']} users, {user_cache['hits'] / lookups if lookups else 0:.0%} hit rate", inline=False)
+    await ctx.send(embed=metrics_embed)
+
+# !mile announcement_channel [#channel]: where this server's daily and season announcements go
+# (defaults to the channel the command is used in)
+@bot.command()
+async def announcement_channel(ctx, channel: discord.TextChannel = None):
+    if not admin_guard(ctx):
+        return
+    if channel is None:
+        channel = ctx.channel
+    await async_db.set_announcement_channel(guild_of(ctx), channel.id)
+    await ctx.send(f"{ctx.author.mention}, announcements for this server will go to {channel.mention}.")
+
 # Periodic Tasks, managing the RR lifecycle and season resets.
 
-announcement_channel_id = 1422105352144425011 # Alex's Server - #run-a-mile-ranked channel
+LEGACY_ANNOUNCEMENT_CHANNEL_ID = 1422105352144425011 # Alex's Server - #run-a-mile-ranked channel
 
-# Daily at midnight PST, announce the end of the day and the RR losses for the players who didn't log a run
-@aiocron.crontab('0 0 * * *', tz=timezone, start=False, loop=loop) # Every day at midnight PST
+# Sends one message's worth of EmbedPages for the announcer
+async def send_pages(channel_id, pages):
+    channel = bot.get_channel(channel_id)
+    if channel is None:
+        raise announcements.Undeliverable(f"Announcement channel {channel_id} not found")
+    await channel.send(embeds=[helper.to_embed(page) for page in pages])
+
+# Every announcement goes through here, so big reports are split to fit Discord's limits and each channel
+# stays inside its rate limit (see announcements.py)
+announcer = announcements.Announcer(send_pages)
+
+# Queues EmbedPages for a server's announcement channel, if it has one. Doesn't wait for them to be sent.
+def announce(channel_id, pages):
+    if channel_id:
+        announcer.post(channel_id, pages)
+
+# Announces the Usain Bolt title changing hands as soon as it happens, whatever the cause (a run, the
+# decay, an admin adjustment or a season reset)
+async def announce_usain_bolt(guild_id, old_holder, new_holder):
+    channel_id = await async_db.get_announcement_channel(guild_id)
+    if new_holder is None:
+        title = "The Usain Bolt Title Is Vacant"
+        description = f"<@{old_holder}> is no longer the Usain Bolt. The top runner needs at least {rr.USAIN_BOLT_RR_START} RR to claim it!"
+    else:
+        title = f"{rr.get_rank_icon(rr.Rank.USAIN_BOLT)} New Usain Bolt!"
+        description = f"<@{new_holder}> is the new Usain Bolt" + (f", taking the title from <@{old_holder}>!" if old_holder else "!")
+    announce(channel_id, announcements.paginate(title, description))
+
+HOUR = pytz.datetime.timedelta(hours=1)
+# The decay's ledger rows are kept this long; only the latest is ever read
+JOB_RUN_RETENTION = pytz.datetime.timedelta(days=7)
+
+# Ends the days that finished in one server by the hourly tick at, and records the tick in the job ledger.
+# Normally that's the buckets of timezones whose midnight just passed (see timezones.midnight_buckets), each
+# announced unless nobody in the server is in it. If the ledger shows ticks were missed while the bot was down,
+# every day that ended since the last recorded tick is applied in one pass instead (see db.catch_up_decay).
+async def end_days(guild_id, channel_id, at):
+    last = await async_db.get_last_job_run(db.DECAY_JOB, guild_id)
+    since = pytz.datetime.datetime.fromisoformat(last) if last else at - HOUR
+    if since >= at:
+        return
+    if since == at - HOUR:
+        for first_offset, end_offset, date in timezones.midnight_buckets(at):
+            pages = await async_db.run_write_alone(helper.daily_rr_message, guild_id, date, first_offset, end_offset)
+            if pages is not None:
+                announce(channel_id, pages)
+    else:
+        print(f"Catching up on the days guild {guild_id} missed since {since}.")
+        pages = await async_db.run_write_alone(helper.catch_up_message, guild_id, since, at)
+        if pages is not None:
+            announce(channel_id, pages)
+    await async_db.record_job_run(db.DECAY_JOB, guild_id, at.isoformat(), (at - JOB_RUN_RETENTION).isoformat())
+
+# Only one tick runs at a time, so the startup catch-up and the hourly job can't announce the same day twice
+end_of_day_lock = asyncio.Lock()
+
+# Ends the days that finished by the hourly tick at in every server. Offsets are refreshed first so daylight
+# saving changes land before anyone is decayed. Every server is handled concurrently. The decays themselves
+# are queued smallest server first and each commits on its own, so a big server's decay never holds up a small
+# server's announcement.
+async def end_of_day(at):
+    async with end_of_day_lock:
+        await async_db.refresh_timezone_offsets(at)
+        guilds = await async_db.get_guilds()
+        results = await asyncio.gather(*(end_days(guild_id, channel_id, at) for guild_id, channel_id, _ in guilds), return_exceptions=True)
+        for (guild_id, _, _), result in zip(guilds, results):
+            if isinstance(result, Exception):
+                print(f"Error: Daily RR management failed for guild {guild_id}: {result!r}")
+
+def current_tick():
+    return timezones.now().replace(minute=0, second=0, microsecond=0)
+
+# Hourly, announce the end of the day and the RR losses for the players whose local midnight just passed and
+# who didn't log a run.
+@aiocron.crontab('0 * * * *', start=False, loop=loop) # Every hour, on the hour
 async def daily_rr_management():
     print("Daily rr management task executed.")
-    embeds = helper.daily_rr_message(timezone, bot, announcement_channel_id)
-    channel = bot.get_channel(announcement_channel_id)
-    if channel:
-        if embeds:
-            for embed in embeds:
-                if embed:
-                    await channel.send(embed=embed)
-    else:
-        print("Error: Announcement channel not found: could not send daily RR embeds")
+    await end_of_day(current_tick())
+
+# Ends one server's season (see db.reset_season) and announces its podium
+async def announce_season_end(guild_id, channel_id, ended):
+    season = await async_db.reset_season(guild_id, ended)
+    if season is None:
+        return
+    podium = []
+    for position, _, username, rr_value in await async_db.get_season_standings(guild_id, season, 3):
+        rank = rr.get_rank(rr_value, position)
+        podium.append((f"#{position} {rr.get_rank_icon(rank)} {username}", f"{rr_value} RR"))
+    announce(channel_id, announcements.paginate(f"Season {season} Is Over!", "Everyone's RR has been pulled toward the floor for the new season. Check out the new leaderboard and keep running!", podium))
+
+# The last day (PST) of the most recently finished season
+def last_season_end():
+    first_of_month = pytz.datetime.datetime.now(tz=timezone).replace(day=1)
+    return (first_of_month - pytz.datetime.timedelta(days=1)).strftime("%Y-%m-%d")
 
 @aiocron.crontab('0 0 1 * *', tz=timezone, start=False, loop=loop) # First day of every month at midnight PST
 async def monthly_season_reset():
-    # TODO (akhorana): Implement monthly season reset, resetting RR and announcing winners
     print("Monthly season reset task executed.")
-    channel = bot.get_channel(announcement_channel_id)
-    if channel:
-        await channel.send("The monthly season has reset! Check out the new leaderboard and keep running!")
+    ended = last_season_end()
+    guilds = await async_db.get_guilds()
+    results = await asyncio.gather(*(announce_season_end(guild_id, channel_id, ended) for guild_id, channel_id, _ in guilds), return_exceptions=True)
+    for (guild_id, _, _), result in zip(guilds, results):
+        if isinstance(result, Exception):
+            print(f"Error: Season reset failed for guild {guild_id}: {result!r}")
+
+@aiocron.crontab(f'30 */{backups.BACKUP_INTERVAL_HOURS} * * *', start=False, loop=loop) # Every few hours, at half past
+async def scheduled_backup():
+    try:
+        await backups.take()
+    except Exception as e:
+        print(f"Error: Scheduled backup failed: {e!r}")
+
+# Runs whatever the periodic tasks missed while the bot was down. Each guild's days are applied once, in one
+# pass (see end_days), and a season that ended while the bot was down is reset for each guild that has had a
+# season reset before. Everything is recorded in the job ledger, so restarting again straight away is cheap
+# and repeats nothing.
+async def catch_up():
+    await end_of_day(current_tick())
+    ended = last_season_end()
+    for guild_id, channel_id, _ in await async_db.get_guilds():
+        last = await async_db.get_last_job_run(db.SEASON_JOB, guild_id)
+        if last is not None and last < ended:
+            try:
+                await announce_season_end(guild_id, channel_id, ended)
+            except Exception as e:
+                print(f"Error: Season reset catch-up failed for guild {guild_id}: {e!r}")
 
 # Admin Commands for periodic tasks
+# Ends yesterday (PST) for everyone in the server, whatever their timezone
 @bot.command()
 async def mock_daily_rr_change(ctx):
     if not admin_guard(ctx):
         return
-    embeds = helper.daily_rr_message(timezone, bot, announcement_channel_id)
-    if embeds:
-        for embed in embeds:
-            if embed:
-                await ctx.send(embed=embed)
+    yesterday = pytz.datetime.datetime.now(tz=timezone) - pytz.datetime.timedelta(days=1)
+    pages = await async_db.run_write_alone(helper.daily_rr_message, guild_of(ctx), yesterday.strftime("%Y-%m-%d"))
+    if pages:
+        await announcer.post(ctx.channel.id, pages)
     await ctx.send(f"{ctx.author.mention}, mock daily RR change executed.")
 
 async def main():
-    async with bot:
-        daily_rr_management.start()
-        monthly_season_reset.start()
-        await bot.start(DISCORD_TOKEN)
+    async_db.start()
+    await async_db.setup()
+    async_db.on_title_change(announce_usain_bolt)
+    metrics_server = await metrics.serve()
+    web_server = await web.serve()
+    try:
+        async with bot:
+            daily_rr_management.start()
+            monthly_season_reset.start()
+            scheduled_backup.start()
+            await bot.start(DISCORD_TOKEN)
+    finally:
+        await web_server.cleanup()
+        await metrics_server.cleanup()
+        await async_db.close()
 
-loop.run_until_complete(main())
\ No newline at end of file
+# Spawned worker processes (see replay.py) re-import this module as __mp_main__, so
+# everything above only defines things: the log file is opened (and truncated) here,
+# along with the servers and the connection to Discord in main(), only when run as
+# the bot.
+if __name__ == "__main__":
+    discord.utils.setup_logging(handler=logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w'))
+    loop.run_until_complete(main())
\ No newline at end of file
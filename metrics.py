@@ -0,0 +1,295 @@
+# In-process metrics for finding where time goes under real load.
+# main.py times every command it dispatches, and db.connect() hands out connections
+# whose cursors time every statement. Everything is exposed in the Prometheus text
+# format on a local HTTP port (see serve) and summarized by the admin
+# `!mile metrics` command.
+
+import bisect
+import functools
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger('ranked')
+
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+
+# Latency buckets in seconds, from a cached page read up to a full decay
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Anything slower than this is also written to the log
+SLOW_COMMAND_SECONDS = 1.0
+SLOW_STATEMENT_SECONDS = 0.1
+
+# Statements are recorded from the writer and reader threads as well as the event
+# loop, so every metric shares one lock.
+_lock = threading.Lock()
+
+# Each metric keeps one value per label value (a command name or a statement), and
+# label=None for metrics without one.
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+
+    def inc(self, key=None, amount=1):
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, _labels(self.label, key), value
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, key=None, amount=1):
+        self.inc(key, -amount)
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, label=None, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        # key -> [count per bucket (the last one is +Inf), sum]
+        self.values = {}
+
+    def observe(self, value, key=None):
+        with _lock:
+            counts_sum = self.values.get(key)
+            if counts_sum is None:
+                counts_sum = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts_sum[0][bisect.bisect_left(self.buckets, value)] += 1
+            counts_sum[1] += value
+
+    def count(self, key=None):
+        counts_sum = self.values.get(key)
+        return sum(counts_sum[0]) if counts_sum else 0
+
+    def total(self, key=None):
+        counts_sum = self.values.get(key)
+        return counts_sum[1] if counts_sum else 0.0
+
+    # Upper bound of the bucket the q-th quantile falls in (None past the last bucket)
+    def quantile(self, q, key=None):
+        counts_sum = self.values.get(key)
+        if not counts_sum:
+            return None
+        counts = counts_sum[0]
+        rank = q * sum(counts)
+        seen = 0
+        for bound, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def samples(self):
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield self.name + '_bucket', _labels(self.label, key, le=bound), cumulative
+            yield self.name + '_sum', _labels(self.label, key), total
+            yield self.name + '_count', _labels(self.label, key), cumulative
+
+def _labels(label, key, **extra):
+    pairs = ([(label, key)] if label is not None else []) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+command_seconds = Histogram('ranked_command_seconds', "Time taken to run each bot command", 'command')
+command_errors = Counter('ranked_command_errors_total', "Bot commands that raised or failed", 'command')
+commands_in_flight = Gauge('ranked_commands_in_flight', "Bot commands currently running", 'command')
+statement_seconds = Histogram('ranked_sql_statement_seconds', "Time taken to execute each SQL statement", 'statement')
+statement_fetch_seconds = Counter('ranked_sql_fetch_seconds_total', "Time spent fetching the rows of each SQL statement", 'statement')
+statement_rows = Counter('ranked_sql_rows_total', "Rows fetched or changed by each SQL statement", 'statement')
+announcement_messages = Counter('ranked_announcement_messages_total', "Announcement messages sent or given up on", 'outcome')
+announcement_retries = Counter('ranked_announcement_retries_total', "Announcement sends that failed and were retried")
+
+METRICS = [command_seconds, command_errors, commands_in_flight, statement_seconds, statement_fetch_seconds, statement_rows, announcement_messages, announcement_retries]
+
+# The Prometheus text exposition of every metric
+def render():
+    lines = []
+    with _lock:
+        for metric in METRICS:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {value}')
+    return '\n'.join(lines) + '\n'
+
+def reset():
+    with _lock:
+        for metric in METRICS:
+            metric.values.clear()
+
+# Commands
+
+# Times the command run inside it. Exceptions count as errors; main.py counts
+# commands that failed without raising (discord.py catches CommandErrors itself).
+@contextmanager
+def time_command(name):
+    commands_in_flight.inc(name)
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        command_errors.inc(name)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        commands_in_flight.dec(name)
+        command_seconds.observe(elapsed, name)
+        if elapsed > SLOW_COMMAND_SECONDS:
+            logger.warning("Slow command %s took %.3fs", name, elapsed)
+
+# SQL
+
+# Collapses a statement to a label: whitespace squashed, IN lists of placeholders
+# and savepoint names folded together so each distinct query is one series.
+@functools.lru_cache(maxsize=1024)
+def statement_label(sql):
+    sql = ' '.join(sql.split())
+    sql = re.sub(r'IN \(\?(, \?)*\)', 'IN (...)', sql)
+    return re.sub(r'\bsp\d+\b', 'sp', sql)
+
+# Cursor that records how long each statement takes to execute and to fetch from,
+# and how many rows it returns or changes. Fetches are added up on the cursor and
+# recorded once the statement's rows run out (or the cursor moves on to the next
+# statement), so iterating over a big result doesn't take the lock once per row.
+class TimedCursor(sqlite3.Cursor):
+    statement = None
+    fetch_seconds = 0.0
+    fetched_rows = 0
+
+    def execute(self, sql, parameters=()):
+        self._flush()
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._executed(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._flush()
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._executed(sql, time.perf_counter() - start)
+
+    def _executed(self, sql, elapsed):
+        self.statement = statement_label(sql)
+        statement_seconds.observe(elapsed, self.statement)
+        if self.rowcount > 0:
+            statement_rows.inc(self.statement, self.rowcount)
+        if elapsed > SLOW_STATEMENT_SECONDS:
+            logger.warning("Slow statement took %.3fs: %s", elapsed, self.statement)
+
+    def _flush(self):
+        if self.fetch_seconds:
+            statement_fetch_seconds.inc(self.statement, self.fetch_seconds)
+        if self.fetched_rows:
+            statement_rows.inc(self.statement, self.fetched_rows)
+        self.fetch_seconds = 0.0
+        self.fetched_rows = 0
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self.fetch_seconds += time.perf_counter() - start
+        if row is None:
+            self._flush()
+        else:
+            self.fetched_rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self.fetch_seconds += time.perf_counter() - start
+        self.fetched_rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self.fetch_seconds += time.perf_counter() - start
+        self.fetched_rows += len(rows)
+        self._flush()
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._flush()
+            raise
+        finally:
+            self.fetch_seconds += time.perf_counter() - start
+        self.fetched_rows += 1
+        return row
+
+# Connection whose cursors (including the ones execute() makes) are TimedCursors
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+# Summaries for !mile metrics
+
+# (command, count, errors, p50, p99, in flight) for each command, busiest first
+def command_summary():
+    with _lock:
+        rows = [(name, command_seconds.count(name), command_errors.values.get(name, 0), command_seconds.quantile(0.5, name), command_seconds.quantile(0.99, name), commands_in_flight.values.get(name, 0))
+            for name in command_seconds.values]
+    return sorted(rows, key=lambda row: -row[1])
+
+# (statement, count, total seconds including fetching, rows) for the limit
+# statements that took the most time overall
+def statement_summary(limit=10):
+    with _lock:
+        rows = [(statement, statement_seconds.count(statement), statement_seconds.total(statement) + statement_fetch_seconds.values.get(statement, 0.0), statement_rows.values.get(statement, 0))
+            for statement in statement_seconds.values]
+    return sorted(rows, key=lambda row: -row[2])[:limit]
+
+# Serves render() at http://METRICS_HOST:METRICS_PORT/metrics until the returned
+# runner is cleaned up. aiohttp comes with discord.py, so it's only imported here
+# to keep db.py (which uses this module) importable without it.
+async def serve(host=METRICS_HOST, port=METRICS_PORT):
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(body=render().encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
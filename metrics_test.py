@@ -0,0 +1,51 @@
+# Testing class for metrics.py
+import unittest
+import db
+import metrics
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('test_seconds', "Test", 'name', buckets=(0.1, 1.0))
+        for value in [0.05, 0.1, 0.5, 2.0]:
+            histogram.observe(value, 'a')
+        self.assertEqual(histogram.count('a'), 4)
+        self.assertAlmostEqual(histogram.total('a'), 2.65)
+        self.assertEqual(histogram.quantile(0.5, 'a'), 0.1)
+        self.assertEqual(histogram.quantile(0.75, 'a'), 1.0)
+        self.assertIsNone(histogram.quantile(1.0, 'a'))
+        self.assertEqual([value for _, _, value in histogram.samples()], [2, 3, 4, 2.65, 4])
+
+    def test_time_command(self):
+        with metrics.time_command('log'):
+            self.assertEqual(metrics.commands_in_flight.values['log'], 1)
+        with self.assertRaises(ValueError):
+            with metrics.time_command('log'):
+                raise ValueError()
+        self.assertEqual(metrics.command_seconds.count('log'), 2)
+        self.assertEqual(metrics.command_errors.values['log'], 1)
+        self.assertEqual(metrics.commands_in_flight.values['log'], 0)
+        self.assertIn('ranked_command_errors_total{command="log"} 1', metrics.render())
+
+    def test_statement_label(self):
+        self.assertEqual(metrics.statement_label('SELECT *\n   FROM users WHERE discord_id IN (?, ?, ?)'), 'SELECT * FROM users WHERE discord_id IN (...)')
+        self.assertEqual(metrics.statement_label('SAVEPOINT sp12'), 'SAVEPOINT sp')
+
+    def test_timed_cursor(self):
+        conn = db.connect(':memory:')
+        conn.execute('CREATE TABLE t (x INTEGER)')
+        conn.executemany('INSERT INTO t VALUES (?)', [(i,) for i in range(5)])
+        self.assertEqual(len(list(conn.execute('SELECT x FROM t'))), 5)
+        self.assertEqual(conn.execute('SELECT x FROM t WHERE x > ?', (2,)).fetchall(), [(3,), (4,)])
+        self.assertEqual(metrics.statement_rows.values['INSERT INTO t VALUES (?)'], 5)
+        self.assertEqual(metrics.statement_rows.values['SELECT x FROM t'], 5)
+        self.assertEqual(metrics.statement_rows.values['SELECT x FROM t WHERE x > ?'], 2)
+        self.assertEqual(metrics.statement_seconds.count('SELECT x FROM t'), 1)
+        summary = {statement: (count, rows) for statement, count, _, rows in metrics.statement_summary()}
+        self.assertEqual(summary['SELECT x FROM t WHERE x > ?'], (1, 2))
+
+if __name__ == '__main__':
+    unittest.main()
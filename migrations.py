@@ -0,0 +1,215 @@
+# Schema migrations.
+# The database records how many of MIGRATIONS it has had applied in
+# PRAGMA user_version, and db.setup() applies the rest in order, once, at startup.
+# To change the schema, append a new migration to the end of MIGRATIONS; never edit
+# or reorder one that has shipped, since existing databases have already run it.
+#
+# Each migration takes the writer cursor and runs inside the transaction that
+# db.setup() opens, so a migration that fails leaves the database as it was.
+
+import timezones
+
+# 1: the original tables. Databases from before migrations existed already have
+# these, which is why they're created IF NOT EXISTS.
+def create_tables(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            discord_id TEXT UNIQUE,
+            username TEXT,
+            longest_streak REAL DEFAULT 0,
+            last_logged DATE,
+            rr INTEGER DEFAULT 0,
+            leaderboard_position INTEGER,
+            runs_logged INTEGER DEFAULT 0,
+            total_distance DOUBLE DEFAULT 0.0
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS users_leaderboard_position ON users (leaderboard_position)')
+    # Append-only history of every run logged, one row per run.
+    # Both indexes carry every column their range queries read, so those queries
+    # never have to visit the table itself.
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            discord_id TEXT NOT NULL,
+            date DATE NOT NULL,
+            distance DOUBLE NOT NULL,
+            rr_before INTEGER NOT NULL,
+            rr_after INTEGER NOT NULL
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS runs_discord_id_date ON runs (discord_id, date, distance, rr_before, rr_after)')
+    c.execute('CREATE INDEX IF NOT EXISTS runs_date ON runs (date, discord_id, distance)')
+
+# 2: indexes for the leaderboard rebuild and the end-of-day decay.
+# users_rr is in leaderboard order and covers the rebuild, so the rebuild reads it
+# already sorted instead of scanning and sorting the table. The end-of-day queries
+# find who didn't log from two partial indexes: users who have logged, by
+# last_logged, and users who never have.
+def add_ranking_indexes(c):
+    c.execute('CREATE INDEX IF NOT EXISTS users_rr ON users (rr DESC, id, discord_id, leaderboard_position)')
+    c.execute('CREATE INDEX IF NOT EXISTS users_last_logged ON users (last_logged) WHERE last_logged IS NOT NULL')
+    c.execute('CREATE INDEX IF NOT EXISTS users_never_logged ON users (id) WHERE last_logged IS NULL')
+
+# Rows from before there was more than one guild. They're kept here until the bot
+# claims them for the guild of its old announcement channel (see db.claim_legacy_guild).
+LEGACY_GUILD_ID = ''
+
+# 3: every guild gets its own leaderboard. users and runs are partitioned by
+# guild_id, which leads every index so each guild's rows sit together, and a
+# discord_id is only unique within a guild. SQLite can't change a UNIQUE
+# constraint in place, so users is rebuilt. guilds holds per-guild settings.
+def partition_by_guild(c):
+    c.execute('''
+        CREATE TABLE guilds (
+            guild_id TEXT PRIMARY KEY,
+            announcement_channel_id INTEGER
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE users_by_guild (
+            id INTEGER PRIMARY KEY,
+            guild_id TEXT NOT NULL,
+            discord_id TEXT,
+            username TEXT,
+            longest_streak REAL DEFAULT 0,
+            last_logged DATE,
+            rr INTEGER DEFAULT 0,
+            leaderboard_position INTEGER,
+            runs_logged INTEGER DEFAULT 0,
+            total_distance DOUBLE DEFAULT 0.0,
+            UNIQUE (guild_id, discord_id)
+        )
+    ''')
+    c.execute('''
+        INSERT INTO users_by_guild (id, guild_id, discord_id, username, longest_streak, last_logged, rr, leaderboard_position, runs_logged, total_distance)
+        SELECT id, ?, discord_id, username, longest_streak, last_logged, rr, leaderboard_position, runs_logged, total_distance FROM users
+    ''', (LEGACY_GUILD_ID,))
+    c.execute('DROP TABLE users')
+    c.execute('ALTER TABLE users_by_guild RENAME TO users')
+    c.execute('CREATE INDEX users_leaderboard_position ON users (guild_id, leaderboard_position)')
+    c.execute('CREATE INDEX users_rr ON users (guild_id, rr DESC, id, discord_id, leaderboard_position)')
+    c.execute('CREATE INDEX users_last_logged ON users (guild_id, last_logged) WHERE last_logged IS NOT NULL')
+    c.execute('CREATE INDEX users_never_logged ON users (guild_id, id) WHERE last_logged IS NULL')
+    # Existing runs default to LEGACY_GUILD_ID
+    c.execute("ALTER TABLE runs ADD COLUMN guild_id TEXT NOT NULL DEFAULT ''")
+    c.execute('DROP INDEX runs_discord_id_date')
+    c.execute('DROP INDEX runs_date')
+    c.execute('CREATE INDEX runs_discord_id_date ON runs (guild_id, discord_id, date, distance, rr_before, rr_after)')
+    c.execute('CREATE INDEX runs_date ON runs (guild_id, date, discord_id, distance)')
+
+# 4: per-user timezones. Everyone starts on timezones.DEFAULT_TIMEZONE, which every
+# day used to be in. tz_offset caches the timezone's current UTC offset for the
+# hourly decay (see timezones.py), and timezones records the offset each timezone
+# was last seen at, so db.refresh_timezone_offsets can tell when daylight saving
+# has moved one. The end-of-day queries search by tz_offset now, so users_last_logged
+# gives way to users_tz_offset and users_never_logged leads with tz_offset too.
+def add_timezones(c):
+    tz_offset = timezones.offset(timezones.DEFAULT_TIMEZONE, timezones.now())
+    c.execute('''
+        CREATE TABLE timezones (
+            name TEXT PRIMARY KEY,
+            tz_offset INTEGER NOT NULL
+        )
+    ''')
+    c.execute('INSERT INTO timezones (name, tz_offset) VALUES (?, ?)', (timezones.DEFAULT_TIMEZONE, tz_offset))
+    # ALTER TABLE only takes constant defaults
+    c.execute(f"ALTER TABLE users ADD COLUMN timezone TEXT NOT NULL DEFAULT '{timezones.DEFAULT_TIMEZONE}'")
+    c.execute(f'ALTER TABLE users ADD COLUMN tz_offset INTEGER NOT NULL DEFAULT {tz_offset}')
+    c.execute('DROP INDEX users_last_logged')
+    c.execute('DROP INDEX users_never_logged')
+    c.execute('CREATE INDEX users_tz_offset ON users (guild_id, tz_offset, last_logged)')
+    c.execute('CREATE INDEX users_never_logged ON users (guild_id, tz_offset) WHERE last_logged IS NULL')
+
+# 5: final standings of every finished season (see db.reset_season), one row per
+# runner, so past seasons are read from here instead of being worked out from runs.
+# Rows are keyed by standing; seasons_discord_id finds one runner's seasons and
+# seasons_winners covers the winners of every season.
+def add_seasons(c):
+    c.execute('''
+        CREATE TABLE seasons (
+            guild_id TEXT NOT NULL,
+            season INTEGER NOT NULL,
+            ended DATE NOT NULL,
+            leaderboard_position INTEGER NOT NULL,
+            discord_id TEXT NOT NULL,
+            username TEXT,
+            rr INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, season, leaderboard_position)
+        ) WITHOUT ROWID
+    ''')
+    c.execute('CREATE INDEX seasons_discord_id ON seasons (guild_id, discord_id, season, ended, rr)')
+    c.execute('CREATE INDEX seasons_winners ON seasons (guild_id, season, ended, discord_id, username, rr) WHERE leaderboard_position = 1')
+
+# 6: a ledger of finished scheduled jobs, so the bot can catch up on the ones it
+# missed while it was down (see db.catch_up_decay), and the last day each user lost
+# RR for, so no day is ever decayed twice, however the decay gets run.
+def add_job_ledger(c):
+    c.execute('''
+        CREATE TABLE job_runs (
+            job TEXT NOT NULL,
+            guild_id TEXT NOT NULL,
+            run_at TEXT NOT NULL,
+            PRIMARY KEY (job, guild_id, run_at)
+        ) WITHOUT ROWID
+    ''')
+    c.execute('ALTER TABLE users ADD COLUMN last_decayed DATE')
+
+# 7: at most one run per user per day, enforced by the database as well as by
+# db.log_run's check, so no race can ever count a day twice. Duplicates already there
+# (which only that race could make) keep their first run; a replay (see replay.py)
+# brings the users' totals back in line with them. The unique index takes over from
+# runs_discord_id_date, which led with the same columns: one user's runs are few
+# enough that reading the rest of each from the table costs next to nothing.
+def unique_daily_runs(c):
+    c.execute('DELETE FROM runs WHERE id NOT IN (SELECT MIN(id) FROM runs GROUP BY guild_id, discord_id, date)')
+    c.execute('DROP INDEX runs_discord_id_date')
+    c.execute('CREATE UNIQUE INDEX runs_discord_id_date ON runs (guild_id, discord_id, date)')
+
+# 8: each runner's distance, run count and longest run for every ISO week (keyed by
+# its Monday) and calendar month (keyed by its 1st) they ran in, kept up to date by
+# every write to runs (see db.log_run) so period stats and standings never scan the
+# run history. run_rollups_distance covers a period's standings, longest first.
+def add_run_rollups(c):
+    c.execute('''
+        CREATE TABLE run_rollups (
+            guild_id TEXT NOT NULL,
+            period TEXT NOT NULL,
+            period_start DATE NOT NULL,
+            discord_id TEXT NOT NULL,
+            distance DOUBLE NOT NULL,
+            runs INTEGER NOT NULL,
+            best DOUBLE NOT NULL,
+            PRIMARY KEY (guild_id, period, period_start, discord_id)
+        ) WITHOUT ROWID
+    ''')
+    c.execute('CREATE INDEX run_rollups_distance ON run_rollups (guild_id, period, period_start, distance DESC, runs, best)')
+    c.execute('''
+        INSERT INTO run_rollups (guild_id, period, period_start, discord_id, distance, runs, best)
+        SELECT guild_id, 'week', date(date, 'weekday 0', '-6 days'), discord_id, SUM(distance), COUNT(*), MAX(distance) FROM runs GROUP BY 1, 3, 4
+        UNION ALL
+        SELECT guild_id, 'month', strftime('%Y-%m-01', date), discord_id, SUM(distance), COUNT(*), MAX(distance) FROM runs GROUP BY 1, 3, 4
+    ''')
+
+MIGRATIONS = [
+    create_tables,
+    add_ranking_indexes,
+    partition_by_guild,
+    add_timezones,
+    add_seasons,
+    add_job_ledger,
+    unique_daily_runs,
+    add_run_rollups,
+]
+
+def version(c):
+    return c.execute('PRAGMA user_version').fetchone()[0]
+
+# Applies every migration the database hasn't had yet, and returns how many ran
+def migrate(c):
+    current = version(c)
+    for number, migration in enumerate(MIGRATIONS[current:], start=current + 1):
+        migration(c)
+        c.execute(f'PRAGMA user_version = {number}')
+    return len(MIGRATIONS) - min(current, len(MIGRATIONS))
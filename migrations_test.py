@@ -0,0 +1,65 @@
+# Testing class for migrations.py
+import unittest
+import db
+import migrations
+
+class TestMigrations(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = db.connect(':memory:')
+        self.c = self.conn.cursor()
+
+    def indexes(self):
+        return {name for name, in self.c.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name NOT LIKE 'sqlite_%'")}
+
+    def test_fresh_database(self):
+        self.assertEqual(migrations.migrate(self.c), len(migrations.MIGRATIONS))
+        self.assertEqual(migrations.version(self.c), len(migrations.MIGRATIONS))
+        self.assertTrue({'users_rr', 'users_tz_offset', 'users_never_logged', 'users_leaderboard_position'} <= self.indexes())
+        # Running again is a no-op
+        self.assertEqual(migrations.migrate(self.c), 0)
+
+    def test_database_from_before_migrations(self):
+        # Tables made by the old setup(), at user_version 0
+        self.c.execute('CREATE TABLE users (id INTEGER PRIMARY KEY, discord_id TEXT UNIQUE, username TEXT, longest_streak REAL DEFAULT 0, last_logged DATE, rr INTEGER DEFAULT 0, leaderboard_position INTEGER, runs_logged INTEGER DEFAULT 0, total_distance DOUBLE DEFAULT 0.0)')
+        self.c.execute("INSERT INTO users (discord_id, username, leaderboard_position) VALUES ('1', 'a', 1)")
+        migrations.migrate(self.c)
+        self.assertEqual(migrations.version(self.c), len(migrations.MIGRATIONS))
+        self.assertEqual(self.c.execute('SELECT guild_id, discord_id FROM users').fetchall(), [(migrations.LEGACY_GUILD_ID, '1')])
+        self.assertIn('users_never_logged', self.indexes())
+
+    def test_duplicate_runs_keep_the_first(self):
+        for migration in migrations.MIGRATIONS[:6]:
+            migration(self.c)
+        self.c.execute('PRAGMA user_version = 6')
+        self.c.execute("INSERT INTO runs (guild_id, discord_id, date, distance, rr_before, rr_after) VALUES ('1', '1', '2025-01-01', 1.0, 0, 25), ('1', '1', '2025-01-01', 2.0, 25, 51), ('1', '1', '2025-01-02', 1.0, 25, 51)")
+        self.assertEqual(migrations.migrate(self.c), len(migrations.MIGRATIONS) - 6)
+        self.assertEqual(self.c.execute('SELECT date, distance FROM runs ORDER BY id').fetchall(), [('2025-01-01', 1.0), ('2025-01-02', 1.0)])
+
+    def test_rollups_are_backfilled_from_runs(self):
+        for migration in migrations.MIGRATIONS[:7]:
+            migration(self.c)
+        self.c.execute('PRAGMA user_version = 7')
+        # Sunday 2025-03-02 is in the week starting Monday 2025-02-24
+        self.c.execute("INSERT INTO runs (guild_id, discord_id, date, distance, rr_before, rr_after) VALUES ('1', '1', '2025-02-27', 1.0, 0, 25), ('1', '1', '2025-03-02', 3.0, 25, 51), ('1', '1', '2025-03-03', 2.0, 51, 77), ('2', '1', '2025-03-03', 1.5, 0, 26)")
+        self.assertEqual(migrations.migrate(self.c), 1)
+        self.assertEqual(self.c.execute("SELECT guild_id, period, period_start, distance, runs, best FROM run_rollups WHERE discord_id = '1' ORDER BY guild_id, period, period_start").fetchall(), [
+            ('1', 'month', '2025-02-01', 1.0, 1, 1.0), ('1', 'month', '2025-03-01', 5.0, 2, 3.0),
+            ('1', 'week', '2025-02-24', 4.0, 2, 3.0), ('1', 'week', '2025-03-03', 2.0, 1, 2.0),
+            ('2', 'month', '2025-03-01', 1.5, 1, 1.5), ('2', 'week', '2025-03-03', 1.5, 1, 1.5),
+        ])
+
+    def test_period_leaderboard_reads_only_the_rows_it_returns(self):
+        migrations.migrate(self.c)
+        plan = ' '.join(row[3] for row in self.c.execute("EXPLAIN QUERY PLAN SELECT discord_id, distance FROM run_rollups WHERE guild_id = '1' AND period = 'week' AND period_start = '2025-03-03' ORDER BY distance DESC LIMIT 10"))
+        self.assertIn('run_rollups_distance', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_didnt_log_query_uses_timezone_indexes(self):
+        migrations.migrate(self.c)
+        plan = ' '.join(row[3] for row in self.c.execute('EXPLAIN QUERY PLAN ' + db._didnt_log('*'), {'guild_id': '1', 'date': '2025-01-01', 'first_offset': -480, 'end_offset': -420}))
+        self.assertIn('users_tz_offset', plan)
+        self.assertIn('runs_discord_id_date', plan)
+
+if __name__ == '__main__':
+    unittest.main()
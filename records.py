@@ -0,0 +1,43 @@
+# Typed user records.
+# Rows of the users table come back as User objects instead of positional tuples,
+# built straight off the cursor by user_factory. A query only needs to select the
+# columns its caller reads: a User only has the attributes that were selected, and
+# reading any other one raises AttributeError rather than quietly using the wrong
+# column.
+
+USER_COLUMNS = ('id', 'guild_id', 'discord_id', 'username', 'longest_streak', 'last_logged', 'rr', 'leaderboard_position', 'runs_logged', 'total_distance', 'timezone', 'tz_offset', 'last_decayed')
+
+class User:
+    __slots__ = USER_COLUMNS
+
+    def __init__(self, **columns):
+        for name, value in columns.items():
+            setattr(self, name, value)
+
+    # (name, value) for each column this record has
+    def columns(self):
+        return [(name, getattr(self, name)) for name in USER_COLUMNS if hasattr(self, name)]
+
+    # Returns a copy with some columns changed
+    def replace(self, **changes):
+        user = User(**dict(self.columns()))
+        for name, value in changes.items():
+            setattr(user, name, value)
+        return user
+
+    def __eq__(self, other):
+        if not isinstance(other, User):
+            return NotImplemented
+        return self.columns() == other.columns()
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'User(' + ', '.join(f'{name}={value!r}' for name, value in self.columns()) + ')'
+
+# sqlite3 row factory: set it on a cursor to get User records back
+def user_factory(cursor, row):
+    user = User.__new__(User)
+    for column, value in zip(cursor.description, row):
+        setattr(user, column[0], value)
+    return user
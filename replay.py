@@ -0,0 +1,136 @@
+# Replays the run history to re-derive everyone's RR, streak and leaderboard position
+# under the current rules in rr.py. Run it after tuning any of the RR constants so
+# existing players are scored the same way new runs will be.
+#
+# Usage: python replay.py GUILD_ID [--through YYYY-MM-DD] [--dry-run] [--workers N]
+#
+# Only run this from the command line while the bot is stopped, since the bot keeps
+# each guild's leaderboard ordering and users in memory and wouldn't see the rewrite.
+# While it's running, use the admin !mile replay_history command instead.
+#
+# Each user's history only depends on their own runs, so users are split into chunks
+# and replayed in parallel on a process pool. Within a chunk the replay steps through
+# the calendar one day at a time, scoring that day's runs and that night's decay for
+# the whole chunk with the batch functions in rr.py.
+#
+# The one thing a user's history doesn't determine on its own is whether they were
+# top of the leaderboard on a given night (the Usain Bolt decay). The replay treats
+# everyone as not being first, so a long-time Usain Bolt will come out with slightly
+# more RR than the live decay would have left them with.
+
+import argparse
+import concurrent.futures
+import datetime
+import multiprocessing
+import os
+from collections import defaultdict
+from itertools import repeat
+
+import db
+import rr
+
+NOT_FIRST = 2  # Leaderboard position used for every user during a replay
+
+def _days(start, end):
+    day = datetime.date.fromisoformat(start)
+    last = datetime.date.fromisoformat(end)
+    while day <= last:
+        yield day.isoformat()
+        day += datetime.timedelta(days=1)
+
+# Replays one chunk of users. histories maps discord_id to that user's runs as
+# (run id, date, distance), oldest first. Nights after through get no decay, since
+# it hasn't been applied for them yet, but their runs are still scored. Returns
+# (users, runs) in the shape db.apply_replay takes.
+def _replay_chunk(histories, through):
+    runs_by_day = defaultdict(list)
+    for discord_id, runs in histories.items():
+        for run_id, date, distance in runs:
+            runs_by_day[date].append((discord_id, run_id, distance))
+    rrs = defaultdict(int)
+    streaks = defaultdict(int)
+    runs_logged = defaultdict(int)
+    total_distance = defaultdict(float)
+    last_logged = {}
+    run_rrs = []
+    # Users with enough RR to lose some for a missed day; everyone else can be skipped
+    at_risk = set()
+    for day in _days(min(runs_by_day), max(max(runs_by_day), through)):
+        todays_runs = runs_by_day.get(day, [])
+        if todays_runs:
+            ids = [discord_id for discord_id, _, _ in todays_runs]
+            new_rrs, _ = rr.calculate_rr_logged_batch([rrs[i] for i in ids], repeat(NOT_FIRST), [streaks[i] for i in ids], [distance for _, _, distance in todays_runs])
+            for (discord_id, run_id, distance), new_rr in zip(todays_runs, new_rrs):
+                run_rrs.append((run_id, rrs[discord_id], new_rr))
+                rrs[discord_id] = new_rr
+                streaks[discord_id] += 1
+                runs_logged[discord_id] += 1
+                total_distance[discord_id] += distance
+                last_logged[discord_id] = day
+                if new_rr >= rr.PLATINUM_RR_START:
+                    at_risk.add(discord_id)
+                else:
+                    at_risk.discard(discord_id)
+        if day > through:
+            continue
+        decaying = at_risk.difference(discord_id for discord_id, _, _ in todays_runs)
+        if decaying:
+            ids = list(decaying)
+            new_rrs, _ = rr.calculate_rr_no_log_batch([rrs[i] for i in ids], repeat(NOT_FIRST))
+            for discord_id, new_rr in zip(ids, new_rrs):
+                rrs[discord_id] = new_rr
+                if new_rr < rr.PLATINUM_RR_START:
+                    at_risk.discard(discord_id)
+    users = [(discord_id, rrs[discord_id], streaks[discord_id], runs_logged[discord_id], total_distance[discord_id], last_logged[discord_id]) for discord_id in histories]
+    return users, run_rrs
+
+# Replays every run in a guild, with decay for each night up to and including through
+# (a YYYY-MM-DD date, normally the last day whose decay has already been applied).
+# Runs from after through, like today's, are scored on top, so everyone still ends up
+# with every run they've logged. Only users who have runs are replayed.
+# Returns (discord_id, username, old_rr, new_rr, old_streak, new_streak) for every
+# replayed user whose RR or streak changes; with dry_run, nothing is written.
+def replay(guild_id, through, dry_run=False, workers=None):
+    current = {user.discord_id: user for user in db.get_leaderboard(guild_id)}
+    histories = defaultdict(list)
+    for run_id, discord_id, date, distance in db.iter_run_history(guild_id):
+        if discord_id in current:
+            histories[discord_id].append((run_id, date, distance))
+    if not histories:
+        return []
+    workers = workers or os.cpu_count() or 1
+    ids = list(histories)
+    chunk_size = -(-len(ids) // (workers * 4))
+    chunks = [{discord_id: histories[discord_id] for discord_id in ids[i:i + chunk_size]} for i in range(0, len(ids), chunk_size)]
+    if workers == 1:
+        results = list(map(_replay_chunk, chunks, repeat(through)))
+    else:
+        # Spawned rather than forked: this runs on a bot thread while other threads
+        # hold locks and SQLite connections that a forked child would inherit mid-use
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            results = list(pool.map(_replay_chunk, chunks, repeat(through)))
+    users, runs = [], []
+    for chunk_users, chunk_runs in results:
+        users.extend(chunk_users)
+        runs.extend(chunk_runs)
+    diff = []
+    for discord_id, new_rr, new_streak, _, _, _ in users:
+        user = current[discord_id]
+        if user.rr != new_rr or user.longest_streak != new_streak:
+            diff.append((discord_id, user.username, user.rr, new_rr, user.longest_streak, new_streak))
+    if not dry_run:
+        db.apply_replay(guild_id, users, runs)
+    return diff
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Re-derive everyone's RR from the run history.")
+    parser.add_argument('guild_id', help="Discord ID of the server to replay")
+    parser.add_argument('--through', default=(datetime.date.today() - datetime.timedelta(days=1)).isoformat(), help="last night to apply decay for (default: yesterday)")
+    parser.add_argument('--dry-run', action='store_true', help="report the changes without writing them")
+    parser.add_argument('--workers', type=int, default=None, help="number of worker processes (default: one per CPU)")
+    args = parser.parse_args()
+    db.setup()
+    diff = replay(args.guild_id, args.through, dry_run=args.dry_run, workers=args.workers)
+    for discord_id, username, old_rr, new_rr, old_streak, new_streak in diff:
+        print(f"{username}: RR {old_rr} -> {new_rr}, streak {old_streak} -> {new_streak}")
+    print(f"{len(diff)} users {'would change' if args.dry_run else 'changed'}.")
@@ -0,0 +1,57 @@
+# Testing class for replay.py
+import unittest
+import db
+import replay
+
+GUILD = '100'
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        db.use_database(':memory:')
+        for discord_id in '123':
+            db.add_new_user(GUILD, discord_id, discord_id)
+        # User 3 climbs out of Gold and then misses days; users 1 and 2 stay in the
+        # ranks without decay so nobody is ever Usain Bolt.
+        db.adjust_rr(GUILD, '3', 290)
+        db.log_run(GUILD, '1', 1.0, '2025-01-01')
+        db.log_run(GUILD, '3', 3.0, '2025-01-01')
+        db.apply_daily_decay(GUILD, '2025-01-01')
+        db.log_run(GUILD, '2', 0.5, '2025-01-02')
+        db.apply_daily_decay(GUILD, '2025-01-02')
+        db.log_run(GUILD, '1', 6.0, '2025-01-03')
+        db.apply_daily_decay(GUILD, '2025-01-03')
+
+    def users(self):
+        db.c.execute('SELECT discord_id, rr, longest_streak, runs_logged, total_distance, last_logged, leaderboard_position FROM users ORDER BY discord_id')
+        return db.c.fetchall()
+
+    def test_replay_matches_live_scoring(self):
+        # User 3's RR came from an admin adjustment, not runs, so the replay rescores it
+        diff = replay.replay(GUILD, '2025-01-03', dry_run=True, workers=1)
+        self.assertEqual(diff, [('3', '3', 305, 27, 1, 1)])
+        before = self.users()
+        self.assertEqual([user[1] for user in before], [53, 0, 305])
+
+    def test_replay_writes_results(self):
+        replay.replay(GUILD, '2025-01-03', workers=1)
+        self.assertEqual(self.users(), [
+            ('1', 53, 2, 2, 7.0, '2025-01-03', 1),
+            ('2', 0, 1, 1, 0.5, '2025-01-02', 3),
+            ('3', 27, 1, 1, 3.0, '2025-01-01', 2),
+        ])
+        self.assertEqual(list(db.iter_user_runs(GUILD, '3')), [('2025-01-01', 3.0, 0, 27)])
+        self.assertEqual(replay.replay(GUILD, '2025-01-03', dry_run=True, workers=1), [])
+
+    def test_replay_keeps_runs_after_through(self):
+        # Logged today, before tonight's decay: scored, but no decay after it
+        db.log_run(GUILD, '1', 1.0, '2025-01-04')
+        before = self.users()
+        self.assertEqual(replay.replay(GUILD, '2025-01-03', dry_run=True, workers=1), [('3', '3', 305, 27, 1, 1)])
+        replay.replay(GUILD, '2025-01-03', workers=1)
+        self.assertEqual(self.users()[0][:6], before[0][:6])
+        self.assertEqual(before[0][1:6], (79, 3, 3, 8.0, '2025-01-04'))
+        self.assertEqual(list(db.iter_user_runs(GUILD, '1', start='2025-01-04')), [('2025-01-04', 1.0, 53, 79)])
+
+if __name__ == '__main__':
+    unittest.main()
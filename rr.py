@@ -5,7 +5,7 @@
 # This encourages consistent running and rewards longer runs.
 # Also, the higher your streak, the more points you get for each run logged.
 
-import db
+from bisect import bisect_left, bisect_right
 from enum import Enum
 import math
 
@@ -49,10 +49,12 @@ USAIN_BOLT_RR_END = float('inf')
 
 # A streak starts at 3 consecutive days of logging a run, and increases in a logarithmic scale
 # A streak is broken if a user does not log a run for a day.
+# STREAK_THRESHOLDS[k] is the streak needed for a bonus of k + 1, i.e. floor(log3(streak)).
+# Looked up with bisect rather than math.log, which rounds 3^5 down to 4.999...
+STREAK_THRESHOLDS = [3 ** k for k in range(1, 40)]
+
 def get_longest_streak_bonus(longest_streak):
-    if longest_streak == 0:
-        return 0
-    return math.floor(math.log(longest_streak, 3))
+    return bisect_right(STREAK_THRESHOLDS, longest_streak)
 
 def get_base_rr_gain(rank):
     if rank == Rank.BRONZE:
@@ -99,35 +101,21 @@ def get_distance_multiplier(distance):
         return 1.0
 
 # Distance bonus to add to the rr gain to reward longer runs
+# Up to 1 mile: +0, up to 2 miles: +1, up to 5 miles: +2, beyond that: +3
+DISTANCE_BONUS_THRESHOLDS = [1.0, 2.0, 5.0]
+
 def get_distance_bonus(distance):
-    if distance <= 1.0:
-        return 0
-    elif distance <= 2.0:
-        return 1
-    elif distance <= 5.0:
-        return 2
-    else:
-        return 3
+    return bisect_left(DISTANCE_BONUS_THRESHOLDS, distance)
 
 # Calculates rr gain for a user who logged a run today
 def calculate_rr_logged(user, distance):
-    rank = get_rank(user[5], user[6])
-    longest_streak = user[3] + 1
-    base_rr_gain = get_base_rr_gain(rank)
-    streak_bonus = get_longest_streak_bonus(longest_streak)
-    distance_multiplier = get_distance_multiplier(distance)
-    distance_bonus = get_distance_bonus(distance)
-    total_rr_gain = math.ceil((base_rr_gain + streak_bonus + distance_bonus) * distance_multiplier)
-    new_rr = max(0, user[5] + total_rr_gain)  # RR cannot go below 0
-    return new_rr
+    new_rrs, _ = calculate_rr_logged_batch([user.rr], [user.leaderboard_position], [user.longest_streak], [distance])
+    return new_rrs[0]
 
 # Calculates rr loss for a user who did not log a run today
 def calculate_rr_no_log(user):
-    rank = get_rank(user[5], user[6])
-    base_rr_loss = get_base_rr_loss(rank)
-    longest_streak = user[3]
-    new_rr = max(0, user[5] - base_rr_loss)  # RR cannot go below 0
-    return new_rr
+    new_rrs, _ = calculate_rr_no_log_batch([user.rr], [user.leaderboard_position])
+    return new_rrs[0]
 
 class Rank(Enum):
     BRONZE = 0 # 0 - 99 RR
@@ -140,22 +128,7 @@ class Rank(Enum):
     USAIN_BOLT = 7 # Rank 1. Must be Grandmaster, and top 1 in RR.
 
 def get_rank(rr, position):
-    if rr < get_rank_start(Rank.SILVER):
-        return Rank.BRONZE
-    elif rr < get_rank_start(Rank.GOLD):
-        return Rank.SILVER
-    elif rr < get_rank_start(Rank.PLATINUM):
-        return Rank.GOLD
-    elif rr < get_rank_start(Rank.DIAMOND):
-        return Rank.PLATINUM
-    elif rr < get_rank_start(Rank.MASTER):
-        return Rank.DIAMOND
-    elif rr < get_rank_start(Rank.GRANDMASTER):
-        return Rank.MASTER
-    elif rr >= get_rank_start(Rank.GRANDMASTER) and position > 1:
-        return Rank.GRANDMASTER
-    else:
-        return Rank.USAIN_BOLT
+    return get_ranks([rr], [position])[0]
     
 def get_rank_name(rank):
     if rank == Rank.BRONZE:
@@ -242,4 +215,56 @@ def get_rank_range(rank):
         return f"{get_rank_start(rank)}+"
     else:
         return f"{get_rank_start(rank)} - {get_rank_end(rank)}"
-    
\ No newline at end of file
+
+# Batch calculations
+# These work on parallel lists (one entry per user) so the nightly decay, season
+# resets and history replays can score thousands of users in one pass. Every rank
+# dependent constant is looked up in the tables below instead of going through
+# the if/elif chains above for each user; the streak and distance rules are the
+# functions above, so each rule is only written down once.
+
+# RANK_STARTS[i] is the lowest RR of RANKS_BY_RR[i]. Usain Bolt isn't in here since it
+# depends on leaderboard position, not just RR.
+RANKS_BY_RR = [Rank.BRONZE, Rank.SILVER, Rank.GOLD, Rank.PLATINUM, Rank.DIAMOND, Rank.MASTER, Rank.GRANDMASTER]
+RANK_STARTS = [get_rank_start(rank) for rank in RANKS_BY_RR]
+
+# Indexed by Rank.value
+BASE_RR_GAINS = [get_base_rr_gain(rank) for rank in Rank]
+BASE_RR_LOSSES = [get_base_rr_loss(rank) for rank in Rank]
+
+def get_ranks(rrs, positions):
+    ranks = []
+    for rr, position in zip(rrs, positions):
+        rank = RANKS_BY_RR[max(0, bisect_right(RANK_STARTS, rr) - 1)]
+        if rank == Rank.GRANDMASTER and not position > 1:
+            rank = Rank.USAIN_BOLT
+        ranks.append(rank)
+    return ranks
+
+# Scores a run for each user. streaks are the users' streaks before this run.
+# Returns (new rrs, new ranks), with ranks worked out against the given positions.
+def calculate_rr_logged_batch(rrs, positions, streaks, distances):
+    new_rrs = []
+    for rank, rr, streak, distance in zip(get_ranks(rrs, positions), rrs, streaks, distances):
+        base_rr_gain = BASE_RR_GAINS[rank.value]
+        streak_bonus = get_longest_streak_bonus(streak + 1)
+        distance_bonus = get_distance_bonus(distance)
+        distance_multiplier = get_distance_multiplier(distance)
+        total_rr_gain = math.ceil((base_rr_gain + streak_bonus + distance_bonus) * distance_multiplier)
+        new_rrs.append(max(0, rr + total_rr_gain))  # RR cannot go below 0
+    return new_rrs, get_ranks(new_rrs, positions)
+
+# Applies a missed day to each user. Returns (new rrs, new ranks), with ranks worked
+# out against the given positions.
+def calculate_rr_no_log_batch(rrs, positions):
+    new_rrs = [max(0, rr - BASE_RR_LOSSES[rank.value]) for rank, rr in zip(get_ranks(rrs, positions), rrs)]  # RR cannot go below 0
+    return new_rrs, get_ranks(new_rrs, positions)
+
+# Season resets pull everyone's RR toward SEASON_RR_FLOOR instead of zeroing it, so the
+# new season starts out in roughly last season's order: RR above the floor keeps
+# SEASON_RR_CARRYOVER of its distance from the floor, and RR at or below it is kept.
+SEASON_RR_FLOOR = 0
+SEASON_RR_CARRYOVER = 0.5
+
+def calculate_rr_season_reset_batch(rrs, floor=SEASON_RR_FLOOR, carryover=SEASON_RR_CARRYOVER):
+    return [floor + int((rr - floor) * carryover) if rr > floor else rr for rr in rrs]
@@ -1,6 +1,8 @@
 # Testing class for rr.py
 import unittest
+from unittest import mock
 import rr
+from records import User
 
 class TestRRFunctions(unittest.TestCase):
 
@@ -17,6 +19,12 @@ class TestRRFunctions(unittest.TestCase):
         self.assertEqual(rr.get_longest_streak_bonus(15), 2)
         self.assertEqual(rr.get_longest_streak_bonus(30), 3)
 
+        # Test exact powers of 3 aren't rounded down
+        self.assertEqual(rr.get_longest_streak_bonus(26), 2)
+        self.assertEqual(rr.get_longest_streak_bonus(27), 3)
+        self.assertEqual(rr.get_longest_streak_bonus(242), 4)
+        self.assertEqual(rr.get_longest_streak_bonus(243), 5)
+
     def test_get_rank(self):
         # Test various RR values and positions
         self.assertEqual(rr.get_rank(0, 10), rr.Rank.BRONZE)
@@ -94,7 +102,7 @@ class TestRRFunctions(unittest.TestCase):
     
     def test_calculate_rr_logged(self):
         # Test RR calculation for various scenarios
-        user = (None, None, None, 0, None, 0, 0, 0, 0)  # Starting user.
+        user = User(longest_streak=0, rr=0, leaderboard_position=0)  # Starting user.
         self.assertEqual(rr.calculate_rr_logged(user, 0.5), 0)  # Distance < 1 mile, should lose nothing
         self.assertEqual(rr.calculate_rr_logged(user, 1.0), 25) # Base 25, no bonuses
         self.assertEqual(rr.calculate_rr_logged(user, 1.5), 26) # Base 25 + 1 distance bonus
@@ -102,5 +110,37 @@ class TestRRFunctions(unittest.TestCase):
         self.assertEqual(rr.calculate_rr_logged(user, 3.0), 27) # Base 25 + 2 distance bonus
         self.assertEqual(rr.calculate_rr_logged(user, 10.0), 28) # Base 25 + 3 distance bonus
 
+    def test_calculate_rr_logged_batch(self):
+        rrs = [0, 0, 150, 420, 760, 760]
+        positions = [5, 5, 4, 3, 2, 1]
+        streaks = [0, 2, 7, 30, 100, 100]
+        distances = [0.5, 3.0, 1.0, 0.2, 6.0, 1.0]
+        new_rrs, new_ranks = rr.calculate_rr_logged_batch(rrs, positions, streaks, distances)
+        self.assertEqual(new_rrs, [0, 28, 175, 402, 784, 781])
+        self.assertEqual(new_ranks, [rr.Rank.BRONZE, rr.Rank.BRONZE, rr.Rank.SILVER, rr.Rank.DIAMOND, rr.Rank.GRANDMASTER, rr.Rank.USAIN_BOLT])
+        # The scalar version agrees with the batch version
+        for i in range(len(rrs)):
+            user = User(longest_streak=streaks[i], rr=rrs[i], leaderboard_position=positions[i])
+            self.assertEqual(rr.calculate_rr_logged(user, distances[i]), new_rrs[i])
+
+    def test_batch_scoring_follows_the_rule_functions(self):
+        user = User(longest_streak=0, rr=0, leaderboard_position=0)
+        with mock.patch.object(rr, 'get_distance_bonus', return_value=10), mock.patch.object(rr, 'get_longest_streak_bonus', return_value=5), mock.patch.object(rr, 'get_distance_multiplier', return_value=2.0):
+            self.assertEqual(rr.calculate_rr_logged(user, 1.0), 80) # (25 + 5 + 10) * 2
+
+    def test_calculate_rr_no_log_batch(self):
+        rrs = [50, 250, 302, 400, 510, 760, 760]
+        positions = [7, 6, 5, 4, 3, 2, 1]
+        new_rrs, new_ranks = rr.calculate_rr_no_log_batch(rrs, positions)
+        self.assertEqual(new_rrs, [50, 250, 297, 393, 498, 743, 738])
+        self.assertEqual(new_ranks, [rr.Rank.BRONZE, rr.Rank.GOLD, rr.Rank.GOLD, rr.Rank.PLATINUM, rr.Rank.DIAMOND, rr.Rank.MASTER, rr.Rank.MASTER])
+        for i in range(len(rrs)):
+            user = User(rr=rrs[i], leaderboard_position=positions[i])
+            self.assertEqual(rr.calculate_rr_no_log(user), new_rrs[i])
+
+    def test_calculate_rr_season_reset_batch(self):
+        self.assertEqual(rr.calculate_rr_season_reset_batch([0, 1, 101, 760]), [0, 0, 50, 380])
+        self.assertEqual(rr.calculate_rr_season_reset_batch([50, 100, 301, 900], floor=100, carryover=0.25), [50, 100, 150, 300])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
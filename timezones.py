@@ -0,0 +1,65 @@
+# Per-user day boundaries.
+# Every user has a timezone, and their day (for logging a run, and for losing RR if
+# they didn't) runs from midnight to midnight in it. Each user row also carries their
+# timezone's current UTC offset in minutes (tz_offset), so the hourly job in main.py
+# can pick out just the users whose local midnight has passed since the last tick
+# with an index range scan (see midnight_buckets).
+
+import datetime
+import functools
+from zoneinfo import ZoneInfo, available_timezones
+
+DEFAULT_TIMEZONE = 'America/Los_Angeles'
+
+# UTC offsets in use anywhere, in minutes (UTC-12:00 to UTC+14:00)
+MIN_OFFSET = -12 * 60
+MAX_OFFSET = 14 * 60
+
+class UnknownTimezone(ValueError):
+    pass
+
+# Returns the canonical name for an IANA timezone name given in any case
+# (e.g. "america/new_york" -> "America/New_York"), or raises UnknownTimezone
+def canonical_name(name):
+    try:
+        return _names()[name.strip().lower()]
+    except KeyError:
+        raise UnknownTimezone(name) from None
+
+@functools.lru_cache(maxsize=None)
+def _names():
+    return {known.lower(): known for known in available_timezones()}
+
+# The offset from UTC, in minutes, of timezone at the aware datetime at
+def offset(timezone, at):
+    return int(at.astimezone(ZoneInfo(timezone)).utcoffset().total_seconds()) // 60
+
+# Today's date (YYYY-MM-DD) in timezone, at the aware datetime at
+def local_date(timezone, at):
+    return at.astimezone(ZoneInfo(timezone)).strftime("%Y-%m-%d")
+
+def now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+# The users whose local midnight passed in the hour up to at (an aware datetime on
+# the hour), as (first offset, end offset, date) buckets: everyone with
+# first <= tz_offset < end has just finished date (YYYY-MM-DD). There's usually one
+# bucket, but two around the date line, where UTC-11:00 and UTC+13:00 reach midnight
+# together a day apart.
+def midnight_buckets(at):
+    at = at.astimezone(datetime.timezone.utc)
+    minute = at.hour * 60 + at.minute
+    buckets = []
+    for day in (-1, 0, 1, 2):
+        # Local time is between 00:00 and 01:00 for offsets in [first, end)
+        first = max(day * 24 * 60 - minute, MIN_OFFSET)
+        end = min(day * 24 * 60 - minute + 60, MAX_OFFSET + 1)
+        if first < end:
+            ended = (at + datetime.timedelta(minutes=first)).date() - datetime.timedelta(days=1)
+            buckets.append((first, end, ended.isoformat()))
+    return buckets
+
+# e.g. "UTC+05:30"
+def describe_offset(minutes):
+    sign = '+' if minutes >= 0 else '-'
+    return f"UTC{sign}{abs(minutes) // 60:02d}:{abs(minutes) % 60:02d}"
@@ -0,0 +1,41 @@
+# Testing class for timezones.py
+import datetime
+import unittest
+import timezones
+
+class TestTimezones(unittest.TestCase):
+
+    def test_every_offset_ends_its_day_once(self):
+        # Over a UTC day, every offset's midnight is in exactly one hourly bucket
+        start = datetime.datetime(2025, 3, 2, 1, tzinfo=datetime.timezone.utc)
+        seen = {}
+        for hour in range(24):
+            at = start + datetime.timedelta(hours=hour)
+            for first, end, date in timezones.midnight_buckets(at):
+                for minutes in range(first, end):
+                    self.assertNotIn(minutes, seen)
+                    seen[minutes] = date
+                    # The local time at the tick is between 00:00 and 01:00 the day after date
+                    local = at + datetime.timedelta(minutes=minutes)
+                    self.assertEqual(local.hour, 0)
+                    self.assertEqual((local.date() - datetime.timedelta(days=1)).isoformat(), date)
+        self.assertEqual(sorted(seen), list(range(timezones.MIN_OFFSET, timezones.MAX_OFFSET + 1)))
+
+    def test_date_line_has_two_buckets(self):
+        at = datetime.datetime(2025, 3, 3, 11, tzinfo=datetime.timezone.utc)
+        self.assertEqual(timezones.midnight_buckets(at), [(-660, -600, '2025-03-02'), (780, 840, '2025-03-03')])
+
+    def test_canonical_name(self):
+        self.assertEqual(timezones.canonical_name(' america/new_york '), 'America/New_York')
+        with self.assertRaises(timezones.UnknownTimezone):
+            timezones.canonical_name('Nowhere/Special')
+
+    def test_offset_and_local_date(self):
+        at = datetime.datetime(2025, 7, 1, 2, tzinfo=datetime.timezone.utc)
+        self.assertEqual(timezones.offset('Asia/Kolkata', at), 330)
+        self.assertEqual(timezones.local_date('America/Los_Angeles', at), '2025-06-30')
+        self.assertEqual(timezones.describe_offset(330), 'UTC+05:30')
+        self.assertEqual(timezones.describe_offset(-210), 'UTC-03:30')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+# Bulk import and export of a guild's runners and run history as CSV or JSONL, for
+# migrating from a spreadsheet or moving a leaderboard between databases.
+#
+# Usage: python transfer.py export {users,runs} GUILD_ID FILE [--format {csv,jsonl}]
+#        python transfer.py import {users,runs} GUILD_ID FILE [--format {csv,jsonl}] [--through YYYY-MM-DD] [--workers N]
+#
+# FILE can be - for stdout/stdin, and the format defaults to the file's extension.
+# The database (RANKED_STATS_DB) is brought up to date first, so a fresh one works.
+# Only run this while the bot is stopped: the bot keeps each guild's leaderboard
+# ordering and users in memory, and would go on to shift positions it no longer
+# has right. While it's running, use the admin !mile import and !mile export commands.
+# Everything streams: exports are written as the rows come off the cursor, and imports
+# are parsed one row at a time and inserted a chunk at a time (see db.import_users).
+#
+# Runners are imported with a discord_id, username and optional timezone. Imported
+# runs (discord_id, date, distance) only go into the run history; everyone's RR,
+# streak and totals are then re-derived from the whole history by a replay (see
+# replay.py), in the same transaction, with the positions rebuilt once at the end.
+# So anything not backed by a run, like an admin RR adjustment, is replaced.
+
+import argparse
+import contextlib
+import csv
+import datetime
+import io
+import json
+import math
+import os
+import sys
+import tempfile
+
+import db
+import replay
+import timezones
+
+USER_FIELDS = ('discord_id', 'username', 'timezone', 'rr', 'leaderboard_position', 'longest_streak', 'runs_logged', 'total_distance', 'last_logged')
+RUN_FIELDS = ('discord_id', 'date', 'distance')
+FORMATS = ('csv', 'jsonl')
+
+# Raised for a row that can't be imported. Nothing from the file is written.
+class BadRow(ValueError):
+    pass
+
+# The format to use for a file name: its extension if that's a known format, else csv
+def format_of(filename):
+    extension = os.path.splitext(filename)[1].lstrip('.').lower()
+    return extension if extension in FORMATS else 'csv'
+
+# Writes rows (tuples in the order of fields) to a text file, and returns how many there were
+def write_rows(file, format, fields, rows):
+    count = 0
+    if format == 'csv':
+        writer = csv.writer(file)
+        writer.writerow(fields)
+        for count, row in enumerate(rows, start=1):
+            writer.writerow(row)
+    else:
+        for count, row in enumerate(rows, start=1):
+            file.write(json.dumps(dict(zip(fields, row))) + '\n')
+    return count
+
+# Yields (line number, dict) for each row of a text file. CSV files need a header row.
+def read_rows(file, format):
+    if format == 'csv':
+        reader = csv.DictReader(file)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for line_number, line in enumerate(file, start=1):
+            if line.strip():
+                try:
+                    row = json.loads(line)
+                except ValueError as e:
+                    raise BadRow(f"line {line_number}: {e}") from None
+                if not isinstance(row, dict):
+                    raise BadRow(f"line {line_number}: expected a JSON object")
+                yield line_number, row
+
+def _field(line_number, row, name):
+    value = row.get(name)
+    if value is None or str(value).strip() == '':
+        raise BadRow(f"line {line_number}: missing {name}")
+    return str(value).strip()
+
+def _parse_user(line_number, row):
+    discord_id = _field(line_number, row, 'discord_id')
+    timezone = row.get('timezone') or timezones.DEFAULT_TIMEZONE
+    try:
+        timezone = timezones.canonical_name(timezone)
+    except timezones.UnknownTimezone:
+        raise BadRow(f"line {line_number}: unknown timezone {timezone}") from None
+    return discord_id, row.get('username') or discord_id, timezone
+
+def _parse_run(line_number, row):
+    discord_id = _field(line_number, row, 'discord_id')
+    try:
+        date = datetime.date.fromisoformat(_field(line_number, row, 'date')).isoformat()
+        distance = float(_field(line_number, row, 'distance'))
+    except ValueError as e:
+        raise BadRow(f"line {line_number}: {e}") from None
+    if not math.isfinite(distance) or distance < 0:
+        raise BadRow(f"line {line_number}: bad distance {distance}")
+    return discord_id, date, distance
+
+def export_users(guild_id, file, format='csv'):
+    return write_rows(file, format, USER_FIELDS, ((user.discord_id, user.username, user.timezone, user.rr, user.leaderboard_position, user.longest_streak, user.runs_logged, user.total_distance, user.last_logged) for user in db.iter_users(guild_id)))
+
+def export_runs(guild_id, file, format='csv'):
+    return write_rows(file, format, RUN_FIELDS, ((discord_id, date, distance) for date, discord_id, distance in db.iter_runs(guild_id)))
+
+# Signs up every runner in file who isn't already. Returns (added, skipped).
+def import_users(guild_id, file, format='csv'):
+    rows = 0
+    def users():
+        nonlocal rows
+        for line_number, row in read_rows(file, format):
+            rows += 1
+            yield _parse_user(line_number, row)
+    added = db.import_users(guild_id, users())
+    return added, rows - added
+
+# Adds the runs in file to the run history and replays it through through (a
+# YYYY-MM-DD date, normally yesterday: the last day whose decay has already been
+# applied). Runs after through are skipped, as are runs by anyone not signed up and
+# second runs on the same day. Returns (added, skipped, diff) with diff as returned
+# by replay.replay.
+def import_runs(guild_id, file, format='csv', through=None, workers=None):
+    through = through or (datetime.date.today() - datetime.timedelta(days=1)).isoformat()
+    rows = 0
+    def runs():
+        nonlocal rows
+        for line_number, row in read_rows(file, format):
+            rows += 1
+            run = _parse_run(line_number, row)
+            if run[1] <= through:
+                yield run
+    with db.transaction():
+        added = db.import_runs(guild_id, runs())
+        diff = replay.replay(guild_id, through, workers=workers) if added else []
+    return added, rows - added, diff
+
+# Exports table ('users' or 'runs') to a temporary file for sending as an attachment.
+# Returns (binary file positioned at the start, row count).
+def export_file(guild_id, table, format='csv'):
+    file = tempfile.TemporaryFile()
+    text = io.TextIOWrapper(file, encoding='utf-8', newline='')
+    count = (export_users if table == 'users' else export_runs)(guild_id, text, format)
+    text.flush()
+    text.detach()
+    file.seek(0)
+    return file, count
+
+# Imports table ('users' or 'runs') from the bytes of an uploaded file. Returns what
+# import_users or import_runs does.
+def import_bytes(guild_id, table, data, format='csv', through=None):
+    text = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8-sig', newline='')
+    if table == 'users':
+        return import_users(guild_id, text, format)
+    return import_runs(guild_id, text, format, through)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Import or export a server's runners and run history.")
+    parser.add_argument('action', choices=('import', 'export'))
+    parser.add_argument('table', choices=('users', 'runs'))
+    parser.add_argument('guild_id', help="Discord ID of the server")
+    parser.add_argument('file', help="CSV or JSONL file, or - for stdin/stdout")
+    parser.add_argument('--format', choices=FORMATS, default=None, help="file format (default: from the file's extension, else csv)")
+    parser.add_argument('--through', default=None, help="last day of runs to import (default: yesterday)")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes for the replay after importing runs (default: one per CPU)")
+    args = parser.parse_args()
+    db.setup()
+    format = args.format or format_of(args.file)
+    if args.action == 'export':
+        with open(args.file, 'w', encoding='utf-8', newline='') if args.file != '-' else contextlib.nullcontext(sys.stdout) as file:
+            count = (export_users if args.table == 'users' else export_runs)(args.guild_id, file, format)
+        print(f"Exported {count} {args.table}.", file=sys.stderr)
+    else:
+        with open(args.file, encoding='utf-8-sig', newline='') if args.file != '-' else contextlib.nullcontext(sys.stdin) as file:
+            try:
+                if args.table == 'users':
+                    added, skipped = import_users(args.guild_id, file, format)
+                else:
+                    added, skipped, diff = import_runs(args.guild_id, file, format, args.through, args.workers)
+            except BadRow as e:
+                sys.exit(f"Nothing imported: {e}")
+        print(f"Imported {added} {args.table}, skipped {skipped}.")
+        if args.table == 'runs':
+            print(f"{len(diff)} users changed.")
@@ -0,0 +1,77 @@
+# Testing class for transfer.py
+import io
+import unittest
+import db
+import transfer
+
+GUILD = '100'
+
+class TestTransfer(unittest.TestCase):
+
+    def setUp(self):
+        db.use_database(':memory:')
+
+    def users(self):
+        db.c.execute('SELECT discord_id, username, timezone, rr, leaderboard_position, runs_logged FROM users ORDER BY leaderboard_position')
+        return db.c.fetchall()
+
+    def test_import_users(self):
+        db.add_new_user(GUILD, '1', 'a')
+        file = io.StringIO('discord_id,username,timezone\n2,b,europe/london\n1,not a,\n3,,\n')
+        self.assertEqual(transfer.import_users(GUILD, file), (2, 1))
+        self.assertEqual(self.users(), [('1', 'a', 'America/Los_Angeles', 0, 1, 0), ('2', 'b', 'Europe/London', 0, 2, 0), ('3', '3', 'America/Los_Angeles', 0, 3, 0)])
+        db.c.execute("SELECT tz_offset FROM users WHERE discord_id = '2'")
+        self.assertIn(db.c.fetchone()[0], (0, 60))
+
+    def test_import_runs_replays_history(self):
+        for discord_id in '12':
+            db.add_new_user(GUILD, discord_id, discord_id)
+        db.log_run(GUILD, '1', 1.0, '2025-01-02')
+        file = io.StringIO('\n'.join([
+            '{"discord_id": "2", "date": "2025-01-01", "distance": 2}',
+            '{"discord_id": "2", "date": "2025-01-02", "distance": 1.5}',
+            '{"discord_id": "1", "date": "2025-01-02", "distance": 3}',
+            '{"discord_id": "9", "date": "2025-01-02", "distance": 3}',
+            '{"discord_id": "2", "date": "2025-01-05", "distance": 3}',
+        ]))
+        added, skipped, diff = transfer.import_runs(GUILD, file, 'jsonl', through='2025-01-03', workers=1)
+        # 1 already ran on the 2nd, 9 isn't signed up and the 5th is after through
+        self.assertEqual((added, skipped), (2, 3))
+        self.assertEqual([discord_id for discord_id, *_ in diff], ['2'])
+        self.assertEqual(self.users(), [('2', '2', 'America/Los_Angeles', 52, 1, 2), ('1', '1', 'America/Los_Angeles', 25, 2, 1)])
+        db.c.execute("SELECT rr_before, rr_after FROM runs WHERE discord_id = '2' ORDER BY date")
+        self.assertEqual(db.c.fetchall(), [(0, 26), (26, 52)])
+
+    def test_bad_row_imports_nothing(self):
+        db.add_new_user(GUILD, '1', 'a')
+        file = io.StringIO('discord_id,date,distance\n1,2025-01-01,1\n1,2025-01-02,far\n')
+        with self.assertRaisesRegex(transfer.BadRow, 'line 3'):
+            transfer.import_runs(GUILD, file, through='2025-01-03', workers=1)
+        db.c.execute('SELECT COUNT(*) FROM runs')
+        self.assertEqual(db.c.fetchone()[0], 0)
+        with self.assertRaisesRegex(transfer.BadRow, 'unknown timezone'):
+            transfer.import_users(GUILD, io.StringIO('{"discord_id": "2", "timezone": "Mars/Olympus"}'), 'jsonl')
+        self.assertEqual(len(self.users()), 1)
+
+    def test_export_round_trip(self):
+        for discord_id in '12':
+            db.add_new_user(GUILD, discord_id, 'runner ' + discord_id)
+        db.log_run(GUILD, '2', 1.0, '2025-01-01')
+        db.log_run(GUILD, '2', 2.0, '2025-01-02')
+        users, runs = io.StringIO(), io.StringIO()
+        self.assertEqual(transfer.export_users(GUILD, users), 2)
+        self.assertEqual(transfer.export_runs(GUILD, runs, 'jsonl'), 2)
+        self.assertEqual(users.getvalue().splitlines()[1], '2,runner 2,America/Los_Angeles,51,1,2.0,2,3.0,2025-01-02')
+        before = self.users()
+        users.seek(0)
+        runs.seek(0)
+        self.assertEqual(transfer.import_users('200', users), (2, 0))
+        self.assertEqual(transfer.import_runs('200', runs, 'jsonl', through='2025-01-02', workers=1)[:2], (2, 0))
+        db.c.execute("SELECT discord_id, username, timezone, rr, leaderboard_position, runs_logged FROM users WHERE guild_id = '200' ORDER BY leaderboard_position")
+        self.assertEqual(db.c.fetchall(), before)
+        file, count = transfer.export_file(GUILD, 'runs')
+        with file:
+            self.assertEqual((count, file.read()), (2, b'discord_id,date,distance\r\n2,2025-01-01,1.0\r\n2,2025-01-02,2.0\r\n'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,248 @@
+# Web leaderboard.
+# Serves every guild's leaderboard, runner profiles and rank distribution as JSON and
+# HTML from an aiohttp server running next to the bot. Requests never query the
+# database: each guild has an immutable Snapshot of its standings, rebuilt (once, on
+# a reader thread, however many requests are waiting) only when the guild's users
+# have been written to since it was taken (see cache.UserCache.versions), and at
+# most every MIN_REBUILD_SECONDS. Every response a snapshot gives is rendered and
+# gzipped once and kept on the snapshot, with an ETag and Last-Modified so clients
+# can revalidate and get a 304 instead of the whole body again.
+
+import asyncio
+import gzip
+import hashlib
+import html
+import json
+import os
+import time
+from email.utils import formatdate, parsedate_to_datetime
+
+import async_db
+import cache
+import rr
+
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("WEB_PORT", "8080"))
+# Where the server can be reached from outside, for links from the bot (unset: no links)
+WEB_URL = os.getenv("WEB_URL")
+
+PAGE_SIZE = 100
+# A busy guild's snapshot is rebuilt at most this often; requests in between get
+# the last one
+MIN_REBUILD_SECONDS = 2.0
+# How long clients may use a response before revalidating it
+MAX_AGE = 10
+# The list of guilds is re-read at most this often, so requests for made-up guild
+# IDs never reach the database
+GUILDS_REFRESH_SECONDS = 60.0
+
+# Paths a guild's resources are served at
+def leaderboard_path(guild_id, format='html', page=1):
+    return f"/guilds/{guild_id}/leaderboard.{format}" + (f"?page={page}" if page != 1 else "")
+
+def profile_path(guild_id, discord_id, format='html'):
+    return f"/guilds/{guild_id}/users/{discord_id}.{format}"
+
+def ranks_path(guild_id, format='html'):
+    return f"/guilds/{guild_id}/ranks.{format}"
+
+# One response body, rendered and compressed once
+class Rendered:
+    __slots__ = ('body', 'gzipped', 'etag', 'gzip_etag', 'content_type')
+
+    def __init__(self, body, content_type):
+        self.body = body
+        self.gzipped = gzip.compress(body, 6)
+        digest = hashlib.blake2b(body, digest_size=12).hexdigest()
+        # The two encodings are different bytes, so they get different ETags
+        self.etag = f'"{digest}"'
+        self.gzip_etag = f'"{digest}-gzip"'
+        self.content_type = content_type
+
+CONTENT_TYPES = {'json': 'application/json; charset=utf-8', 'html': 'text/html; charset=utf-8'}
+
+# A guild's standings at one moment. Nothing on it changes once it's built, apart
+# from rendered filling in as responses are asked for.
+class Snapshot:
+    def __init__(self, guild_id, version, users, built_at=None):
+        self.guild_id = guild_id
+        self.version = version
+        self.users = tuple(users)
+        self.by_discord_id = {user.discord_id: index for index, user in enumerate(self.users)}
+        self.ranks = rr.get_ranks([user.rr for user in self.users], [user.leaderboard_position for user in self.users])
+        self.built_at = int(time.time() if built_at is None else built_at)
+        self.built_monotonic = time.monotonic()
+        self.last_modified = formatdate(self.built_at, usegmt=True)
+        self.rendered = {}
+
+    def page_count(self):
+        return max(1, -(-len(self.users) // PAGE_SIZE))
+
+    # The Rendered response for resource ('leaderboard' with a page number, 'profile'
+    # with a discord_id or 'ranks') in format ('json' or 'html'), or None if there's
+    # no such page or runner
+    def render(self, resource, format, key=None):
+        rendered = self.rendered.get((resource, format, key))
+        if rendered is None:
+            if resource == 'leaderboard':
+                data = self._leaderboard(key)
+            elif resource == 'profile':
+                data = self._profile(key)
+            else:
+                data = self._ranks()
+            if data is None:
+                return None
+            if format == 'json':
+                body = json.dumps(data, separators=(',', ':')).encode()
+            else:
+                body = getattr(self, f'_{resource}_html')(data).encode()
+            rendered = self.rendered[(resource, format, key)] = Rendered(body, CONTENT_TYPES[format])
+        return rendered
+
+    def _runner(self, index):
+        user = self.users[index]
+        rank = self.ranks[index]
+        return {'position': user.leaderboard_position, 'discord_id': user.discord_id, 'username': user.username, 'rr': user.rr, 'rank': rr.get_rank_name(rank), 'rank_icon': rr.get_rank_icon(rank)}
+
+    def _leaderboard(self, page):
+        if not 1 <= page <= self.page_count():
+            return None
+        first = (page - 1) * PAGE_SIZE
+        runners = [self._runner(index) for index in range(first, min(first + PAGE_SIZE, len(self.users)))]
+        return {'guild_id': self.guild_id, 'page': page, 'page_count': self.page_count(), 'runners': runners}
+
+    def _profile(self, discord_id):
+        index = self.by_discord_id.get(discord_id)
+        if index is None:
+            return None
+        user = self.users[index]
+        profile = self._runner(index)
+        profile.update(longest_streak=user.longest_streak, runs_logged=user.runs_logged, total_distance=user.total_distance, last_logged=user.last_logged, timezone=user.timezone)
+        return profile
+
+    def _ranks(self):
+        counts = {rank: 0 for rank in rr.Rank}
+        for rank in self.ranks:
+            counts[rank] += 1
+        return {'guild_id': self.guild_id, 'runners': len(self.users), 'ranks': [{'rank': rr.get_rank_name(rank), 'rank_icon': rr.get_rank_icon(rank), 'range': rr.get_rank_range(rank), 'runners': count} for rank, count in counts.items()]}
+
+    def _leaderboard_html(self, data):
+        rows = ''.join(f"<tr><td>{runner['position']}</td><td>{runner['rank_icon']} <a href=\"{profile_path(self.guild_id, runner['discord_id'])}\">{html.escape(runner['username'] or '')}</a></td><td>{runner['rr']}</td><td>{runner['rank']}</td></tr>" for runner in data['runners'])
+        links = []
+        if data['page'] > 1:
+            links.append(f"<a href=\"{leaderboard_path(self.guild_id, page=data['page'] - 1)}\">◀ Previous</a>")
+        if data['page'] < data['page_count']:
+            links.append(f"<a href=\"{leaderboard_path(self.guild_id, page=data['page'] + 1)}\">Next ▶</a>")
+        return _page("Run A Mile Ranked Leaderboard", f"<table><tr><th>#</th><th>Runner</th><th>RR</th><th>Rank</th></tr>{rows}</table><p>Page {data['page']} of {data['page_count']} {' '.join(links)}</p><p><a href=\"{ranks_path(self.guild_id)}\">Rank distribution</a></p>")
+
+    def _profile_html(self, data):
+        rows = [("Rank", f"{data['rank_icon']} {data['rank']}"), ("Run Rating (RR)", data['rr']), ("Leaderboard Position", data['position']), ("Longest Streak (Days)", data['longest_streak']),
+            ("Total Runs Logged", data['runs_logged']), ("Total Distance", data['total_distance']), ("Last Logged Run", data['last_logged'] or "No runs logged yet"), ("Timezone", data['timezone'])]
+        table = ''.join(f"<tr><th>{name}</th><td>{html.escape(str(value))}</td></tr>" for name, value in rows)
+        return _page(f"{html.escape(data['username'] or '')}'s Profile", f"<table>{table}</table><p><a href=\"{leaderboard_path(self.guild_id)}\">Leaderboard</a></p>")
+
+    def _ranks_html(self, data):
+        rows = ''.join(f"<tr><td>{rank['rank_icon']} {rank['rank']}</td><td>{rank['range']}</td><td>{rank['runners']}</td></tr>" for rank in data['ranks'])
+        return _page("Rank Distribution", f"<table><tr><th>Rank</th><th>RR</th><th>Runners</th></tr>{rows}</table><p><a href=\"{leaderboard_path(self.guild_id)}\">Leaderboard</a></p>")
+
+def _page(title, body):
+    return f"<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>{title}</title></head><body><h1>{title}</h1>{body}</body></html>"
+
+# Keeps each guild's latest Snapshot, rebuilding it when it's out of date
+class Snapshots:
+    def __init__(self):
+        self.snapshots = {}
+        self.building = {}
+        self.guilds = frozenset()
+        self.guilds_read_at = None
+
+    async def known_guilds(self):
+        if self.guilds_read_at is None or time.monotonic() - self.guilds_read_at > GUILDS_REFRESH_SECONDS:
+            self.guilds = frozenset(guild_id for guild_id, _, _ in await async_db.get_guilds())
+            self.guilds_read_at = time.monotonic()
+        return self.guilds
+
+    # The guild's current snapshot, or None for a guild the bot doesn't know
+    async def get(self, guild_id):
+        if guild_id not in await self.known_guilds():
+            return None
+        snapshot = self.snapshots.get(guild_id)
+        if snapshot is not None and (snapshot.version == cache.users.version(guild_id) or time.monotonic() - snapshot.built_monotonic < MIN_REBUILD_SECONDS):
+            return snapshot
+        build = self.building.get(guild_id)
+        if build is None:
+            build = self.building[guild_id] = asyncio.ensure_future(self._build(guild_id))
+            build.add_done_callback(lambda _: self.building.pop(guild_id, None))
+        return await asyncio.shield(build)
+
+    async def _build(self, guild_id):
+        # Read the version first: a write that lands during the read makes the
+        # snapshot look stale and gets it rebuilt, never the other way round
+        version = cache.users.version(guild_id)
+        users = await async_db.get_leaderboard(guild_id)
+        snapshot = self.snapshots[guild_id] = Snapshot(guild_id, version, users)
+        return snapshot
+
+# Whether the client's copy (from its If-None-Match or If-Modified-Since) is current
+def not_modified(headers, snapshot, etag):
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        return etag in tags or '*' in tags
+    if_modified_since = headers.get('If-Modified-Since')
+    if if_modified_since is not None:
+        try:
+            return parsedate_to_datetime(if_modified_since).timestamp() >= snapshot.built_at
+        except (TypeError, ValueError):
+            return False
+    return False
+
+# (status, headers, body) for a request for rendered from snapshot
+def respond(headers, snapshot, rendered):
+    use_gzip = 'gzip' in headers.get('Accept-Encoding', '')
+    etag = rendered.gzip_etag if use_gzip else rendered.etag
+    response_headers = {'ETag': etag, 'Last-Modified': snapshot.last_modified, 'Cache-Control': f'public, max-age={MAX_AGE}', 'Vary': 'Accept-Encoding'}
+    if not_modified(headers, snapshot, etag):
+        return 304, response_headers, b''
+    response_headers['Content-Type'] = rendered.content_type
+    if use_gzip:
+        response_headers['Content-Encoding'] = 'gzip'
+        return 200, response_headers, rendered.gzipped
+    return 200, response_headers, rendered.body
+
+# Serves the web leaderboard at http://host:port until the returned runner is cleaned
+# up. Like metrics.serve, aiohttp is only imported here.
+async def serve(host=WEB_HOST, port=WEB_PORT, snapshots=None):
+    from aiohttp import web
+
+    snapshots = snapshots or Snapshots()
+
+    async def handle(request, resource, key=None):
+        snapshot = await snapshots.get(request.match_info['guild_id'])
+        rendered = snapshot.render(resource, request.match_info['format'], key) if snapshot is not None else None
+        if rendered is None:
+            raise web.HTTPNotFound()
+        status, headers, body = respond(request.headers, snapshot, rendered)
+        return web.Response(status=status, headers=headers, body=body)
+
+    async def leaderboard(request):
+        try:
+            page = int(request.query.get('page', '1'))
+        except ValueError:
+            raise web.HTTPBadRequest()
+        return await handle(request, 'leaderboard', page)
+
+    async def profile(request):
+        return await handle(request, 'profile', request.match_info['discord_id'])
+
+    async def ranks(request):
+        return await handle(request, 'ranks')
+
+    app = web.Application()
+    app.router.add_get('/guilds/{guild_id}/leaderboard.{format:json|html}', leaderboard)
+    app.router.add_get('/guilds/{guild_id}/users/{discord_id}.{format:json|html}', profile)
+    app.router.add_get('/guilds/{guild_id}/ranks.{format:json|html}', ranks)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
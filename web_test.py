@@ -0,0 +1,89 @@
+# Testing class for web.py
+import asyncio
+import gzip
+import json
+import unittest
+from unittest import mock
+import async_db
+import cache
+import db
+import web
+
+GUILD = '100'
+
+class TestWeb(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        db.use_database(':memory:')
+        for discord_id, username, rr in (('1', 'a', 800), ('2', 'b', 300), ('3', '<c>', 50)):
+            db.add_new_user(GUILD, discord_id, username)
+            db.adjust_rr(GUILD, discord_id, rr)
+
+    def snapshot(self):
+        return web.Snapshot(GUILD, cache.users.version(GUILD), db.get_leaderboard(GUILD), built_at=1700000000)
+
+    def test_render(self):
+        snapshot = self.snapshot()
+        page = json.loads(snapshot.render('leaderboard', 'json', 1).body)
+        self.assertEqual([(runner['position'], runner['username'], runner['rank']) for runner in page['runners']], [(1, 'a', 'Usain Bolt'), (2, 'b', 'Platinum'), (3, '<c>', 'Bronze')])
+        self.assertEqual(page['page_count'], 1)
+        self.assertIsNone(snapshot.render('leaderboard', 'json', 2))
+        self.assertEqual(json.loads(snapshot.render('profile', 'json', '2').body)['rr'], 300)
+        self.assertIsNone(snapshot.render('profile', 'json', '4'))
+        ranks = {rank['rank']: rank['runners'] for rank in json.loads(snapshot.render('ranks', 'json').body)['ranks']}
+        self.assertEqual((ranks['Usain Bolt'], ranks['Platinum'], ranks['Bronze'], ranks['Gold']), (1, 1, 1, 0))
+        html = snapshot.render('leaderboard', 'html', 1).body.decode()
+        self.assertIn('&lt;c&gt;', html)
+        self.assertNotIn('<c>', html)
+        # Rendered once, then reused
+        rendered = snapshot.render('ranks', 'html')
+        self.assertIs(snapshot.render('ranks', 'html'), rendered)
+        self.assertEqual(gzip.decompress(rendered.gzipped), rendered.body)
+
+    def test_conditional_get(self):
+        snapshot = self.snapshot()
+        rendered = snapshot.render('leaderboard', 'json', 1)
+        status, headers, body = web.respond({}, snapshot, rendered)
+        self.assertEqual((status, body, headers['ETag'], headers['Last-Modified']), (200, rendered.body, rendered.etag, 'Tue, 14 Nov 2023 22:13:20 GMT'))
+        status, headers, body = web.respond({'Accept-Encoding': 'gzip, br'}, snapshot, rendered)
+        self.assertEqual((status, body, headers['Content-Encoding'], headers['ETag']), (200, rendered.gzipped, 'gzip', rendered.gzip_etag))
+        self.assertEqual(web.respond({'If-None-Match': rendered.etag}, snapshot, rendered)[:3:2], (304, b''))
+        self.assertEqual(web.respond({'If-None-Match': f'"x", W/{rendered.gzip_etag}', 'Accept-Encoding': 'gzip'}, snapshot, rendered)[0], 304)
+        # The plain body's ETag doesn't match the gzipped one
+        self.assertEqual(web.respond({'If-None-Match': rendered.etag, 'Accept-Encoding': 'gzip'}, snapshot, rendered)[0], 200)
+        self.assertEqual(web.respond({'If-Modified-Since': 'Tue, 14 Nov 2023 22:13:20 GMT'}, snapshot, rendered)[0], 304)
+        self.assertEqual(web.respond({'If-Modified-Since': 'Tue, 14 Nov 2023 22:13:19 GMT'}, snapshot, rendered)[0], 200)
+        self.assertEqual(web.respond({'If-Modified-Since': 'yesterday'}, snapshot, rendered)[0], 200)
+        # If-None-Match wins over If-Modified-Since
+        self.assertEqual(web.respond({'If-None-Match': '"x"', 'If-Modified-Since': 'Tue, 14 Nov 2023 22:13:20 GMT'}, snapshot, rendered)[0], 200)
+
+    async def test_snapshots_only_rebuild_when_users_change(self):
+        reads = []
+        async def get_leaderboard(guild_id):
+            reads.append(guild_id)
+            await asyncio.sleep(0)
+            return db.get_leaderboard(guild_id)
+        async def get_guilds():
+            return db.get_guilds()
+        snapshots = web.Snapshots()
+        with mock.patch.object(async_db, 'get_leaderboard', get_leaderboard), mock.patch.object(async_db, 'get_guilds', get_guilds), mock.patch.object(web, 'MIN_REBUILD_SECONDS', 0):
+            first, second = await asyncio.gather(snapshots.get(GUILD), snapshots.get(GUILD))
+            self.assertIs(first, second)
+            self.assertIs(await snapshots.get(GUILD), first)
+            self.assertEqual(reads, [GUILD])
+            self.assertIsNone(await snapshots.get('200'))
+            db.adjust_rr(GUILD, '3', 60)
+            rebuilt = await snapshots.get(GUILD)
+            self.assertIsNot(rebuilt, first)
+            self.assertEqual(rebuilt.users[2].rr, 60)
+            self.assertEqual(reads, [GUILD, GUILD])
+            # Writes to another guild don't touch this one's snapshot
+            db.add_new_user('200', '1', 'a')
+            self.assertIs(await snapshots.get(GUILD), rebuilt)
+        with mock.patch.object(async_db, 'get_leaderboard', get_leaderboard):
+            # Within MIN_REBUILD_SECONDS the last snapshot is served even if it's stale
+            db.adjust_rr(GUILD, '3', 70)
+            self.assertIs(await snapshots.get(GUILD), rebuilt)
+
+if __name__ == '__main__':
+    unittest.main()